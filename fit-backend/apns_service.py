@@ -7,6 +7,9 @@ import ssl
 import ipaddress
 import re
 import logging
+import queue
+import threading
+import time
 import collections
 import collections.abc
 from functools import lru_cache
@@ -80,13 +83,17 @@ if not hasattr(ssl, "match_hostname"):
     ssl.verify_hostname = verify_hostname  # type: ignore[attr-defined]
 
 from apns2.client import APNsClient
+from apns2.credentials import Credentials
 from apns2.payload import Payload
-from apns2.errors import APNsException, Unregistered
-from hyper.http20.exceptions import StreamResetError
-
-logger = logging.getLogger(__name__)
+from apns2.errors import APNsException, ConnectionFailed, Unregistered, exception_class_for_reason
+from h2.exceptions import H2Error
+from hyper import HTTP20Connection
+from hyper.http20.exceptions import HTTP20Error
 
+from circuit_breaker import CircuitBreaker
+from push_outcomes import DEFERRED, FAILED, INVALID_TOKEN, SENT
 
+logger = logging.getLogger(__name__)
 
 
 class ApnsConfigError(RuntimeError):
@@ -103,11 +110,16 @@ def _load_config() -> dict[str, Any]:
 
     use_sandbox = os.getenv("APNS_USE_SANDBOX", "true").strip().lower() in {"1", "true", "yes"}
     password = os.getenv("APNS_CERT_PASSWORD") or None
+    # host:port override, e.g. a local fake endpoint (benchmarks/fake_apns.py)
+    endpoint = os.getenv("APNS_ENDPOINT") or None
+    plaintext = os.getenv("APNS_ENDPOINT_PLAINTEXT", "false").strip().lower() in {"1", "true", "yes"}
     return {
         "cert_path": cert_path,
         "topic": topic,
         "use_sandbox": use_sandbox,
         "password": password,
+        "endpoint": endpoint,
+        "plaintext": bool(endpoint) and plaintext,
     }
 
 
@@ -116,14 +128,211 @@ def get_apns_config() -> dict[str, Any]:
     return _load_config()
 
 
-@lru_cache
-def get_apns_client() -> APNsClient:
-    config = get_apns_config()
-    return APNsClient(
-        config["cert_path"],
-        use_sandbox=config["use_sandbox"],
-        password=config["password"],
-    )
+# Reasons meaning the token will never work again and should be removed
+_INVALID_TOKEN_REASONS = {"Unregistered", "BadDeviceToken"}
+# Reasons meaning APNs itself is failing, not the notification
+_UNAVAILABLE_REASONS = {"InternalServerError", "ServiceUnavailable", "Shutdown"}
+
+APNS_POOL_SIZE = max(1, int(os.getenv("APNS_POOL_SIZE", "2")))
+APNS_MAX_RETRIES = max(0, int(os.getenv("APNS_MAX_RETRIES", "3")))
+APNS_BACKOFF_BASE_SECONDS = float(os.getenv("APNS_BACKOFF_BASE_SECONDS", "0.5"))
+APNS_BACKOFF_MAX_SECONDS = float(os.getenv("APNS_BACKOFF_MAX_SECONDS", "10"))
+# Upper bound on tokens per send_push_batch call; push_delivery splits larger sends
+APNS_BATCH_MAX_TOKENS = 1000
+# apns2 applies the same cap to the server's MAX_CONCURRENT_STREAMS
+_MAX_STREAMS_PER_CONNECTION = 1000
+# Used when the server's limit cannot be read (the minimum RFC 7540 recommends)
+_FALLBACK_STREAMS_PER_CONNECTION = 100
+
+# Errors that mean the connection, not the notification, is broken
+_CONNECTION_ERRORS = (ConnectionFailed, HTTP20Error, H2Error, OSError)
+
+
+class _PlaintextCredentials(Credentials):
+    """h2c without TLS or a client certificate; for local fake endpoints only."""
+
+    def create_connection(self, server, port, proto, proxy_host=None, proxy_port=None):
+        return HTTP20Connection(server, port, secure=False)
+
+
+_stream_limit_warned = False
+
+
+class _PooledClient(APNsClient):
+    def __init__(self, config: dict[str, Any]) -> None:
+        if config["endpoint"]:
+            host, _, port = config["endpoint"].rpartition(":")
+            # _init_connection reads these; instance attributes shadow Apple's hosts
+            self.SANDBOX_SERVER = self.LIVE_SERVER = host
+            self.DEFAULT_PORT = int(port)
+        credentials = _PlaintextCredentials() if config["plaintext"] else config["cert_path"]
+        super().__init__(credentials, use_sandbox=config["use_sandbox"], password=config["password"])
+
+    def connect(self) -> None:
+        # One attempt: the pool retries with backoff and feeds the circuit breaker,
+        # where apns2 would retry immediately and log a traceback each time
+        try:
+            self._connection.connect()
+        except Exception as exc:
+            self._connection.close()
+            raise ConnectionFailed() from exc
+
+    def stream_limit(self) -> int:
+        # Read after connect(): APNs announces the limit in its SETTINGS frame. The h2
+        # state is private to hyper (pinned in requirements.txt); if it ever moves,
+        # send with a conservative limit rather than fail every batch
+        try:
+            with self._connection._conn as h2_connection:
+                limit = h2_connection.remote_settings.max_concurrent_streams
+        except AttributeError:
+            global _stream_limit_warned
+            if not _stream_limit_warned:
+                _stream_limit_warned = True
+                logger.warning(
+                    "Cannot read the APNs stream limit from hyper; using %s", _FALLBACK_STREAMS_PER_CONNECTION
+                )
+            return _FALLBACK_STREAMS_PER_CONNECTION
+        return max(1, min(limit, _MAX_STREAMS_PER_CONNECTION))
+
+    def close(self) -> None:
+        try:
+            self._connection.close()
+        except Exception:
+            pass
+
+
+def _send_streams(client: _PooledClient, tokens: list[str], payload: Payload, topic: str, results: dict) -> None:
+    """
+    Send one stream per token over the client's connection, keeping up to the
+    server's stream limit in flight. Results are recorded as responses arrive, so a
+    connection error leaves only the unanswered tokens missing from results.
+    """
+    client.connect()
+    limit = client.stream_limit()
+    in_flight: collections.deque[tuple[int, str]] = collections.deque()
+    remaining = iter(tokens)
+    token = next(remaining, None)
+    while in_flight or token is not None:
+        if token is not None and len(in_flight) < limit:
+            in_flight.append((client.send_notification_async(token, payload, topic), token))
+            token = next(remaining, None)
+        else:
+            stream_id, answered = in_flight.popleft()
+            results[answered] = client.get_notification_result(stream_id)
+
+
+def _backoff_seconds(attempt: int) -> float:
+    return min(APNS_BACKOFF_MAX_SECONDS, APNS_BACKOFF_BASE_SECONDS * (2 ** (attempt - 1)))
+
+
+class ApnsConnectionPool:
+    """
+    A fixed number of long-lived APNs connections. Each send checks one out, so
+    concurrent batches spread over the pool while the streams of one batch are
+    multiplexed over a single connection. A broken connection is closed and
+    replaced with exponential backoff; only tokens without a response are resent.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._clients: list[_PooledClient | None] = [None] * size
+        self._idle: queue.Queue[int] = queue.Queue()
+        for slot in range(size):
+            self._idle.put(slot)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.notifications = 0
+        self.connects = 0
+        self.connection_errors = 0
+
+    def _client(self, slot: int) -> _PooledClient:
+        client = self._clients[slot]
+        if client is None:
+            client = _PooledClient(get_apns_config())
+            self._clients[slot] = client
+            with self._lock:
+                self.connects += 1
+        return client
+
+    def _discard(self, slot: int) -> None:
+        client = self._clients[slot]
+        self._clients[slot] = None
+        if client is not None:
+            client.close()
+
+    def send(self, tokens: list[str], payload: Payload, topic: str) -> tuple[dict[str, Any], Exception | None]:
+        """
+        Send payload to distinct tokens on one pooled connection.
+        Returns (token -> apns2 result, last connection error); tokens missing from
+        the results were not answered within APNS_MAX_RETRIES reconnects.
+        """
+        results: dict[str, Any] = {}
+        error: Exception | None = None
+        slot = self._idle.get()
+        try:
+            for attempt in range(APNS_MAX_RETRIES + 1):
+                if attempt:
+                    time.sleep(_backoff_seconds(attempt))
+                pending = [token for token in tokens if token not in results]
+                try:
+                    _send_streams(self._client(slot), pending, payload, topic, results)
+                    return results, None
+                except _CONNECTION_ERRORS as exc:
+                    error = exc
+                    self._discard(slot)
+                    with self._lock:
+                        self.connection_errors += 1
+                    logger.warning(
+                        "APNs connection error (attempt %s of %s, %s tokens unanswered): %s",
+                        attempt + 1,
+                        APNS_MAX_RETRIES + 1,
+                        len(tokens) - len(results),
+                        format_apns_exception(exc),
+                    )
+            return results, error
+        finally:
+            self._idle.put(slot)
+            with self._lock:
+                self.batches += 1
+                self.notifications += len(tokens)
+
+    def close(self) -> None:
+        for slot in range(self.size):
+            self._discard(slot)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "connected": sum(1 for client in self._clients if client is not None),
+                "idle": self._idle.qsize(),
+                "batches": self.batches,
+                "notifications": self.notifications,
+                "connects": self.connects,
+                "connection_errors": self.connection_errors,
+            }
+
+
+_pool = ApnsConnectionPool(APNS_POOL_SIZE)
+_circuit = CircuitBreaker("APNs")
+
+
+def close_apns_pool() -> None:
+    """Close every pooled connection; the next send reconnects."""
+    _pool.close()
+
+
+def apns_pool_stats() -> dict[str, Any]:
+    return _pool.stats()
+
+
+def apns_circuit_stats() -> dict[str, Any]:
+    return _circuit.stats()
+
+
+def apns_retry_after() -> float:
+    """Seconds until deferred iOS sends should be retried."""
+    return _circuit.retry_after()
 
 
 def apns_use_sandbox() -> bool:
@@ -151,26 +360,77 @@ def format_apns_exception(exc: Exception) -> str:
     return ", ".join(parts)
 
 
-def send_push(token: str, title: str, body: str, data: dict | None = None) -> None:
-    config = get_apns_config()
-    payload = Payload(
+def _payload(title: str, body: str, data: dict | None) -> Payload:
+    return Payload(
         alert={"title": title, "body": body},
         sound="default",
         badge=1,
         custom=data or {},
     )
+
+
+def _reason(result: Any) -> str:
+    return result[0] if isinstance(result, tuple) else str(result)
+
+
+def _outcome(result: Any, error: Exception | None) -> tuple[str, str | None]:
+    if result is None:
+        return FAILED, format_apns_exception(error) if error else "No response from APNs"
+    if result == "Success":
+        return SENT, None
+    reason = _reason(result)
+    return (INVALID_TOKEN if reason in _INVALID_TOKEN_REASONS else FAILED), reason
+
+
+def _transport_failed(results: dict[str, Any], error: Exception | None) -> bool:
+    """A connection that stayed broken, or APNs answering only with server errors."""
+    if error is not None:
+        return True
+    return bool(results) and all(_reason(result) in _UNAVAILABLE_REASONS for result in results.values())
+
+
+def send_push_batch(
+    tokens: list[str],
+    title: str,
+    body: str,
+    data: dict | None = None,
+) -> list[tuple[str, str | None]]:
+    """
+    Send one notification to many tokens over a pooled connection, one HTTP/2
+    stream per token. Returns (outcome, error) per token in input order: sent,
+    invalid_token (Unregistered/BadDeviceToken; remove the token), failed, or
+    deferred for every token while the APNs circuit is open.
+    Raises ApnsConfigError when APNs is not configured.
+    """
+    config = get_apns_config()
+    if not _circuit.allow():
+        return [(DEFERRED, "APNs circuit open")] * len(tokens)
+    transport_failed = False
     try:
-        client = get_apns_client()
-        client.send_notification(token, payload, config["topic"])
-    except StreamResetError as exc:
-        logger.warning(
-            "APNs stream reset; retrying once. topic=%s sandbox=%s",
-            config["topic"],
-            config["use_sandbox"],
-        )
-        get_apns_client.cache_clear()
-        client = get_apns_client()
-        client.send_notification(token, payload, config["topic"])
+        results, error = _pool.send(list(dict.fromkeys(tokens)), _payload(title, body, data), config["topic"])
+        transport_failed = _transport_failed(results, error)
+    finally:
+        # Always settle, or a half-open probe that raised would keep the circuit
+        # shut for good. Anything but a connection error means APNs was reachable.
+        if transport_failed:
+            _circuit.record_failure()
+        else:
+            _circuit.record_success()
+    return [_outcome(results.get(token), error) for token in tokens]
+
+
+def send_push(token: str, title: str, body: str, data: dict | None = None) -> None:
+    """Send to one token; raises the APNs error (e.g. Unregistered) on rejection."""
+    config = get_apns_config()
+    results, error = _pool.send([token], _payload(title, body, data), config["topic"])
+    result = results.get(token)
+    if result is None:
+        raise error or ConnectionFailed()
+    if isinstance(result, tuple):
+        reason, timestamp = result
+        raise exception_class_for_reason(reason)(timestamp)
+    if result != "Success":
+        raise exception_class_for_reason(result)
 
 
 __all__ = [
@@ -178,6 +438,11 @@ __all__ = [
     "APNsException",
     "Unregistered",
     "apns_use_sandbox",
+    "apns_circuit_stats",
+    "apns_pool_stats",
+    "apns_retry_after",
+    "close_apns_pool",
     "format_apns_exception",
     "send_push",
+    "send_push_batch",
 ]
@@ -5,20 +5,24 @@ from __future__ import annotations
 import json
 from typing import Any
 
-from fastapi import Header
+from fastapi import Header, HTTPException
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
 from auth import require_user
-from database import engine
+from database import REQUEST_CONNECTION, engine
 
 
 def maybe_get_user(
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ) -> dict | None:
+    """The signed-in user, or None for a missing or invalid session token."""
     try:
-        return require_user(authorization=authorization, x_user_token=x_user_token)
-    except Exception:
+        return require_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
+    except HTTPException:
+        # Only auth failures: a database error has aborted the request transaction
         return None
 
 
@@ -28,22 +32,28 @@ def log_audit_event(
     action: str,
     summary: str | None = None,
     details: dict[str, Any] | None = None,
+    conn: Connection | None = None,
 ) -> None:
+    """Record an audit event; in the caller's transaction when conn is given."""
+    if conn is None:
+        with engine.begin() as own_conn:
+            log_audit_event(server_name, actor_user_id, action, summary, details, own_conn)
+        return
+
     payload = json.dumps(details or {})
-    with engine.begin() as conn:
-        conn.execute(
-            text(
-                """
-                INSERT INTO audit_logs (server_name, actor_user_id, action, summary, details_json)
-                VALUES (:server_name, :actor_user_id, :action, :summary, :details_json)
-                """
-            ),
-            {
-                "server_name": server_name,
-                "actor_user_id": actor_user_id,
-                "action": action,
-                "summary": summary,
-                "details_json": payload,
-            },
-        )
+    conn.execute(
+        text(
+            """
+            INSERT INTO audit_logs (server_name, actor_user_id, action, summary, details_json)
+            VALUES (:server_name, :actor_user_id, :action, :summary, :details_json)
+            """
+        ),
+        {
+            "server_name": server_name,
+            "actor_user_id": actor_user_id,
+            "action": action,
+            "summary": summary,
+            "details_json": payload,
+        },
+    )
 
@@ -1,15 +1,34 @@
-"""Authentication and authorization functions."""
+"""
+Authentication and authorization functions.
+
+Each dependency has an async twin (require_api_key_async, ...) for routes declared
+async: same cache and queries, but cache misses go through the request's
+RequestTransaction instead of blocking a threadpool thread. Cache misses in the
+sync dependencies use the request's connection (database.REQUEST_CONNECTION).
+"""
 
 import os
 from fastapi import HTTPException, Header, Query
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from utils import hash_token, generate_opaque_token
-from database import engine
+from database import (
+    REQUEST_CONNECTION,
+    REQUEST_TRANSACTION,
+    RequestTransaction,
+    engine,
+    run_in_transaction,
+)
+import auth_cache
+import last_used_tracker
 
 MASTER_ADMIN_KEY = os.getenv("MASTER_ADMIN_KEY", "change-me-in-production")
 
 
-def require_api_key(x_api_key: str | None = Header(default=None, alias="X-API-Key")) -> str:
+def require_api_key(
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    conn: Connection = REQUEST_CONNECTION,
+) -> str:
     """
     Validate server API key (opaque token).
     Returns server_name on success.
@@ -18,23 +37,52 @@ def require_api_key(x_api_key: str | None = Header(default=None, alias="X-API-Ke
         raise HTTPException(status_code=401, detail="Missing API key")
     
     key_hash = hash_token(x_api_key)
+    server_name = auth_cache.api_keys.get(key_hash)
     
-    with engine.begin() as conn:
-        key_row = conn.execute(
-            text("SELECT server_name FROM api_keys WHERE key = :key_hash AND active = TRUE"),
-            {"key_hash": key_hash}
-        ).fetchone()
-        
-        if not key_row:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Update last_used timestamp
-        conn.execute(
-            text("UPDATE api_keys SET last_used = NOW() WHERE key = :key_hash"),
-            {"key_hash": key_hash}
-        )
+    if server_name is None:
+        generation = auth_cache.api_keys.generation()
+        key_row = _lookup_api_key(conn, key_hash)
+        server_name = _cache_api_key(key_hash, key_row, generation)
     
-    return key_row[0]
+    # last_used is written in batches by last_used_tracker
+    last_used_tracker.touch("api_keys", key_hash)
+    return server_name
+
+
+async def require_api_key_async(
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
+) -> str:
+    """require_api_key for async routes."""
+    if not x_api_key:
+        raise HTTPException(status_code=401, detail="Missing API key")
+
+    key_hash = hash_token(x_api_key)
+    server_name = auth_cache.api_keys.get(key_hash)
+
+    if server_name is None:
+        generation = auth_cache.api_keys.generation()
+        key_row = await tx.run(_lookup_api_key, key_hash)
+        server_name = _cache_api_key(key_hash, key_row, generation)
+
+    last_used_tracker.touch("api_keys", key_hash)
+    return server_name
+
+
+def _lookup_api_key(conn, key_hash: str):
+    return conn.execute(
+        text("SELECT server_name FROM api_keys WHERE key = :key_hash AND active = TRUE"),
+        {"key_hash": key_hash}
+    ).fetchone()
+
+
+def _cache_api_key(key_hash: str, key_row, generation: int) -> str:
+    if not key_row:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    server_name = key_row[0]
+    auth_cache.api_keys.put(key_hash, server_name, generation)
+    return server_name
 
 
 def require_master_admin(x_admin_key: str | None = Header(default=None, alias="X-Admin-Key")) -> bool:
@@ -50,9 +98,39 @@ def require_master_admin(x_admin_key: str | None = Header(default=None, alias="X
 
 def require_user(
     authorization: str | None = Header(default=None, alias="Authorization"),
-    x_user_token: str | None = Header(default=None, alias="X-User-Token")
+    x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ) -> dict:
     """Validate user session token and return user info."""
+    token_hash = _session_token_hash(authorization, x_user_token)
+    user = auth_cache.sessions.get(token_hash)
+    if user is None:
+        generation = auth_cache.sessions.generation()
+        row = _lookup_session(conn, token_hash)
+        user = _cache_session(token_hash, row, generation)
+
+    last_used_tracker.touch("user_sessions", token_hash)
+    return dict(user)
+
+
+async def require_user_async(
+    authorization: str | None = Header(default=None, alias="Authorization"),
+    x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
+) -> dict:
+    """require_user for async routes."""
+    token_hash = _session_token_hash(authorization, x_user_token)
+    user = auth_cache.sessions.get(token_hash)
+    if user is None:
+        generation = auth_cache.sessions.generation()
+        row = await tx.run(_lookup_session, token_hash)
+        user = _cache_session(token_hash, row, generation)
+
+    last_used_tracker.touch("user_sessions", token_hash)
+    return dict(user)
+
+
+def _session_token_hash(authorization: str | None, x_user_token: str | None) -> str:
     token = None
     if x_user_token:
         token = x_user_token.strip()
@@ -61,29 +139,29 @@ def require_user(
 
     if not token:
         raise HTTPException(status_code=401, detail="Missing user token")
+    return hash_token(token)
+
+
+def _lookup_session(conn, token_hash: str):
+    return conn.execute(
+        text("""
+            SELECT u.id, u.email, u.name
+            FROM user_sessions s
+            JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash = :token_hash
+            LIMIT 1
+        """),
+        {"token_hash": token_hash}
+    ).fetchone()
 
-    token_hash = hash_token(token)
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT u.id, u.email, u.name
-                FROM user_sessions s
-                JOIN users u ON u.id = s.user_id
-                WHERE s.token_hash = :token_hash
-                LIMIT 1
-            """),
-            {"token_hash": token_hash}
-        ).fetchone()
-
-        if not row:
-            raise HTTPException(status_code=401, detail="Invalid user token")
-
-        conn.execute(
-            text("UPDATE user_sessions SET last_used = NOW() WHERE token_hash = :token_hash"),
-            {"token_hash": token_hash}
-        )
 
-    return {"id": row[0], "email": row[1], "name": row[2]}
+def _cache_session(token_hash: str, row, generation: int) -> dict:
+    if not row:
+        raise HTTPException(status_code=401, detail="Invalid user token")
+
+    user = {"id": row[0], "email": row[1], "name": row[2]}
+    auth_cache.sessions.put(token_hash, user, generation)
+    return user
 
 
 def require_server_access(
@@ -92,62 +170,130 @@ def require_server_access(
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
     server: str | None = Query(default=None),
     server_name: str | None = Query(default=None),
+    conn: Connection = REQUEST_CONNECTION,
 ) -> str:
     if x_api_key:
         try:
-            return require_api_key(x_api_key)
+            return require_api_key(x_api_key, conn)
         except HTTPException:
             if not authorization and not x_user_token:
                 raise
 
-    user = require_user(authorization=authorization, x_user_token=x_user_token)
+    user = require_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
     selected = (server or server_name or "").strip()
     if not selected:
         raise HTTPException(status_code=400, detail="Missing server")
 
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
-            {"server": selected, "user_id": user["id"]}
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=403, detail="Not authorized for this server")
+    _check_server_owner(conn, selected, user["id"])
+    return selected
+
+
+async def require_server_access_async(
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    authorization: str | None = Header(default=None, alias="Authorization"),
+    x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    server: str | None = Query(default=None),
+    server_name: str | None = Query(default=None),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
+) -> str:
+    """require_server_access for async routes."""
+    if x_api_key:
+        try:
+            return await require_api_key_async(x_api_key, tx)
+        except HTTPException:
+            if not authorization and not x_user_token:
+                raise
 
+    user = await require_user_async(authorization=authorization, x_user_token=x_user_token, tx=tx)
+    selected = (server or server_name or "").strip()
+    if not selected:
+        raise HTTPException(status_code=400, detail="Missing server")
+
+    await tx.run(_check_server_owner, selected, user["id"])
     return selected
 
 
-def validate_and_get_server(device_id: str, player_api_key: str) -> tuple[str, str]:
+def _check_server_owner(conn, server_name: str, user_id: int) -> None:
+    row = conn.execute(
+        text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
+        {"server": server_name, "user_id": user_id}
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=403, detail="Not authorized for this server")
+
+
+def validate_and_get_server(
+    device_id: str,
+    player_api_key: str,
+    conn: Connection | None = None,
+) -> tuple[str, str]:
     """
     Validate user token (opaque token) and return (server_name, minecraft_username).
     Scoped: can only access their own data.
-    Updates last_used timestamp.
+    Records last_used (batched). Successful lookups are served from auth_cache.
+    Cache misses read through conn when given (the request's connection).
     """
     token_hash = hash_token(player_api_key)
+    cached = auth_cache.player_keys.get(token_hash)
+    if cached is not None and cached["device_id"] != device_id:
+        cached = None
+    
+    if cached is None:
+        generation = auth_cache.player_keys.generation()
+        if conn is not None:
+            row = _lookup_player_key(conn, token_hash, device_id)
+        else:
+            with engine.begin() as own_conn:
+                row = _lookup_player_key(own_conn, token_hash, device_id)
+        cached = _cache_player_key(token_hash, device_id, row, generation)
     
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT server_name, minecraft_username FROM player_keys
-                WHERE key = :key_hash 
-                  AND device_id = :device_id
-                  AND active = TRUE
-            """),
-            {
-                "key_hash": token_hash,
-                "device_id": device_id
-            }
-        ).fetchone()
-        
-        if not row:
-            raise HTTPException(
-                status_code=401, 
-                detail="Invalid user token or device mismatch"
-            )
-        
-        # Update last_used timestamp
-        conn.execute(
-            text("UPDATE player_keys SET last_used = NOW() WHERE key = :key_hash"),
-            {"key_hash": token_hash}
+    last_used_tracker.touch("player_keys", token_hash)
+    return cached["server_name"], cached["minecraft_username"]
+
+
+async def validate_and_get_server_async(
+    device_id: str,
+    player_api_key: str,
+    tx: RequestTransaction | None = None,
+) -> tuple[str, str]:
+    """validate_and_get_server for async routes."""
+    token_hash = hash_token(player_api_key)
+    cached = auth_cache.player_keys.get(token_hash)
+    if cached is not None and cached["device_id"] != device_id:
+        cached = None
+
+    if cached is None:
+        generation = auth_cache.player_keys.generation()
+        run = tx.run if tx is not None else run_in_transaction
+        row = await run(_lookup_player_key, token_hash, device_id)
+        cached = _cache_player_key(token_hash, device_id, row, generation)
+
+    last_used_tracker.touch("player_keys", token_hash)
+    return cached["server_name"], cached["minecraft_username"]
+
+
+def _lookup_player_key(conn, token_hash: str, device_id: str):
+    return conn.execute(
+        text("""
+            SELECT server_name, minecraft_username FROM player_keys
+            WHERE key = :key_hash 
+              AND device_id = :device_id
+              AND active = TRUE
+        """),
+        {
+            "key_hash": token_hash,
+            "device_id": device_id
+        }
+    ).fetchone()
+
+
+def _cache_player_key(token_hash: str, device_id: str, row, generation: int) -> dict:
+    if not row:
+        raise HTTPException(
+            status_code=401, 
+            detail="Invalid user token or device mismatch"
         )
     
-    return row[0], row[1]  # server_name, minecraft_username
+    cached = {"device_id": device_id, "server_name": row[0], "minecraft_username": row[1]}
+    auth_cache.player_keys.put(token_hash, cached, generation)
+    return cached
@@ -0,0 +1,205 @@
+"""
+Bounded LRU+TTL cache for authentication lookups, keyed by token hash.
+
+Caches the results of the lookups in auth.py:
+- api_keys:    server key hash -> server_name
+- player_keys: player key hash -> {device_id, server_name, minecraft_username}
+- sessions:    user session hash -> {id, email, name}
+
+Only successful lookups are cached. Anything that revokes, rotates or rebinds a key
+must call one of the invalidate_* helpers once the change has committed (or pass
+the request's connection, which defers the local drop until it commits); they drop
+matching entries locally and, on Postgres, publish a NOTIFY on the auth_cache
+channel so other processes (extra API workers) drop them too. Out-of-process
+writers such as manage_keys.py publish the same payloads. AUTH_CACHE_TTL_SECONDS bounds staleness when a
+notification is missed; 0 disables the cache.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from sqlalchemy.engine import Connection
+
+from database import after_commit
+import notify_listener
+
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+NOTIFY_CHANNEL = "auth_cache"
+
+
+class LruTtlCache:
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float) -> None:
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced with a revoke
+        # does not put the stale value back.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key: str) -> Any | None:
+        if self.ttl_seconds <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: Any, generation: int) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def remove_where(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            self._generation += 1
+            stale = [k for k, (_, v) in self._entries.items() if predicate(v)]
+            for k in stale:
+                del self._entries[k]
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+api_keys = LruTtlCache("api_keys", AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+player_keys = LruTtlCache("player_keys", AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+sessions = LruTtlCache("sessions", AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+
+
+def _same(a: str | None, b: str | None) -> bool:
+    return a is not None and b is not None and a.lower() == b.lower()
+
+
+def _apply(payload: dict[str, Any]) -> None:
+    scope = payload.get("scope")
+    if scope == "token":
+        api_keys.remove(payload["key_hash"])
+        player_keys.remove(payload["key_hash"])
+    elif scope == "server":
+        server_name = payload["server_name"]
+        api_keys.remove_where(lambda v: _same(v, server_name))
+        player_keys.remove_where(lambda v: _same(v["server_name"], server_name))
+    elif scope == "player":
+        def matches(v: dict[str, Any]) -> bool:
+            for field in ("server_name", "minecraft_username", "device_id"):
+                if payload.get(field) is not None and not _same(v[field], payload[field]):
+                    return False
+            return True
+        player_keys.remove_where(matches)
+    else:
+        _clear_all()
+
+
+def _publish(payload: dict[str, Any], conn: Connection | None = None) -> None:
+    """
+    Apply locally and broadcast to other processes. Call after the change has
+    committed, or pass the request's connection to do both when it commits.
+    """
+    if conn is None:
+        _apply(payload)
+    else:
+        after_commit(conn, _apply, payload)
+    if AUTH_CACHE_TTL_SECONDS > 0:
+        notify_listener.publish(NOTIFY_CHANNEL, payload, conn)
+
+
+def invalidate_token(key_hash: str, conn: Connection | None = None) -> None:
+    """Drop a single server or player key by hash."""
+    _publish({"scope": "token", "key_hash": key_hash}, conn)
+
+
+def invalidate_server(server_name: str, conn: Connection | None = None) -> None:
+    """Drop every server and player key cached for a server (pause, delete, key rotation)."""
+    _publish({"scope": "server", "server_name": server_name}, conn)
+
+
+def invalidate_players(
+    server_name: str | None = None,
+    minecraft_username: str | None = None,
+    device_id: str | None = None,
+    conn: Connection | None = None,
+) -> None:
+    """Drop cached player keys matching all given fields (rebind, recover, wipe, prune)."""
+    _publish(
+        {
+            "scope": "player",
+            "server_name": server_name,
+            "minecraft_username": minecraft_username,
+            "device_id": device_id,
+        },
+        conn,
+    )
+
+
+def invalidate_all() -> None:
+    """Drop everything (bulk deletes)."""
+    _publish({"scope": "all"})
+
+
+def _clear_all() -> None:
+    api_keys.clear()
+    player_keys.clear()
+    sessions.clear()
+
+
+if AUTH_CACHE_TTL_SECONDS > 0:
+    # Invalidations from other processes are applied by notify_listener (Postgres only)
+    notify_listener.register(NOTIFY_CHANNEL, _apply, _clear_all)
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "ttl_seconds": AUTH_CACHE_TTL_SECONDS,
+        "max_entries": AUTH_CACHE_MAX_ENTRIES,
+        "api_keys": api_keys.stats(),
+        "player_keys": player_keys.stats(),
+        "sessions": sessions.stats(),
+    }
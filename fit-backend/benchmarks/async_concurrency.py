@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Compare the threadpool and async request models under concurrent ingest load.
+
+Drives N concurrent clients against two in-process apps through httpx's ASGI
+transport, both running the same ingest statement for one player per client:
+a sync handler (the previous model: each request holds one of the AnyIO
+threadpool's tokens and a psycopg2 connection for its whole duration) and an
+async handler using database.run_in_transaction (asyncpg, no thread held). A
+probe hits the sync /health endpoint every 10 ms meanwhile; its latency shows
+whether the rest of the API is starved of threadpool tokens.
+
+latency_ms adds a server-side pg_sleep to every transaction to stand in for the
+network round trip to a remote database. Pool sizes come from the usual
+DB_API_POOL_SIZE / DB_API_MAX_OVERFLOW settings. Creates throwaway players in the
+configured DATABASE_URL and removes them afterwards.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg2://... python benchmarks/async_concurrency.py [requests] [latency_ms] [concurrency ...]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import anyio.to_thread
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import text
+
+import database
+from database import engine, init_db, run_in_transaction
+from ingest_engine import CENTRAL_TZ, run_ingest
+from routes import health
+from utils import generate_opaque_token, hash_token
+
+SERVER = "bench-async-server"
+PROBE_INTERVAL_S = 0.01
+
+
+def _ingest_work(conn, latency_s: float, device_id: str, username: str, key_hash: str, steps: int) -> None:
+    if latency_s:
+        conn.execute(text("SELECT pg_sleep(:s)"), {"s": latency_s})
+    day = datetime.now(CENTRAL_TZ).date()
+    run_ingest(conn, device_id, username, [(key_hash, None, day, steps)], "bench")
+
+
+def _apps(latency_s: float) -> dict[str, FastAPI]:
+    threadpool_app = FastAPI()
+    threadpool_app.include_router(health.router)
+
+    @threadpool_app.post("/ingest/{player}/{steps}")
+    def ingest_threadpool(player: int, steps: int):
+        with engine.begin() as conn:
+            _ingest_work(conn, latency_s, *_player(player), steps)
+        return {"ok": True}
+
+    async_app = FastAPI()
+    async_app.include_router(health.router)
+
+    @async_app.post("/ingest/{player}/{steps}")
+    async def ingest_async(player: int, steps: int):
+        await run_in_transaction(_ingest_work, latency_s, *_player(player), steps)
+        return {"ok": True}
+
+    return {"threadpool": threadpool_app, "async": async_app}
+
+
+def _player(i: int) -> tuple[str, str, str]:
+    return f"bench-async-device-{i}", f"BenchAsync{i}", hash_token(f"bench-async-key-{i}")
+
+
+def _setup(players: int) -> None:
+    _cleanup()
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO api_keys (key, server_name, active) VALUES (:key, :server, TRUE)"),
+            {"key": hash_token(generate_opaque_token()), "server": SERVER},
+        )
+        conn.execute(
+            text("""
+                INSERT INTO player_keys (key, device_id, minecraft_username, server_name, active)
+                SELECT p.key, p.device_id, p.minecraft_username, :server, TRUE
+                FROM unnest(
+                    CAST(:keys AS TEXT[]), CAST(:devices AS TEXT[]), CAST(:usernames AS TEXT[])
+                ) AS p(key, device_id, minecraft_username)
+            """),
+            {
+                "keys": [_player(i)[2] for i in range(players)],
+                "devices": [_player(i)[0] for i in range(players)],
+                "usernames": [_player(i)[1] for i in range(players)],
+                "server": SERVER,
+            },
+        )
+
+
+def _cleanup() -> None:
+    with engine.begin() as conn:
+        for table in ("step_ingest", "player_keys", "api_keys"):
+            conn.execute(text(f"DELETE FROM {table} WHERE server_name = :server"), {"server": SERVER})
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def _run(app: FastAPI, requests: int, concurrency: int, offset: int) -> dict:
+    latencies: list[float] = []
+    probe_latencies: list[float] = []
+    errors = 0
+    pending = iter(range(requests))
+    done = asyncio.Event()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def worker(player: int) -> None:
+            nonlocal errors
+            for n in pending:
+                started = time.perf_counter()
+                response = await client.post(f"/ingest/{player}/{offset + n}")
+                latencies.append((time.perf_counter() - started) * 1000)
+                errors += response.status_code != 200
+
+        async def probe() -> None:
+            while not done.is_set():
+                started = time.perf_counter()
+                await client.get("/health")
+                probe_latencies.append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(PROBE_INTERVAL_S)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await probe_task
+
+    loop_engine = database.async_engine()
+    if loop_engine is not None:
+        await loop_engine.dispose()
+    return {
+        "tokens": int(anyio.to_thread.current_default_thread_limiter().total_tokens),
+        "rps": requests / elapsed,
+        "p50": _percentile(latencies, 50),
+        "p99": _percentile(latencies, 99),
+        "health_p99": _percentile(probe_latencies, 99),
+        "errors": errors,
+    }
+
+
+def main() -> None:
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency_s = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+    levels = [int(v) for v in sys.argv[3:]] or [10, 50, 200]
+    init_db()
+    _setup(max(levels))
+    apps = _apps(latency_s)
+    print(
+        f"async={'asyncpg' if database.ASYNC_ENABLED else 'threadpool fallback'} "
+        f"latency_ms={latency_s * 1000:g} requests={requests}"
+    )
+    try:
+        offset = 0
+        for concurrency in levels:
+            for mode, app in apps.items():
+                result = asyncio.run(_run(app, requests, concurrency, offset))
+                offset += requests
+                print(
+                    f"{mode:<10} concurrency={concurrency:<4} rps={result['rps']:.0f} "
+                    f"p50_ms={result['p50']:.1f} p99_ms={result['p99']:.1f} "
+                    f"health_p99_ms={result['health_p99']:.1f} errors={result['errors']} "
+                    f"threadpool_tokens={result['tokens']}"
+                )
+    finally:
+        _cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Local fake APNs endpoint for offline iOS push benchmarks.
+
+Speaks plaintext HTTP/2 (h2c, prior knowledge) on 127.0.0.1, accepts
+POST /3/device/<token> like api.push.apple.com and answers every stream after a
+fixed latency without blocking the other streams on the connection. Tokens ending
+in "bad" get 410 Unregistered; everything else gets 200. Advertises
+MAX_CONCURRENT_STREAMS like APNs does, so batch sends multiplex realistically.
+
+Point apns_service at it with:
+    APNS_ENDPOINT=127.0.0.1:<port> APNS_ENDPOINT_PLAINTEXT=true APNS_TOPIC=... APNS_CERT_PATH=<any>
+
+Usage:
+    python benchmarks/fake_apns.py [port] [latency_ms]
+"""
+
+import heapq
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import apns_service  # noqa: F401  (collections shims needed by the h2 package on Python 3.10+)
+import h2.connection
+import h2.events
+import h2.settings
+
+MAX_CONCURRENT_STREAMS = 500
+
+
+class FakeApnsServer:
+    def __init__(self, port: int = 0, latency_ms: float = 20.0) -> None:
+        self.latency_s = latency_ms / 1000
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", port))
+        self._sock.listen(64)
+        self.port = self._sock.getsockname()[1]
+        self._stopping = threading.Event()
+
+    def start(self) -> "FakeApnsServer":
+        threading.Thread(target=self._accept_loop, name="fake-apns", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._sock.close()
+
+    def _accept_loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket) -> None:
+        conn = h2.connection.H2Connection(client_side=False)
+        conn.initiate_connection()
+        conn.update_settings({h2.settings.MAX_CONCURRENT_STREAMS: MAX_CONCURRENT_STREAMS})
+        client.sendall(conn.data_to_send())
+        paths: dict[int, str] = {}
+        due: list[tuple[float, int]] = []
+        try:
+            while True:
+                timeout = max(0.0, due[0][0] - time.monotonic()) if due else 1.0
+                readable, _, _ = select.select([client], [], [], timeout)
+                if readable:
+                    data = client.recv(65536)
+                    if not data:
+                        return
+                    for event in conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            paths[event.stream_id] = dict(event.headers).get(":path", "")
+                        elif isinstance(event, h2.events.DataReceived):
+                            conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                        elif isinstance(event, h2.events.StreamEnded):
+                            heapq.heappush(due, (time.monotonic() + self.latency_s, event.stream_id))
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                now = time.monotonic()
+                while due and due[0][0] <= now:
+                    _, stream_id = heapq.heappop(due)
+                    self._respond(conn, stream_id, paths.pop(stream_id, ""))
+                out = conn.data_to_send()
+                if out:
+                    client.sendall(out)
+        except (OSError, h2.exceptions.ProtocolError):
+            return
+        finally:
+            client.close()
+
+    def _respond(self, conn: h2.connection.H2Connection, stream_id: int, path: str) -> None:
+        with self._lock:
+            self.requests += 1
+        if path.endswith("bad"):
+            body = json.dumps({"reason": "Unregistered", "timestamp": int(time.time() * 1000)}).encode()
+            conn.send_headers(stream_id, [(":status", "410"), ("content-length", str(len(body)))])
+            conn.send_data(stream_id, body, end_stream=True)
+        else:
+            conn.send_headers(stream_id, [(":status", "200"), ("apns-id", f"fake-{stream_id}")], end_stream=True)
+
+
+def main() -> None:
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2197
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    server = FakeApnsServer(port, latency_ms).start()
+    print(f"Fake APNs listening on 127.0.0.1:{server.port} (latency={latency_ms}ms)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Count database round trips per /v1/ingest submission.
+
+Compares the previous multi-transaction ingest flow (reproduced below as the
+baseline) with the consolidated statement in ingest_engine, driven through
+ingest_steps_async on one event loop as the route does. Creates a throwaway
+server/player in the configured DATABASE_URL and removes it afterwards.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg2://... python benchmarks/ingest_roundtrips.py [iterations]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, text
+
+import database
+from database import engine, init_db
+from ingest_engine import CENTRAL_TZ, ingest_steps_async
+from utils import generate_opaque_token, hash_token
+
+SERVER = "bench-ingest-server"
+DEVICE = "bench-ingest-device"
+USERNAME = "BenchWalker"
+
+
+class RoundTripCounter:
+    def __init__(self, *engines) -> None:
+        self.statements = 0
+        self.commits = 0
+        for counted in engines:
+            event.listen(counted, "before_cursor_execute", self._on_statement)
+            event.listen(counted, "commit", self._on_commit)
+
+    def _on_statement(self, *args) -> None:
+        self.statements += 1
+
+    def _on_commit(self, *args) -> None:
+        self.commits += 1
+
+    def reset(self) -> None:
+        self.statements = 0
+        self.commits = 0
+
+    @property
+    def round_trips(self) -> int:
+        # psycopg2 sends BEGIN with the first statement; COMMIT is its own trip.
+        return self.statements + self.commits
+
+
+def legacy_ingest(device_id: str, player_api_key: str, username: str, steps: int, day) -> None:
+    """The pre-consolidation flow: four transactions, up to seven statements."""
+    token_hash = hash_token(player_api_key)
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("""
+                SELECT server_name, minecraft_username FROM player_keys
+                WHERE key = :key_hash AND device_id = :device_id AND active = TRUE
+            """),
+            {"key_hash": token_hash, "device_id": device_id},
+        ).fetchone()
+        conn.execute(
+            text("UPDATE player_keys SET last_used = NOW() WHERE key = :key_hash"),
+            {"key_hash": token_hash},
+        )
+    server_name, current_username = row[0], row[1]
+
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                SELECT id, reason FROM bans
+                WHERE server_name = :server_name
+                AND (minecraft_username = :minecraft_username OR device_id = :device_id)
+                LIMIT 1
+            """),
+            {"server_name": server_name, "minecraft_username": username, "device_id": device_id},
+        ).fetchone()
+
+    if current_username != username:
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    UPDATE player_keys SET minecraft_username = :new_username
+                    WHERE device_id = :device_id AND server_name = :server_name
+                """),
+                {"new_username": username, "device_id": device_id, "server_name": server_name},
+            )
+
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                SELECT minecraft_username FROM step_ingest
+                WHERE device_id = :device_id AND day = :day
+                ORDER BY created_at ASC LIMIT 1
+            """),
+            {"device_id": device_id, "day": day},
+        ).fetchone()
+        prev = conn.execute(
+            text("""
+                SELECT day, steps_today FROM step_ingest
+                WHERE minecraft_username = :minecraft_username AND server_name = :server_name AND day = :day
+                ORDER BY created_at DESC LIMIT 1
+            """),
+            {"minecraft_username": username, "server_name": server_name, "day": day},
+        ).fetchone()
+        if prev is None or steps > prev[1]:
+            conn.execute(
+                text("""
+                    INSERT INTO step_ingest (minecraft_username, device_id, day, steps_today, source, server_name)
+                    VALUES (:minecraft_username, :device_id, :day, :steps_today, :source, :server_name)
+                    ON CONFLICT (minecraft_username, server_name, day)
+                    WHERE minecraft_username IS NOT NULL AND server_name IS NOT NULL
+                    DO UPDATE SET steps_today = EXCLUDED.steps_today, device_id = EXCLUDED.device_id,
+                        source = EXCLUDED.source, created_at = NOW()
+                    WHERE EXCLUDED.steps_today > step_ingest.steps_today
+                """),
+                {
+                    "minecraft_username": username,
+                    "device_id": device_id,
+                    "day": day,
+                    "steps_today": steps,
+                    "source": "bench",
+                    "server_name": server_name,
+                },
+            )
+
+
+def _setup() -> str:
+    player_key = generate_opaque_token()
+    _cleanup()
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO api_keys (key, server_name, active) VALUES (:key, :server, TRUE)"),
+            {"key": hash_token(generate_opaque_token()), "server": SERVER},
+        )
+        conn.execute(
+            text("""
+                INSERT INTO player_keys (key, device_id, minecraft_username, server_name, active)
+                VALUES (:key, :device_id, :username, :server, TRUE)
+            """),
+            {"key": hash_token(player_key), "device_id": DEVICE, "username": USERNAME, "server": SERVER},
+        )
+    return player_key
+
+
+def _cleanup() -> None:
+    with engine.begin() as conn:
+        for table in ("step_ingest", "player_keys", "api_keys"):
+            conn.execute(text(f"DELETE FROM {table} WHERE server_name = :server"), {"server": SERVER})
+
+
+def _measure(label: str, counter: RoundTripCounter, fn, iterations: int) -> None:
+    counter.reset()
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{label:<14} statements/ingest={counter.statements / iterations:.2f} "
+        f"commits/ingest={counter.commits / iterations:.2f} "
+        f"round_trips/ingest={counter.round_trips / iterations:.2f} "
+        f"avg_ms={elapsed * 1000 / iterations:.2f}"
+    )
+
+
+async def _loop_engines() -> list:
+    # asyncpg statements run on the event loop's own engine (none without asyncpg)
+    loop_engine = database.async_engine()
+    return [engine] if loop_engine is None else [engine, loop_engine.sync_engine]
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    init_db()
+    player_key = _setup()
+    today = datetime.now(CENTRAL_TZ).date()
+    with asyncio.Runner() as runner:
+        counter = RoundTripCounter(*runner.run(_loop_engines()))
+        try:
+            _measure(
+                "legacy",
+                counter,
+                lambda i: legacy_ingest(DEVICE, player_key, USERNAME, 1000 + i, today - timedelta(days=1)),
+                iterations,
+            )
+            _measure(
+                "consolidated",
+                counter,
+                lambda i: runner.run(ingest_steps_async(DEVICE, player_key, USERNAME, 1000 + i, str(today), "bench")),
+                iterations,
+            )
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    main()
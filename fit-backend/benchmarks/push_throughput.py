@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Measure scheduled-push drain time against local fake providers.
+
+Seeds one due announcement for N device tokens (half iOS, half Android, a few
+unregistered) in the configured DATABASE_URL, then drains it twice: once with the
+previous one-at-a-time loop (reproduced below as the baseline: serial sends, one
+transaction per delivery row, one batch per scheduler interval) and once with
+push_scheduler.run_push_until_drained. iOS goes through the real apns_service
+connection pool against an in-process fake APNs endpoint (benchmarks/fake_apns.py)
+that answers each stream after a fixed latency; Android uses a fake sender that
+sleeps for the same latency per call (one sleep per FCM multicast request).
+Removes its rows afterwards.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg2://... python benchmarks/push_throughput.py [devices] [latency_ms]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The fake APNs endpoint is plaintext, so no certificate is loaded.
+os.environ["APNS_CERT_PATH"] = "/dev/null"
+os.environ["APNS_TOPIC"] = "bench.fake"
+os.environ["APNS_USE_SANDBOX"] = "true"
+os.environ["APNS_ENDPOINT_PLAINTEXT"] = "true"
+
+from sqlalchemy import text
+
+from database import engine, init_db
+from apns_service import APNsException, Unregistered, apns_pool_stats, send_push, send_push_batch
+from fake_apns import FakeApnsServer
+import push_delivery
+import push_scheduler
+
+SERVER = "bench-push-server"
+INVALID_EVERY = 50
+CALLS = {"android": 0}
+
+
+def fake_android(latency_s: float):
+    """Each multicast request costs latency_s."""
+    def android_multicast(tokens, title, body, data):
+        CALLS["android"] += 1
+        time.sleep(latency_s)
+        return [(push_delivery.SENT, None) for _ in tokens]
+
+    return android_multicast
+
+
+def legacy_load_due_messages(limit: int) -> list[dict]:
+    """The previous per-pass anti-join against push_deliveries (before the delivery queue)."""
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT pn.id, pn.server_name, pn.message, pdt.device_id, pdt.platform, pdt.token,
+                       COALESCE(pk.minecraft_username, 'unknown') AS minecraft_username
+                FROM push_notifications pn
+                JOIN push_device_tokens pdt ON pdt.server_name = pn.server_name
+                LEFT JOIN player_keys pk
+                  ON pk.device_id = pdt.device_id AND pk.server_name = pn.server_name AND pk.active = TRUE
+                LEFT JOIN push_deliveries pd
+                  ON pd.notification_id = pn.id AND pd.device_id = pdt.device_id
+                WHERE pn.scheduled_at <= NOW()
+                  AND pn.scheduled_at >= pdt.created_at
+                  AND pd.id IS NULL
+                ORDER BY pn.scheduled_at ASC
+                LIMIT :limit
+            """),
+            {"limit": limit},
+        ).mappings().all()
+    return [
+        {
+            "notification_id": row["id"],
+            "server_name": row["server_name"],
+            "device_id": row["device_id"],
+            "username": row["minecraft_username"],
+            "platform": row["platform"],
+            "token": row["token"],
+            "title": "StepCraft",
+            "body": row["message"],
+            "data": {"server_name": row["server_name"], "notification_id": row["id"]},
+        }
+        for row in rows
+    ]
+
+
+def legacy_drain(android_multicast, batch: int) -> int:
+    """The previous scheduler loop: serial sends and one transaction per delivery."""
+    batches = 0
+    while True:
+        messages = legacy_load_due_messages(batch)
+        if not messages:
+            return batches
+        batches += 1
+        for m in messages:
+            args = (m["title"], m["body"], m["data"])
+            if push_delivery._provider(m) == "android":
+                outcome, _ = android_multicast([m["token"]], *args)[0]
+            else:
+                try:
+                    send_push(m["token"], *args)
+                    outcome = push_delivery.SENT
+                except Unregistered:
+                    outcome = push_delivery.INVALID_TOKEN
+                except APNsException:
+                    outcome = push_delivery.FAILED
+            with engine.begin() as conn:
+                if outcome == push_delivery.SENT:
+                    push_delivery.record_deliveries(conn, [m])
+                elif outcome == push_delivery.INVALID_TOKEN:
+                    push_delivery.remove_tokens(conn, [m])
+
+
+def _seed(devices: int) -> None:
+    _cleanup()
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO push_device_tokens (device_id, server_name, platform, token, sandbox, created_at)
+                SELECT
+                    'bench-dev-' || i,
+                    :server,
+                    CASE WHEN i % 2 = 0 THEN 'ios' ELSE 'android' END,
+                    'tok-' || i || CASE WHEN i % :invalid_every = 0 THEN '-bad' ELSE '' END,
+                    TRUE,
+                    NOW() - INTERVAL '1 day'
+                FROM generate_series(1, :devices) AS i
+            """),
+            {"server": SERVER, "devices": devices, "invalid_every": INVALID_EVERY},
+        )
+        now = datetime.now(timezone.utc)
+        conn.execute(
+            text("""
+                INSERT INTO push_notifications (server_name, message, scheduled_at, scheduled_date)
+                VALUES (:server, 'Benchmark announcement', :at, :day)
+            """),
+            {"server": SERVER, "at": now - timedelta(minutes=1), "day": now.date()},
+        )
+
+
+def _cleanup() -> None:
+    with engine.begin() as conn:
+        # push_delivery_queue rows go with their notifications
+        for table in ("push_deliveries", "push_device_tokens", "push_notifications"):
+            conn.execute(text(f"DELETE FROM {table} WHERE server_name = :server"), {"server": SERVER})
+
+
+def _delivered() -> int:
+    with engine.begin() as conn:
+        return conn.execute(
+            text("SELECT COUNT(*) FROM push_deliveries WHERE server_name = :server"),
+            {"server": SERVER},
+        ).scalar()
+
+
+def main() -> None:
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency_s = (float(sys.argv[2]) if len(sys.argv) > 2 else 20.0) / 1000
+    batch = int(os.getenv("PUSH_SCHEDULER_BATCH", "200"))
+    interval = int(os.getenv("PUSH_SCHEDULER_INTERVAL_SECONDS", "30"))
+    init_db()
+    fake_apns = FakeApnsServer(latency_ms=latency_s * 1000).start()
+    os.environ["APNS_ENDPOINT"] = f"127.0.0.1:{fake_apns.port}"
+    android = fake_android(latency_s)
+    try:
+        _seed(devices)
+        CALLS.update(android=0)
+        ios_requests = fake_apns.requests
+        started = time.perf_counter()
+        batches = legacy_drain(android, batch)
+        elapsed = time.perf_counter() - started
+        print(
+            f"{'legacy':<10} delivered={_delivered()} elapsed_s={elapsed:.2f} "
+            f"msgs_per_s={devices / elapsed:.0f} scheduler_cycles={batches} "
+            f"apns_requests={fake_apns.requests - ios_requests} fcm_calls={CALLS['android']} "
+            f"(~{(batches - 1) * interval}s of interval sleeps not included)"
+        )
+
+        _seed(devices)
+        CALLS.update(android=0)
+        ios_requests = fake_apns.requests
+        started = time.perf_counter()
+        push_scheduler.run_push_until_drained({"ios": send_push_batch, "android": android})
+        elapsed = time.perf_counter() - started
+        print(
+            f"{'engine':<10} delivered={_delivered()} elapsed_s={elapsed:.2f} "
+            f"msgs_per_s={devices / elapsed:.0f} scheduler_cycles=1 "
+            f"apns_requests={fake_apns.requests - ios_requests} fcm_calls={CALLS['android']} "
+            f"(apns={push_delivery.APNS_CONCURRENCY} fcm={push_delivery.FCM_CONCURRENCY} workers, "
+            f"apns_connections={apns_pool_stats()['connects']})"
+        )
+    finally:
+        _cleanup()
+        fake_apns.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""
+Cascade deletes for players and servers.
+
+Every wipe goes through here so the list of dependent tables lives in one place:
+player_keys, step_ingest, step_claims, bans, push_deliveries, push_device_tokens
+(by the player's devices), key_recovery_audit and the player's audit_logs entries
+(those whose details name the player). Usernames match case-insensitively, the
+way Minecraft treats them; the exact spellings on record are resolved first so
+the deletes themselves use indexes.
+
+Rows are deleted in chunks of CASCADE_DELETE_CHUNK_ROWS, one short transaction
+per chunk on the jobs connection pool, starting with player_keys so wiped players stop authenticating right
+away. Wipes of whole tables use TRUNCATE. Wipes that can be large (every player
+on a server, a whole server) run as background jobs in this process; progress
+is kept in deletion_jobs (GET /v1/admin/deletion-jobs/{job_id}). Several API
+processes may run jobs: each records itself as the job's worker_id and a
+heartbeat thread refreshes heartbeat_at on its open jobs every
+DELETION_JOB_HEARTBEAT_SECONDS. Open jobs whose heartbeat is older than
+DELETION_JOB_STALE_SECONDS died with their process and are marked failed by
+whichever process notices first.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import after_commit, engine, jobs_engine
+import auth_cache
+import server_config
+
+logger = logging.getLogger("cascade_delete")
+
+CHUNK_ROWS = max(1, int(os.getenv("CASCADE_DELETE_CHUNK_ROWS", "5000")))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+# Unique per process start, so a restarted process never adopts its predecessor's jobs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+HEARTBEAT_SECONDS = max(1, int(os.getenv("DELETION_JOB_HEARTBEAT_SECONDS", "30")))
+# Must cover several missed heartbeats, or a slow owner would see its jobs failed
+JOB_STALE_SECONDS = max(3 * HEARTBEAT_SECONDS, int(os.getenv("DELETION_JOB_STALE_SECONDS", "120")))
+
+# Tables holding per-player rows keyed by (server_name, minecraft_username), in
+# delete order after player_keys
+PLAYER_TABLES = ("step_ingest", "step_claims", "push_deliveries", "bans", "key_recovery_audit")
+# Player data cleared by truncate_player_data (bans are kept for enforcement);
+# queued pushes go with the device tokens they target
+TRUNCATE_TABLES = (
+    "player_keys",
+    "step_ingest",
+    "step_claims",
+    "push_deliveries",
+    "push_delivery_queue",
+    "push_device_tokens",
+    "key_recovery_audit",
+)
+
+_PLAYERS = """
+    (server_name, minecraft_username) IN (
+        SELECT * FROM unnest(CAST(:servers AS TEXT[]), CAST(:usernames AS TEXT[]))
+    )
+"""
+_DEVICES = """
+    (server_name, device_id) IN (
+        SELECT * FROM unnest(CAST(:device_servers AS TEXT[]), CAST(:device_ids AS TEXT[]))
+    )
+"""
+# audit_logs entries about a player (bans, wipes) carry its name in details_json;
+# the LIKE skips parsing the JSON of every other entry
+_AUDIT_PLAYERS = """
+    details_json LIKE '%"minecraft_username"%'
+    AND (server_name, CAST(details_json AS JSONB) ->> 'minecraft_username') IN (
+        SELECT * FROM unnest(CAST(:servers AS TEXT[]), CAST(:usernames AS TEXT[]))
+    )
+"""
+_AUDIT_ANY_PLAYER = """
+    details_json LIKE '%"minecraft_username"%'
+    AND CAST(details_json AS JSONB) ->> 'minecraft_username' IS NOT NULL
+"""
+
+Progress = Callable[[dict[str, int]], None]
+
+
+def _delete_chunked(table: str, where: str, params: dict[str, Any], counts: dict[str, int], progress: Progress | None) -> None:
+    counts.setdefault(table, 0)
+    while True:
+        with jobs_engine.begin() as conn:
+            deleted = conn.execute(
+                text(f"""
+                    DELETE FROM {table}
+                    WHERE id IN (
+                        SELECT id FROM {table}
+                        WHERE {where}
+                        LIMIT :chunk
+                    )
+                """),
+                {**params, "chunk": CHUNK_ROWS},
+            ).rowcount
+        counts[table] += deleted
+        if progress is not None and deleted:
+            progress(counts)
+        if deleted < CHUNK_ROWS:
+            return
+
+
+def resolve_players(minecraft_username: str, server_name: str | None = None) -> list[tuple[str, str]]:
+    """(server_name, exact username) pairs on record for a username, any case."""
+    with jobs_engine.begin() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT DISTINCT server_name, minecraft_username FROM (
+                    SELECT server_name, minecraft_username FROM player_keys
+                    UNION ALL SELECT server_name, minecraft_username FROM step_ingest
+                    UNION ALL SELECT server_name, minecraft_username FROM step_claims
+                    UNION ALL SELECT server_name, minecraft_username FROM bans
+                ) AS records
+                WHERE LOWER(minecraft_username) = LOWER(:username)
+                  AND (CAST(:server AS TEXT) IS NULL OR server_name = :server)
+                  AND server_name IS NOT NULL
+            """),
+            {"username": minecraft_username, "server": server_name},
+        ).all()
+    return [(row[0], row[1]) for row in rows]
+
+
+def delete_player_rows(conn, server_name: str, usernames: list[str], device_ids: list[str]) -> dict[str, int]:
+    """
+    Delete the dependent rows of players whose player_keys rows the caller has
+    already removed, inside the caller's transaction (inactive prune chunks).
+    Returns rows deleted per table.
+    """
+    params = {
+        "servers": [server_name] * len(usernames),
+        "usernames": usernames,
+        "device_servers": [server_name] * len(device_ids),
+        "device_ids": device_ids,
+    }
+    counts = {}
+    for table in PLAYER_TABLES:
+        counts[table] = conn.execute(text(f"DELETE FROM {table} WHERE {_PLAYERS}"), params).rowcount
+    counts["push_device_tokens"] = conn.execute(
+        text(f"DELETE FROM push_device_tokens WHERE {_DEVICES}"), params
+    ).rowcount
+    counts["audit_logs"] = conn.execute(text(f"DELETE FROM audit_logs WHERE {_AUDIT_PLAYERS}"), params).rowcount
+    return counts
+
+
+def wipe_players(players: list[tuple[str, str]], progress: Progress | None = None) -> dict[str, int]:
+    """Delete everything stored for (server_name, username) pairs, in chunks."""
+    counts: dict[str, int] = {"player_keys": 0}
+    if not players:
+        return counts
+    params = {"servers": [p[0] for p in players], "usernames": [p[1] for p in players]}
+
+    with jobs_engine.begin() as conn:
+        devices = conn.execute(
+            text(f"SELECT DISTINCT server_name, device_id FROM player_keys WHERE {_PLAYERS}"),
+            params,
+        ).all()
+    params["device_servers"] = [d[0] for d in devices]
+    params["device_ids"] = [d[1] for d in devices]
+
+    _delete_chunked("player_keys", _PLAYERS, params, counts, progress)
+    for server_name, username in players:
+        auth_cache.invalidate_players(server_name=server_name, minecraft_username=username)
+    for table in PLAYER_TABLES:
+        _delete_chunked(table, _PLAYERS, params, counts, progress)
+    _delete_chunked("push_device_tokens", _DEVICES, params, counts, progress)
+    _delete_chunked("audit_logs", _AUDIT_PLAYERS, params, counts, progress)
+    return counts
+
+
+def wipe_server_players(server_name: str, progress: Progress | None = None) -> dict[str, int]:
+    """Delete every player's data on one server, in chunks."""
+    counts: dict[str, int] = {"player_keys": 0}
+    params = {"server": server_name}
+    _delete_chunked("player_keys", "server_name = :server", params, counts, progress)
+    auth_cache.invalidate_players(server_name=server_name)
+    for table in (*PLAYER_TABLES, "push_device_tokens"):
+        _delete_chunked(table, "server_name = :server", params, counts, progress)
+    _delete_chunked("audit_logs", f"server_name = :server AND {_AUDIT_ANY_PLAYER}", params, counts, progress)
+    return counts
+
+
+def delete_server_data(server_name: str, progress: Progress | None = None) -> dict[str, int]:
+    """
+    Delete a server's players and push history, rewards and keys, in chunks. The
+    caller removes the servers row. Audit logs are kept.
+    """
+    counts: dict[str, int] = {}
+    params = {"server": server_name}
+    # Revoke the server key first so nothing writes while the rest is deleted
+    _delete_chunked("api_keys", "server_name = :server", params, counts, progress)
+    auth_cache.invalidate_server(server_name)
+    server_config.invalidate(server_name)
+    _delete_chunked("player_keys", "server_name = :server", params, counts, progress)
+    auth_cache.invalidate_players(server_name=server_name)
+    # push_delivery_queue rows go with their notifications
+    for table in (*PLAYER_TABLES, "push_device_tokens", "push_notifications", "server_rewards"):
+        _delete_chunked(table, "server_name = :server", params, counts, progress)
+    return counts
+
+
+def truncate_player_data(include_server_keys: bool = False) -> dict[str, int]:
+    """
+    Empty every player table (and api_keys when include_server_keys) with TRUNCATE,
+    then remove audit_logs entries about players. Returns the rows removed per table.
+    """
+    tables = TRUNCATE_TABLES + (("api_keys",) if include_server_keys else ())
+    counts: dict[str, int] = {}
+    with jobs_engine.begin() as conn:
+        # Counted under the same lock the TRUNCATE takes, so the counts are exact
+        conn.execute(text(f"LOCK TABLE {', '.join(tables)} IN ACCESS EXCLUSIVE MODE"))
+        for table in tables:
+            counts[table] = conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar_one()
+        conn.execute(text(f"TRUNCATE {', '.join(tables)}"))
+    auth_cache.invalidate_all()
+    if include_server_keys:
+        server_config.invalidate_all()
+    _delete_chunked("audit_logs", _AUDIT_ANY_PLAYER, {}, counts, None)
+    return counts
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cascade-delete")
+
+
+def _update_job(job_id: int, assignments: str, params: dict[str, Any]) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(f"UPDATE deletion_jobs SET {assignments} WHERE id = :id"), {**params, "id": job_id})
+
+
+def _run_job(job_id: int, work: Callable[[Progress], dict[str, int]]) -> None:
+    started = time.perf_counter()
+    _update_job(job_id, "status = :status, started_at = NOW()", {"status": JOB_RUNNING})
+
+    def progress(counts: dict[str, int]) -> None:
+        _update_job(job_id, "progress_json = :progress", {"progress": json.dumps(counts)})
+
+    try:
+        counts = work(progress)
+    except Exception as e:
+        logger.exception("Deletion job %s failed", job_id)
+        _update_job(
+            job_id,
+            "status = :status, error = :error, finished_at = NOW()",
+            {"status": JOB_FAILED, "error": str(e)},
+        )
+        return
+    _update_job(
+        job_id,
+        "status = :status, progress_json = :progress, finished_at = NOW()",
+        {"status": JOB_COMPLETED, "progress": json.dumps(counts)},
+    )
+    logger.info("Deletion job %s completed in %.1fs: %s", job_id, time.perf_counter() - started, counts)
+
+
+def start_job(
+    kind: str,
+    work: Callable[[Progress], dict[str, int]],
+    server_name: str | None = None,
+    created_by: int | None = None,
+    conn: Connection | None = None,
+) -> int:
+    """
+    Record a deletion job and run work(progress) in the background. Returns the job id.
+    With conn the job row joins conn's transaction and work starts once that commits.
+    """
+    if conn is None:
+        with engine.begin() as own_conn:
+            job_id = _insert_job(own_conn, kind, server_name, created_by)
+        _executor.submit(_run_job, job_id, work)
+        return job_id
+    job_id = _insert_job(conn, kind, server_name, created_by)
+    after_commit(conn, _executor.submit, _run_job, job_id, work)
+    return job_id
+
+
+def _insert_job(conn: Connection, kind: str, server_name: str | None, created_by: int | None) -> int:
+    return conn.execute(
+        text("""
+            INSERT INTO deletion_jobs (kind, server_name, status, created_by, worker_id, heartbeat_at)
+            VALUES (:kind, :server, :status, :created_by, :worker, NOW())
+            RETURNING id
+        """),
+        {"kind": kind, "server": server_name, "status": JOB_QUEUED, "created_by": created_by, "worker": WORKER_ID},
+    ).scalar_one()
+
+
+def get_job(job_id: int) -> dict[str, Any] | None:
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("""
+                SELECT id, kind, server_name, status, progress_json, error, created_by,
+                       created_at, started_at, finished_at
+                FROM deletion_jobs
+                WHERE id = :id
+            """),
+            {"id": job_id},
+        ).mappings().first()
+    if row is None:
+        return None
+    job = dict(row)
+    progress = json.loads(job.pop("progress_json") or "{}")
+    for field in ("created_at", "started_at", "finished_at"):
+        if job[field] is not None:
+            job[field] = job[field].isoformat()
+    return {**job, "deleted": progress, "rows_deleted": sum(progress.values())}
+
+
+def fail_abandoned_jobs() -> int:
+    """Mark open jobs whose owning process stopped heartbeating as failed. Returns how many."""
+    with engine.begin() as conn:
+        return conn.execute(
+            text("""
+                UPDATE deletion_jobs
+                SET status = :failed, error = 'Interrupted: the process running it stopped', finished_at = NOW()
+                WHERE status IN (:queued, :running)
+                  AND worker_id IS DISTINCT FROM :worker
+                  -- Jobs from before heartbeats have none
+                  AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - make_interval(secs => :stale))
+            """),
+            {
+                "failed": JOB_FAILED,
+                "queued": JOB_QUEUED,
+                "running": JOB_RUNNING,
+                "worker": WORKER_ID,
+                "stale": JOB_STALE_SECONDS,
+            },
+        ).rowcount
+
+
+def heartbeat() -> None:
+    """Refresh this process's open jobs, then fail those of processes that are gone."""
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE deletion_jobs SET heartbeat_at = NOW()
+                WHERE worker_id = :worker AND status IN (:queued, :running)
+            """),
+            {"worker": WORKER_ID, "queued": JOB_QUEUED, "running": JOB_RUNNING},
+        )
+    failed = fail_abandoned_jobs()
+    if failed:
+        logger.warning("Marked %s deletion jobs failed: the process running them stopped", failed)
+
+
+_heartbeat_stopping = threading.Event()
+_heartbeat_thread: threading.Thread | None = None
+
+
+def _heartbeat_loop() -> None:
+    while True:
+        try:
+            heartbeat()
+        except Exception:
+            logger.exception("Deletion job heartbeat failed")
+        if _heartbeat_stopping.wait(HEARTBEAT_SECONDS):
+            return
+
+
+def start() -> None:
+    """Start the heartbeat thread (API startup); its first beat fails abandoned jobs."""
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        return
+    _heartbeat_stopping.clear()
+    _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="deletion-job-heartbeat", daemon=True)
+    _heartbeat_thread.start()
+
+
+def stop() -> None:
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        _heartbeat_stopping.set()
+        _heartbeat_thread.join(timeout=10)
+        _heartbeat_thread = None
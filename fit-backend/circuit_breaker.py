@@ -0,0 +1,112 @@
+"""
+Per-provider circuit breaker for push sends (one instance each in apns_service
+and fcm_service).
+
+Closed, it lets every send through and counts consecutive transport failures
+(connection errors, provider unavailable). After PUSH_CIRCUIT_FAILURE_THRESHOLD
+of them it opens: allow() refuses sends for the cooldown, so callers can defer
+their tokens instead of waiting on timeouts. Once the cooldown has passed it is
+half-open and lets exactly one probe send through: success closes it, failure
+reopens it with the cooldown doubled, up to PUSH_CIRCUIT_MAX_COOLDOWN_SECONDS.
+State is per process; stats() is reported by GET /v1/admin/metrics.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any
+
+logger = logging.getLogger("circuit_breaker")
+
+FAILURE_THRESHOLD = max(1, int(os.getenv("PUSH_CIRCUIT_FAILURE_THRESHOLD", "5")))
+COOLDOWN_SECONDS = float(os.getenv("PUSH_CIRCUIT_COOLDOWN_SECONDS", "30"))
+MAX_COOLDOWN_SECONDS = float(os.getenv("PUSH_CIRCUIT_MAX_COOLDOWN_SECONDS", "600"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        cooldown_seconds: float = COOLDOWN_SECONDS,
+        max_cooldown_seconds: float = MAX_COOLDOWN_SECONDS,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max(cooldown_seconds, max_cooldown_seconds)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._cooldown = cooldown_seconds
+        self._open_until = 0.0
+        self._probing = False
+        self.opened = 0
+        self.short_circuited = 0
+
+    def allow(self) -> bool:
+        """Whether a send may go out now. A True in half-open state is the probe."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() >= self._open_until:
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("%s circuit closed", self.name)
+            self._state = CLOSED
+            self._failures = 0
+            self._cooldown = self.base_cooldown_seconds
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                # Failed probe: back off further before the next one
+                self._cooldown = min(self.max_cooldown_seconds, self._cooldown * 2)
+            elif self._state == OPEN or self._failures < self.failure_threshold:
+                return
+            self._state = OPEN
+            self._probing = False
+            self._open_until = time.monotonic() + self._cooldown
+            self.opened += 1
+            logger.warning(
+                "%s circuit open after %s consecutive failures; next probe in %ss",
+                self.name,
+                self._failures,
+                self._cooldown,
+            )
+
+    def retry_after(self) -> float:
+        """Seconds until a deferred send is worth retrying (0 when closed)."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "cooldown_seconds": self._cooldown,
+                "retry_after_seconds": round(max(0.0, self._open_until - time.monotonic()), 1)
+                if self._state == OPEN
+                else 0.0,
+                "opened": self.opened,
+                "short_circuited": self.short_circuited,
+            }
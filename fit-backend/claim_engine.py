@@ -0,0 +1,295 @@
+"""
+Set-based claim availability shared by the player and server claim routes.
+
+The whole claim window is read with one indexed range query on step_ingest and one
+on step_claims (any number of players at once), and the eligible tiers for a day
+are found by bisecting the tier thresholds, so the cost no longer grows with
+two queries per day in the window.
+"""
+
+from bisect import bisect_right
+from datetime import date, datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import text
+from zoneinfo import ZoneInfo
+
+import server_config
+
+CENTRAL_TZ = ZoneInfo("America/Chicago")
+
+
+def claim_window_days(buffer_days: int) -> list[date]:
+    """Days in the claim window, most recent first (today plus buffer_days back)."""
+    today = datetime.now(CENTRAL_TZ).date()
+    return [today - timedelta(days=offset) for offset in range(buffer_days + 1)]
+
+
+def load_tiers(
+    server_name: str,
+    default_rewards: list[dict],
+    config: dict[str, Any] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Reward tiers for a server ordered by min_steps, falling back to the defaults.
+    Pass the server_config entry when the caller already has it (async routes).
+    """
+    tiers = config["tiers"] if config is not None else server_config.tiers(server_name)
+    if tiers:
+        return tiers
+    return [{"min_steps": r["min_steps"], "label": r["label"], "item_id": r.get("item_id")} for r in default_rewards]
+
+
+def fetch_window(
+    conn,
+    server_name: str,
+    usernames: list[str],
+    days: list[date],
+) -> tuple[dict[tuple[str, date], int], dict[tuple[str, date], dict[int, tuple[bool, Any]]]]:
+    """
+    Load steps and claims for every (username, day) in the window.
+    Returns ({(username, day): steps}, {(username, day): {min_steps: (claimed, claimed_at)}}).
+    """
+    if not usernames or not days:
+        return {}, {}
+    params = {
+        "server": server_name,
+        "usernames": list(usernames),
+        "start": min(days),
+        "end": max(days),
+    }
+    steps_rows = conn.execute(
+        text("""
+            SELECT minecraft_username, day, MAX(steps_today) AS steps_today
+            FROM step_ingest
+            WHERE server_name = :server
+              AND minecraft_username = ANY(:usernames)
+              AND day BETWEEN :start AND :end
+            GROUP BY minecraft_username, day
+        """),
+        params,
+    ).fetchall()
+    claim_rows = conn.execute(
+        text("""
+            SELECT minecraft_username, day, min_steps, claimed, claimed_at
+            FROM step_claims
+            WHERE server_name = :server
+              AND minecraft_username = ANY(:usernames)
+              AND day BETWEEN :start AND :end
+        """),
+        params,
+    ).fetchall()
+
+    steps = {(row[0], row[1]): int(row[2]) for row in steps_rows}
+    claims: dict[tuple[str, date], dict[int, tuple[bool, Any]]] = {}
+    for row in claim_rows:
+        claims.setdefault((row[0], row[1]), {})[row[2]] = (bool(row[3]), row[4])
+    return steps, claims
+
+
+def resolve_usernames(conn, server_name: str, usernames: list[str]) -> dict[str, str]:
+    """
+    Map each requested name to its stored spelling (case-insensitive, most recent day
+    wins) in one query. Names with no step_ingest rows map to themselves.
+    """
+    rows = conn.execute(
+        text("""
+            SELECT DISTINCT ON (LOWER(minecraft_username)) LOWER(minecraft_username), minecraft_username
+            FROM step_ingest
+            WHERE server_name = :server
+              AND LOWER(minecraft_username) = ANY(:lowered)
+            ORDER BY LOWER(minecraft_username), day DESC
+        """),
+        {"server": server_name, "lowered": list({u.lower() for u in usernames})},
+    ).fetchall()
+    stored = {row[0]: row[1] for row in rows}
+    return {u: stored.get(u.lower(), u) for u in usernames}
+
+
+def eligible_tiers(tiers: list[dict], thresholds: list[int], steps: int) -> list[dict]:
+    """Tiers (sorted by min_steps) whose threshold is met by steps."""
+    return tiers[:bisect_right(thresholds, steps)]
+
+
+def claim_items(
+    conn,
+    server_name: str,
+    usernames: list[str],
+    tiers: list[dict],
+    days: list[date],
+    include_claimed: bool = False,
+    debug_info: dict | None = None,
+) -> dict[str, list[dict[str, Any]]]:
+    """
+    Claim items per username: one entry per eligible tier per day in the window.
+    Without include_claimed, tiers already claimed are skipped (claim-available);
+    with it, every eligible tier is returned with claimed/claimed_at (claim-status-list).
+    debug_info (single player) receives steps_by_day and claimed_by_day.
+    """
+    tiers = sorted(tiers, key=lambda t: t["min_steps"])
+    thresholds = [t["min_steps"] for t in tiers]
+    steps_by_key, claims_by_key = fetch_window(conn, server_name, usernames, days)
+
+    result: dict[str, list[dict[str, Any]]] = {}
+    for username in usernames:
+        items = []
+        for day in days:
+            day_str = str(day)
+            steps = steps_by_key.get((username, day))
+            if debug_info is not None:
+                debug_info["steps_by_day"][day_str] = steps
+            if steps is None:
+                continue
+
+            eligible = eligible_tiers(tiers, thresholds, steps)
+            if not eligible:
+                continue
+
+            claimed_map = claims_by_key.get((username, day), {})
+            if debug_info is not None:
+                debug_info["claimed_by_day"][day_str] = sorted(m for m, (c, _) in claimed_map.items() if c)
+
+            for tier in eligible:
+                claimed, claimed_at = claimed_map.get(tier["min_steps"], (False, None))
+                item = {
+                    "day": day_str,
+                    "min_steps": tier["min_steps"],
+                    "label": tier["label"],
+                    "item_id": tier.get("item_id"),
+                }
+                if include_claimed:
+                    item["claimed"] = claimed
+                    item["claimed_at"] = claimed_at
+                elif claimed:
+                    continue
+                items.append(item)
+        result[username] = items
+    return result
+
+
+# Claims every requested (day, min_steps) in one statement. Rows that were already
+# claimed are left untouched; the outer SELECT reports them with their original
+# claimed_at (it sees the table as it was before the INSERT).
+_CLAIM_SQL = text("""
+    WITH req AS (
+        SELECT *
+        FROM unnest(
+            CAST(:days AS DATE[]),
+            CAST(:min_steps AS BIGINT[])
+        ) AS r(day, min_steps)
+    ),
+    ins AS (
+        INSERT INTO step_claims (minecraft_username, server_name, day, min_steps, claimed, claimed_at)
+        SELECT CAST(:username AS TEXT), CAST(:server AS TEXT), day, min_steps, TRUE, :claimed_at
+        FROM req
+        ON CONFLICT (minecraft_username, server_name, day, min_steps)
+        DO UPDATE SET claimed = TRUE, claimed_at = EXCLUDED.claimed_at
+        WHERE step_claims.claimed = FALSE
+        RETURNING day, min_steps, claimed_at
+    )
+    SELECT
+        r.day,
+        r.min_steps,
+        ins.day IS NOT NULL AS newly_claimed,
+        COALESCE(ins.claimed_at, sc.claimed_at) AS claimed_at
+    FROM req r
+    LEFT JOIN ins ON ins.day = r.day AND ins.min_steps = r.min_steps
+    LEFT JOIN step_claims sc
+      ON sc.minecraft_username = :username
+     AND sc.server_name = :server
+     AND sc.day = r.day
+     AND sc.min_steps = r.min_steps
+""")
+
+
+def record_player_activity(conn, server_name: str, username: str, at: datetime) -> None:
+    """Bump last_activity_at on the player's active keys (claiming counts as activity)."""
+    conn.execute(
+        text("""
+            UPDATE player_keys
+            SET last_activity_at = :at
+            WHERE server_name = :server
+              AND minecraft_username = :username
+              AND active = TRUE
+              AND (last_activity_at IS NULL OR last_activity_at < :at)
+        """),
+        {"server": server_name, "username": username, "at": at},
+    )
+
+
+def claim_rewards(
+    conn,
+    server_name: str,
+    username: str,
+    claims: list[tuple[str | None, int]],
+    buffer_days: int,
+) -> list[dict[str, Any]]:
+    """
+    Validate and claim several (day, min_steps) tiers for one player.
+    Every item is checked against the claim window and the player's steps for that
+    day (one range query), then all valid items are claimed in one statement.
+    Returns one result per requested item, in request order.
+    """
+    window = claim_window_days(buffer_days)
+    today, earliest = window[0], window[-1]
+    results: list[dict[str, Any]] = []
+    parsed: list[date | None] = []
+    for day, min_steps in claims:
+        target_day = None
+        error = None
+        if day:
+            try:
+                target_day = datetime.fromisoformat(day).date()
+            except Exception:
+                error = "Invalid day format (YYYY-MM-DD)"
+        else:
+            target_day = today
+        if target_day is not None and target_day > today:
+            error = "Cannot claim future days"
+        elif target_day is not None and target_day < earliest:
+            error = "Day is outside claim window"
+        parsed.append(None if error else target_day)
+        results.append({
+            "day": str(target_day) if target_day else day,
+            "min_steps": min_steps,
+            "claimed": False,
+            **({"error": error} if error else {}),
+        })
+
+    valid_days = [d for d in parsed if d is not None]
+    steps_by_key, _ = fetch_window(conn, server_name, [username], valid_days) if valid_days else ({}, {})
+
+    pending: dict[tuple[date, int], list[int]] = {}
+    for idx, target_day in enumerate(parsed):
+        if target_day is None:
+            continue
+        min_steps = claims[idx][1]
+        steps = steps_by_key.get((username, target_day))
+        if steps is None or steps < min_steps:
+            results[idx]["error"] = "Not enough steps for this tier"
+            results[idx]["steps"] = steps
+            continue
+        pending.setdefault((target_day, min_steps), []).append(idx)
+
+    if not pending:
+        return results
+
+    claimed_at = datetime.now(timezone.utc)
+    rows = conn.execute(
+        _CLAIM_SQL,
+        {
+            "days": [slot[0] for slot in pending],
+            "min_steps": [slot[1] for slot in pending],
+            "username": username,
+            "server": server_name,
+            "claimed_at": claimed_at,
+        },
+    ).fetchall()
+    if any(row[2] for row in rows):
+        record_player_activity(conn, server_name, username, claimed_at)
+    for row in rows:
+        for idx in pending[(row[0], int(row[1]))]:
+            results[idx]["claimed"] = True
+            results[idx]["already_claimed"] = not row[2]
+            results[idx]["claimed_at"] = row[3]
+    return results
@@ -1,415 +1,1014 @@
+import asyncio
 import os
 import logging
+import threading
+import time
+import weakref
+from contextlib import AsyncExitStack
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
+from typing import Any, AsyncIterator, Callable, Iterator, TypeVar
+from fastapi import Depends
+from fastapi.concurrency import contextmanager_in_threadpool, run_in_threadpool
+from sqlalchemy import create_engine, event, exc, inspect, text
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+try:
+    import asyncpg  # noqa: F401  (optional: async routes use the threadpool without it)
+    from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+except ImportError:
+    create_async_engine = None
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///fitcollector.db")
+# Session-level features (LISTEN, the migration lock) need a real Postgres session;
+# point this at the database itself when DATABASE_URL goes through PgBouncer
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL", DATABASE_URL)
 IS_SQLITE = DATABASE_URL.startswith("sqlite")
-engine = create_engine(DATABASE_URL, future=True)
-
-
-"""Database schema definitions and initialization."""
-
-def init_db() -> None:
-    """Initialize database schema with all migrations."""
+# "transaction" when DATABASE_URL is a PgBouncer pool in transaction mode: no
+# startup options, and the statement timeout is set per transaction instead
+PGBOUNCER_MODE = os.getenv("DB_PGBOUNCER_MODE", "").strip().lower()
+# Role of this process's default engine: "api" for uvicorn, "jobs" for the
+# scheduler and prune processes (set in supervisord.conf)
+DB_ROLE = os.getenv("DB_ROLE", "api")
+
+# Per-role pool settings, overridable with DB_<ROLE>_<SETTING> or DB_<SETTING>.
+# Request handlers get a short statement timeout; jobs may run long statements
+# but only hold a few connections, so they cannot starve the API pool.
+_ROLE_DEFAULTS = {
+    "api": {"POOL_SIZE": 10, "MAX_OVERFLOW": 10, "POOL_TIMEOUT": 10, "STATEMENT_TIMEOUT_MS": 15000},
+    "jobs": {"POOL_SIZE": 3, "MAX_OVERFLOW": 2, "POOL_TIMEOUT": 60, "STATEMENT_TIMEOUT_MS": 600000},
+    # Migrations and the LISTEN connection; no timeout
+    "direct": {"POOL_SIZE": 1, "MAX_OVERFLOW": 2, "POOL_TIMEOUT": 60, "STATEMENT_TIMEOUT_MS": 0},
+}
+POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+_engines: dict[str, Engine] = {}
+_pool_counters: dict[str, dict[str, float]] = {}
+_pool_lock = threading.Lock()
+
+
+def _setting(role: str, name: str) -> int:
+    default = _ROLE_DEFAULTS.get(role, _ROLE_DEFAULTS["jobs"])[name]
+    return int(os.getenv(f"DB_{role.upper()}_{name}", os.getenv(f"DB_{name}", str(default))))
+
+
+def _metered_pool(name: str, base: type[QueuePool] = QueuePool) -> type[QueuePool]:
+    counters = _pool_counters.setdefault(
+        name, {"checkouts": 0, "waited": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "timeouts": 0}
+    )
+
+    class MeteredQueuePool(base):
+        """QueuePool that records how long each checkout waited for a connection."""
+
+        def _do_get(self):
+            started = time.perf_counter()
+            timed_out = False
+            try:
+                return super()._do_get()
+            except exc.TimeoutError:
+                timed_out = True
+                raise
+            finally:
+                waited_ms = (time.perf_counter() - started) * 1000
+                with _pool_lock:
+                    counters["checkouts"] += 1
+                    counters["timeouts"] += timed_out
+                    # Anything over a millisecond waited on the pool or a new connection
+                    if waited_ms >= 1:
+                        counters["waited"] += 1
+                        counters["wait_ms_total"] += waited_ms
+                        counters["wait_ms_max"] = max(counters["wait_ms_max"], waited_ms)
+
+    return MeteredQueuePool
+
+
+def _pool_args(role: str, name: str, base: type[QueuePool] = QueuePool) -> dict[str, Any]:
+    return {
+        "poolclass": _metered_pool(name, base),
+        "pool_size": _setting(role, "POOL_SIZE"),
+        "max_overflow": _setting(role, "MAX_OVERFLOW"),
+        "pool_timeout": _setting(role, "POOL_TIMEOUT"),
+        "pool_recycle": POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": POOL_PRE_PING,
+    }
+
+
+def _set_timeout_per_transaction(sync_engine: Engine, statement_timeout_ms: int) -> None:
+    # Session settings would leak to other clients of the PgBouncer connection
+    @event.listens_for(sync_engine, "begin")
+    def _set_statement_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {statement_timeout_ms}")
+
+
+def make_engine(role: str, url: str = DATABASE_URL) -> Engine:
+    """Engine with the pool size, overflow, timeouts and statement timeout of a role."""
+    if url.startswith("sqlite"):
+        return create_engine(url, future=True)
+
+    statement_timeout_ms = _setting(role, "STATEMENT_TIMEOUT_MS")
+    transaction_pooled = PGBOUNCER_MODE == "transaction" and url == DATABASE_URL
+    connect_args: dict[str, Any] = {"application_name": f"fitcollector-{role}"}
+    if statement_timeout_ms and not transaction_pooled:
+        connect_args["options"] = f"-c statement_timeout={statement_timeout_ms}"
+
+    new_engine = create_engine(url, future=True, connect_args=connect_args, **_pool_args(role, role))
+    if statement_timeout_ms and transaction_pooled:
+        _set_timeout_per_transaction(new_engine, statement_timeout_ms)
+
+    _engines[role] = new_engine
+    return new_engine
+
+
+def make_async_engine(role: str, url: str = DATABASE_URL) -> "AsyncEngine | None":
+    """
+    asyncpg engine with the settings of a role (its pool is reported as <role>_async).
+    None on SQLite or when asyncpg is not installed.
+    """
+    if url.startswith("sqlite") or create_async_engine is None:
+        return None
+
+    statement_timeout_ms = _setting(role, "STATEMENT_TIMEOUT_MS")
+    transaction_pooled = PGBOUNCER_MODE == "transaction" and url == DATABASE_URL
+    server_settings = {"application_name": f"fitcollector-{role}-async"}
+    if statement_timeout_ms and not transaction_pooled:
+        server_settings["statement_timeout"] = str(statement_timeout_ms)
+    connect_args: dict[str, Any] = {"server_settings": server_settings}
+    async_url = make_url(url).set(drivername="postgresql+asyncpg")
+    if transaction_pooled:
+        # PgBouncer may hand each transaction a different server connection, so
+        # asyncpg must not rely on prepared statements surviving between them
+        connect_args["statement_cache_size"] = 0
+        async_url = async_url.update_query_dict({"prepared_statement_cache_size": "0"})
+
+    name = f"{role}_async"
+    new_engine = create_async_engine(
+        async_url, connect_args=connect_args, **_pool_args(role, name, AsyncAdaptedQueuePool)
+    )
+    if statement_timeout_ms and transaction_pooled:
+        _set_timeout_per_transaction(new_engine.sync_engine, statement_timeout_ms)
+
+    _engines[name] = new_engine.sync_engine
+    return new_engine
+
+
+engine = make_engine(DB_ROLE)
+# Prunes, cascade deletes and retention runs started from the API use their own
+# small pool; in a jobs process this is the default engine
+jobs_engine = engine if DB_ROLE == "jobs" else make_engine("jobs")
+direct_engine = make_engine("direct", DATABASE_DIRECT_URL)
+# asyncpg connections belong to the event loop that opened them, so async handlers
+# get one engine per loop: a single one per uvicorn worker, but TestClient and
+# asyncio.run() callers start a fresh loop each time
+ASYNC_ENABLED = not IS_SQLITE and create_async_engine is not None
+_async_engines: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[AsyncEngine, asyncio.Semaphore]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _loop_async_engine() -> "tuple[AsyncEngine, asyncio.Semaphore]":
+    loop = asyncio.get_running_loop()
+    state = _async_engines.get(loop)
+    if state is None:
+        # Transactions queue on a FIFO semaphore sized to the pool rather than in the
+        # pool itself, where a just-returned connection goes to whichever request asks
+        # first and a burst leaves some requests waiting far longer than the rest
+        capacity = _setting(DB_ROLE, "POOL_SIZE") + _setting(DB_ROLE, "MAX_OVERFLOW")
+        state = _async_engines[loop] = (make_async_engine(DB_ROLE), asyncio.Semaphore(capacity))
+    return state
+
+
+def async_engine() -> "AsyncEngine | None":
+    """The async engine of the running event loop (None when ASYNC_ENABLED is false)."""
+    if not ASYNC_ENABLED:
+        return None
+    return _loop_async_engine()[0]
+
+
+T = TypeVar("T")
+
+
+_AFTER_COMMIT = "fitcollector_after_commit"
+_Callbacks = list[tuple[Callable[..., Any], tuple]]
+
+
+def _collecting_after_commit(conn: Connection, callbacks: _Callbacks, fn: Callable[..., T], *args: Any) -> T:
+    # info belongs to the pooled DBAPI connection and outlives the transaction
+    conn.info[_AFTER_COMMIT] = callbacks
+    try:
+        return fn(conn, *args)
+    finally:
+        conn.info.pop(_AFTER_COMMIT, None)
+
+
+def _run_after_commit(callbacks: _Callbacks) -> None:
+    for fn, args in callbacks:
+        fn(*args)
+
+
+def _in_transaction(fn: Callable[..., T], *args: Any) -> T:
+    callbacks: _Callbacks = []
+    with engine.begin() as conn:
+        result = _collecting_after_commit(conn, callbacks, fn, *args)
+    _run_after_commit(callbacks)
+    return result
+
+
+async def run_in_transaction(fn: Callable[..., T], *args: Any) -> T:
+    """
+    Run fn(conn, *args) in one transaction from an async handler without holding a
+    threadpool thread: on async_engine() through AsyncConnection.run_sync (the sync
+    code drives asyncpg from a greenlet), so the same query functions serve the
+    sync and async routes. Without asyncpg (or on SQLite) it runs in the threadpool.
+    after_commit callbacks registered by fn run in the threadpool once it commits.
+    """
+    if not ASYNC_ENABLED:
+        return await run_in_threadpool(_in_transaction, fn, *args)
+    callbacks: _Callbacks = []
+    loop_engine, slots = _loop_async_engine()
+    async with slots, loop_engine.begin() as conn:
+        result = await conn.run_sync(_collecting_after_commit, callbacks, fn, *args)
+    if callbacks:
+        await run_in_threadpool(_run_after_commit, callbacks)
+    return result
+
+
+def request_connection() -> Iterator[Connection]:
+    """
+    One pooled connection and transaction for a whole request, shared by the auth
+    dependencies, helpers, the handler and audit logging (FastAPI resolves a
+    dependency once per request). Commits when the handler returns and rolls back
+    when it raises, so a request's writes land together or not at all. Declare it
+    as REQUEST_CONNECTION: a different scope would be a second connection.
+    """
+    callbacks: _Callbacks = []
     with engine.begin() as conn:
-        # Create step_claims table for reward claim tracking
+        conn.info[_AFTER_COMMIT] = callbacks
+        try:
+            yield conn
+        finally:
+            # info belongs to the pooled DBAPI connection and outlives the request
+            conn.info.pop(_AFTER_COMMIT, None)
+    _run_after_commit(callbacks)
+
+
+# "function" scope ends the transaction before the response is sent, so a client
+# never sees a success for a write that has not committed
+REQUEST_CONNECTION = Depends(request_connection, scope="function")
+
+
+def after_commit(conn: Connection, fn: Callable[..., Any], *args: Any) -> None:
+    """
+    Call fn(*args) once conn's transaction has committed, e.g. cache invalidations
+    that must not let a concurrent request re-cache the old rows. Applies to request
+    connections and run_in_transaction; on any other connection it runs immediately.
+    """
+    callbacks = conn.info.get(_AFTER_COMMIT)
+    if callbacks is None:
+        fn(*args)
+    else:
+        callbacks.append((fn, args))
+
+
+class RequestTransaction:
+    """
+    request_connection for async handlers. The connection is checked out by the
+    first run() rather than up front, so requests served from the caches take none.
+    Calls must not overlap (one connection). after_commit callbacks registered by
+    any run() wait for the request's commit.
+    """
+
+    def __init__(self, stack: AsyncExitStack) -> None:
+        self._stack = stack
+        self._conn = None
+        self.callbacks: _Callbacks = []
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """run_in_transaction on the request's connection."""
+        if self._conn is None:
+            if ASYNC_ENABLED:
+                loop_engine, slots = _loop_async_engine()
+                await self._stack.enter_async_context(slots)
+                self._conn = await self._stack.enter_async_context(loop_engine.begin())
+            else:
+                self._conn = await self._stack.enter_async_context(contextmanager_in_threadpool(engine.begin()))
+        if ASYNC_ENABLED:
+            return await self._conn.run_sync(_collecting_after_commit, self.callbacks, fn, *args)
+        return await run_in_threadpool(_collecting_after_commit, self._conn, self.callbacks, fn, *args)
+
+
+async def request_transaction() -> AsyncIterator[RequestTransaction]:
+    async with AsyncExitStack() as stack:
+        tx = RequestTransaction(stack)
+        yield tx
+    if tx.callbacks:
+        await run_in_threadpool(_run_after_commit, tx.callbacks)
+
+
+REQUEST_TRANSACTION = Depends(request_transaction, scope="function")
+
+
+def pool_stats() -> dict[str, Any]:
+    """Live checkout counts and cumulative wait/timeout counters per engine role."""
+    stats = {}
+    for name, role_engine in _engines.items():
+        pool = role_engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        with _pool_lock:
+            counters = dict(_pool_counters.get(name, {}))
+        stats[name] = {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+            "max_overflow": _setting(name.removesuffix("_async"), "MAX_OVERFLOW"),
+            **counters,
+            "wait_ms_total": round(counters.get("wait_ms_total", 0.0), 1),
+            "wait_ms_max": round(counters.get("wait_ms_max", 0.0), 1),
+        }
+    return stats
+
+
+"""
+Database schema definitions and migrations.
+
+The schema is versioned: MIGRATIONS lists (version, name, function) in order and
+schema_version records the versions applied. init_db() runs on every process
+start but only reads schema_version when it is current. Otherwise it takes a
+Postgres advisory lock (so concurrent workers wait instead of racing), re-reads
+the version and applies each pending migration in its own transaction together
+with its schema_version row.
+
+Schema changes go in a new migration appended to MIGRATIONS, never into an
+existing one. Version 1 is the schema as it stood before versioning; it is
+idempotent so it also brings databases created by the old startup DDL up to date.
+"""
+
+logger = logging.getLogger("database")
+
+# pg_advisory_lock key held while migrations run
+MIGRATION_LOCK_ID = 8_318_210_001
+
+
+def _migrate_baseline(conn) -> None:
+    # Create step_claims table for reward claim tracking
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS step_claims (
+        id BIGSERIAL PRIMARY KEY,
+        minecraft_username TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        day DATE NOT NULL,
+        min_steps BIGINT NOT NULL DEFAULT 0,
+        claimed BOOLEAN NOT NULL DEFAULT FALSE,
+        claimed_at TIMESTAMPTZ,
+        UNIQUE(minecraft_username, server_name, day, min_steps)
+    );
+    """))
+
+    # Migration: add min_steps if missing
+    conn.execute(text("""
+    ALTER TABLE step_claims
+    ADD COLUMN IF NOT EXISTS min_steps BIGINT NOT NULL DEFAULT 0;
+    """))
+
+    # Migration: drop legacy unique constraint (per-day) and add per-tier unique index
+    if not IS_SQLITE:
         conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS step_claims (
-            id BIGSERIAL PRIMARY KEY,
-            minecraft_username TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            day DATE NOT NULL,
-            min_steps BIGINT NOT NULL DEFAULT 0,
-            claimed BOOLEAN NOT NULL DEFAULT FALSE,
-            claimed_at TIMESTAMPTZ,
-            UNIQUE(minecraft_username, server_name, day, min_steps)
-        );
+        ALTER TABLE step_claims
+        DROP CONSTRAINT IF EXISTS step_claims_minecraft_username_server_name_day_key;
         """))
 
-        # Migration: add min_steps if missing
         conn.execute(text("""
-        ALTER TABLE step_claims
-        ADD COLUMN IF NOT EXISTS min_steps BIGINT NOT NULL DEFAULT 0;
+        DROP INDEX IF EXISTS idx_step_claims_unique_user_server_day;
         """))
 
-        # Migration: drop legacy unique constraint (per-day) and add per-tier unique index
-        if not IS_SQLITE:
+    # SQLite requires table rebuild to drop unique constraints
+    if IS_SQLITE:
+        cols = [row[1] for row in conn.execute(text("PRAGMA table_info(step_claims)"))]
+        if cols:
+            conn.execute(text("ALTER TABLE step_claims RENAME TO step_claims_old"))
             conn.execute(text("""
-            ALTER TABLE step_claims
-            DROP CONSTRAINT IF EXISTS step_claims_minecraft_username_server_name_day_key;
+            CREATE TABLE step_claims (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                minecraft_username TEXT NOT NULL,
+                server_name TEXT NOT NULL,
+                day DATE NOT NULL,
+                min_steps BIGINT NOT NULL DEFAULT 0,
+                claimed BOOLEAN NOT NULL DEFAULT FALSE,
+                claimed_at TIMESTAMPTZ,
+                UNIQUE(minecraft_username, server_name, day, min_steps)
+            );
             """))
-
-            conn.execute(text("""
-            DROP INDEX IF EXISTS idx_step_claims_unique_user_server_day;
-            """))
-
-        # SQLite requires table rebuild to drop unique constraints
-        if IS_SQLITE:
-            cols = [row[1] for row in conn.execute(text("PRAGMA table_info(step_claims)"))]
-            if cols:
-                conn.execute(text("ALTER TABLE step_claims RENAME TO step_claims_old"))
+            if "min_steps" in cols:
                 conn.execute(text("""
-                CREATE TABLE step_claims (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    minecraft_username TEXT NOT NULL,
-                    server_name TEXT NOT NULL,
-                    day DATE NOT NULL,
-                    min_steps BIGINT NOT NULL DEFAULT 0,
-                    claimed BOOLEAN NOT NULL DEFAULT FALSE,
-                    claimed_at TIMESTAMPTZ,
-                    UNIQUE(minecraft_username, server_name, day, min_steps)
-                );
+                INSERT INTO step_claims (id, minecraft_username, server_name, day, min_steps, claimed, claimed_at)
+                SELECT id, minecraft_username, server_name, day, min_steps, claimed, claimed_at
+                FROM step_claims_old
                 """))
-                if "min_steps" in cols:
-                    conn.execute(text("""
-                    INSERT INTO step_claims (id, minecraft_username, server_name, day, min_steps, claimed, claimed_at)
-                    SELECT id, minecraft_username, server_name, day, min_steps, claimed, claimed_at
-                    FROM step_claims_old
-                    """))
-                else:
-                    conn.execute(text("""
-                    INSERT INTO step_claims (id, minecraft_username, server_name, day, min_steps, claimed, claimed_at)
-                    SELECT id, minecraft_username, server_name, day, 0, claimed, claimed_at
-                    FROM step_claims_old
-                    """))
-                conn.execute(text("DROP TABLE step_claims_old"))
-
-        conn.execute(text("""
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_step_claims_unique_user_server_day_tier
-        ON step_claims(minecraft_username, server_name, day, min_steps);
-        """))
-        # 1) Create step_ingest table if it doesn't exist
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS step_ingest (
-            id BIGSERIAL PRIMARY KEY,
-            device_id TEXT NOT NULL,
-            day DATE NOT NULL,
-            steps_today BIGINT NOT NULL,
-            source TEXT,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-        """))
-
-        # 2) Migration: add minecraft_username if missing
-        conn.execute(text("""
-        ALTER TABLE step_ingest
-        ADD COLUMN IF NOT EXISTS minecraft_username TEXT;
-        """))
-
-        # Backfill old rows so you can later enforce NOT NULL
-        conn.execute(text("""
-        UPDATE step_ingest
-        SET minecraft_username = COALESCE(minecraft_username, device_id)
-        WHERE minecraft_username IS NULL;
-        """))
-
-        # 3) Migration: add server_name if missing
-        conn.execute(text("""
-        ALTER TABLE step_ingest
-        ADD COLUMN IF NOT EXISTS server_name TEXT;
-        """))
-
-        # 4) Create indexes
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_step_ingest_device_day
-        ON step_ingest(device_id, day);
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_step_ingest_mc_day
-        ON step_ingest(minecraft_username, day);
-        """))
-
-        # 4a) Add unique constraint to prevent duplicate entries from multiple devices
-        # This ensures only one entry per username/server/day combination
-        conn.execute(text("""
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_step_ingest_unique_user_server_day
-        ON step_ingest(minecraft_username, server_name, day)
-        WHERE minecraft_username IS NOT NULL AND server_name IS NOT NULL;
-        """))
-
-        # 5) Create api_keys table for per-server authentication
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id BIGSERIAL PRIMARY KEY,
-            key TEXT UNIQUE NOT NULL,
-            server_name TEXT NOT NULL,
-            active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            last_used TIMESTAMPTZ
-        );
-        """))
-
-        # 5a) Migration: add max_players column if missing (NULL = unlimited)
-        conn.execute(text("""
-        ALTER TABLE api_keys
-        ADD COLUMN IF NOT EXISTS max_players INTEGER;
-        """))
-
-        # 5b) Migration: add owner_user_id if missing
-        conn.execute(text("""
-        ALTER TABLE api_keys
-        ADD COLUMN IF NOT EXISTS owner_user_id BIGINT;
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_api_keys_key
-        ON api_keys(key);
-        """))
-
-        # 5c) Create servers table for metadata + ownership
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS servers (
-            id BIGSERIAL PRIMARY KEY,
-            server_name TEXT UNIQUE NOT NULL,
-            owner_user_id BIGINT NOT NULL,
-            owner_name TEXT NOT NULL,
-            owner_email TEXT NOT NULL,
-            server_address TEXT,
-            server_version TEXT,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_servers_owner
-        ON servers(owner_user_id);
-        """))
-
-        # 5d) Migration: add privacy + invite code to servers
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS is_private BOOLEAN DEFAULT FALSE;
-        """))
-
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS invite_code TEXT;
-        """))
-
-        # 5e) Migration: add inactivity cleanup settings
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS inactive_prune_enabled BOOLEAN DEFAULT FALSE;
-        """))
-
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS inactive_prune_days INTEGER;
-        """))
-
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS inactive_prune_mode TEXT DEFAULT 'deactivate';
-        """))
-
-        # 5f) Migration: add claim buffer settings (days back allowed to claim)
-        conn.execute(text("""
-        ALTER TABLE servers
-        ADD COLUMN IF NOT EXISTS claim_buffer_days INTEGER DEFAULT 1;
-        """))
-
-        conn.execute(text("""
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_servers_invite_code
-        ON servers(invite_code)
-        WHERE invite_code IS NOT NULL;
-        """))
-
-        # 6) Create player_keys table for per-player authentication
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS player_keys (
-            id BIGSERIAL PRIMARY KEY,
-            key TEXT UNIQUE NOT NULL,
-            device_id TEXT NOT NULL,
-            minecraft_username TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            last_used TIMESTAMPTZ,
-            UNIQUE(device_id, server_name)
-        );
-        """))
-
-        # 7) Create bans table for player bans
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS bans (
-            id BIGSERIAL PRIMARY KEY,
-            ban_group_id TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            minecraft_username TEXT,
-            device_id TEXT,
-            reason TEXT,
-            banned_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        # 7a) Migration: add ban_group_id if missing
-        conn.execute(text("""
-        ALTER TABLE bans
-        ADD COLUMN IF NOT EXISTS ban_group_id TEXT;
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_bans_server_username
-        ON bans(server_name, minecraft_username);
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_bans_server_device
-        ON bans(server_name, device_id);
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_bans_ban_group_id
-        ON bans(ban_group_id);
-        """))
-        # 8) Create key_recovery_audit table for tracking key recoveries
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS key_recovery_audit (
-            id BIGSERIAL PRIMARY KEY,
-            device_id TEXT NOT NULL,
-            minecraft_username TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            recovered_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_key_recovery_device_server
-        ON key_recovery_audit(device_id, server_name);
-        """))
-
-        # 10) Create users and sessions for web login
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS users (
-            id BIGSERIAL PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL,
-            name TEXT NOT NULL,
-            password_hash TEXT NOT NULL,
-            password_salt TEXT NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            id BIGSERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            token_hash TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            last_used TIMESTAMPTZ
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_user_sessions_user
-        ON user_sessions(user_id);
-        """))
-
-        # 9) Create server_rewards table for reward tiers
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS server_rewards (
-            id BIGSERIAL PRIMARY KEY,
-            server_name TEXT NOT NULL,
-            min_steps BIGINT NOT NULL,
-            label TEXT NOT NULL,
-            item_id TEXT,
-            rewards_json TEXT NOT NULL,
-            position INTEGER NOT NULL DEFAULT 0,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        conn.execute(text("""
-        ALTER TABLE server_rewards
-        ADD COLUMN IF NOT EXISTS item_id TEXT;
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_server_rewards_server
-        ON server_rewards(server_name);
-        """))
-
-        # 11) Create push_notifications table for scheduled server messages
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS push_notifications (
-            id BIGSERIAL PRIMARY KEY,
-            server_name TEXT NOT NULL,
-            message TEXT NOT NULL,
-            scheduled_at TIMESTAMPTZ NOT NULL,
-            scheduled_date DATE NOT NULL,
-            created_by BIGINT,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
-
-        conn.execute(text("""
-        DROP INDEX IF EXISTS idx_push_notifications_server_day;
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_push_notifications_server_time
-        ON push_notifications(server_name, scheduled_at);
-        """))
-
-        # 12) Track deliveries per device to avoid duplicate push messages
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS push_deliveries (
-            id BIGSERIAL PRIMARY KEY,
-            notification_id BIGINT NOT NULL,
-            device_id TEXT NOT NULL,
-            minecraft_username TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            delivered_at TIMESTAMPTZ DEFAULT NOW(),
-            UNIQUE(notification_id, device_id)
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_push_deliveries_device
-        ON push_deliveries(device_id, server_name);
-        """))
-
-        # 13) Store device push tokens (APNs)
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS push_device_tokens (
-            id BIGSERIAL PRIMARY KEY,
-            device_id TEXT NOT NULL,
-            server_name TEXT NOT NULL,
-            platform TEXT NOT NULL,
-            token TEXT NOT NULL,
-            sandbox BOOLEAN NOT NULL DEFAULT TRUE,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            updated_at TIMESTAMPTZ DEFAULT NOW(),
-            UNIQUE(device_id, server_name, platform, token, sandbox)
-        );
-        """))
-
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_push_device_tokens_device
-        ON push_device_tokens(device_id, server_name);
-        """))
+            else:
+                conn.execute(text("""
+                INSERT INTO step_claims (id, minecraft_username, server_name, day, min_steps, claimed, claimed_at)
+                SELECT id, minecraft_username, server_name, day, 0, claimed, claimed_at
+                FROM step_claims_old
+                """))
+            conn.execute(text("DROP TABLE step_claims_old"))
+
+    conn.execute(text("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_step_claims_unique_user_server_day_tier
+    ON step_claims(minecraft_username, server_name, day, min_steps);
+    """))
+    # 1) Create step_ingest table if it doesn't exist
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS step_ingest (
+        id BIGSERIAL PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        day DATE NOT NULL,
+        steps_today BIGINT NOT NULL,
+        source TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """))
+
+    # 2) Migration: add minecraft_username if missing
+    conn.execute(text("""
+    ALTER TABLE step_ingest
+    ADD COLUMN IF NOT EXISTS minecraft_username TEXT;
+    """))
+
+    # 3) Migration: add server_name if missing
+    conn.execute(text("""
+    ALTER TABLE step_ingest
+    ADD COLUMN IF NOT EXISTS server_name TEXT;
+    """))
+
+    # 4) Create indexes
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_step_ingest_device_day
+    ON step_ingest(device_id, day);
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_step_ingest_mc_day
+    ON step_ingest(minecraft_username, day);
+    """))
+
+    # 4a) Add unique constraint to prevent duplicate entries from multiple devices
+    # This ensures only one entry per username/server/day combination
+    conn.execute(text("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_step_ingest_unique_user_server_day
+    ON step_ingest(minecraft_username, server_name, day)
+    WHERE minecraft_username IS NOT NULL AND server_name IS NOT NULL;
+    """))
+
+    # 5) Create api_keys table for per-server authentication
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS api_keys (
+        id BIGSERIAL PRIMARY KEY,
+        key TEXT UNIQUE NOT NULL,
+        server_name TEXT NOT NULL,
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        last_used TIMESTAMPTZ
+    );
+    """))
+
+    # 5a) Migration: add max_players column if missing (NULL = unlimited)
+    conn.execute(text("""
+    ALTER TABLE api_keys
+    ADD COLUMN IF NOT EXISTS max_players INTEGER;
+    """))
+
+    # 5b) Migration: add owner_user_id if missing
+    conn.execute(text("""
+    ALTER TABLE api_keys
+    ADD COLUMN IF NOT EXISTS owner_user_id BIGINT;
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_api_keys_key
+    ON api_keys(key);
+    """))
+
+    # 5c) Create servers table for metadata + ownership
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS servers (
+        id BIGSERIAL PRIMARY KEY,
+        server_name TEXT UNIQUE NOT NULL,
+        owner_user_id BIGINT NOT NULL,
+        owner_name TEXT NOT NULL,
+        owner_email TEXT NOT NULL,
+        server_address TEXT,
+        server_version TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_servers_owner
+    ON servers(owner_user_id);
+    """))
+
+    # 5d) Migration: add privacy + invite code to servers
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS is_private BOOLEAN DEFAULT FALSE;
+    """))
+
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS invite_code TEXT;
+    """))
+
+    # 5e) Migration: add inactivity cleanup settings
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS inactive_prune_enabled BOOLEAN DEFAULT FALSE;
+    """))
+
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS inactive_prune_days INTEGER;
+    """))
+
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS inactive_prune_mode TEXT DEFAULT 'deactivate';
+    """))
+
+    # 5f) Migration: add claim buffer settings (days back allowed to claim)
+    conn.execute(text("""
+    ALTER TABLE servers
+    ADD COLUMN IF NOT EXISTS claim_buffer_days INTEGER DEFAULT 1;
+    """))
+
+    conn.execute(text("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_servers_invite_code
+    ON servers(invite_code)
+    WHERE invite_code IS NOT NULL;
+    """))
+
+    # 6) Create player_keys table for per-player authentication
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS player_keys (
+        id BIGSERIAL PRIMARY KEY,
+        key TEXT UNIQUE NOT NULL,
+        device_id TEXT NOT NULL,
+        minecraft_username TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        last_used TIMESTAMPTZ,
+        UNIQUE(device_id, server_name)
+    );
+    """))
+
+    # 6a) Migration: last_activity_at (registration, accepted step submissions and
+    # claimed rewards). Backfilled once from history (migration 3); maintained
+    # incrementally after.
+    conn.execute(text("""
+    ALTER TABLE player_keys
+    ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMPTZ;
+    """))
+
+    conn.execute(text("""
+    ALTER TABLE player_keys
+    ALTER COLUMN last_activity_at SET DEFAULT NOW();
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_player_keys_server_activity
+    ON player_keys(server_name, active, last_activity_at);
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_player_keys_server_username
+    ON player_keys(server_name, minecraft_username);
+    """))
+
+    # 7) Create bans table for player bans
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS bans (
+        id BIGSERIAL PRIMARY KEY,
+        ban_group_id TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        minecraft_username TEXT,
+        device_id TEXT,
+        reason TEXT,
+        banned_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    # 7a) Migration: add ban_group_id if missing
+    conn.execute(text("""
+    ALTER TABLE bans
+    ADD COLUMN IF NOT EXISTS ban_group_id TEXT;
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_bans_server_username
+    ON bans(server_name, minecraft_username);
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_bans_server_device
+    ON bans(server_name, device_id);
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_bans_ban_group_id
+    ON bans(ban_group_id);
+    """))
+    # 8) Create key_recovery_audit table for tracking key recoveries
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS key_recovery_audit (
+        id BIGSERIAL PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        minecraft_username TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        recovered_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_key_recovery_device_server
+    ON key_recovery_audit(device_id, server_name);
+    """))
+
+    # 8a) Player wipes delete recovery history by player
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_key_recovery_server_username
+    ON key_recovery_audit(server_name, minecraft_username);
+    """))
+
+    # 10) Create users and sessions for web login
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        email TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        password_hash TEXT NOT NULL,
+        password_salt TEXT NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        token_hash TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        last_used TIMESTAMPTZ
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_user_sessions_user
+    ON user_sessions(user_id);
+    """))
+
+    # 9) Create server_rewards table for reward tiers
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS server_rewards (
+        id BIGSERIAL PRIMARY KEY,
+        server_name TEXT NOT NULL,
+        min_steps BIGINT NOT NULL,
+        label TEXT NOT NULL,
+        item_id TEXT,
+        rewards_json TEXT NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    ALTER TABLE server_rewards
+    ADD COLUMN IF NOT EXISTS item_id TEXT;
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_server_rewards_server
+    ON server_rewards(server_name);
+    """))
+
+    # 11) Create push_notifications table for scheduled server messages
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS push_notifications (
+        id BIGSERIAL PRIMARY KEY,
+        server_name TEXT NOT NULL,
+        message TEXT NOT NULL,
+        scheduled_at TIMESTAMPTZ NOT NULL,
+        scheduled_date DATE NOT NULL,
+        created_by BIGINT,
+        created_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    DROP INDEX IF EXISTS idx_push_notifications_server_day;
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_notifications_server_time
+    ON push_notifications(server_name, scheduled_at);
+    """))
+
+    # Migration: fan-out and delivery progress (push_scheduler)
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS fanned_out_at TIMESTAMPTZ;
+    """))
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ;
+    """))
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS target_count INTEGER;
+    """))
+    # Migration: send-now jobs share the queue with scheduled notifications
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'scheduled';
+    """))
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS title TEXT;
+    """))
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS data_json TEXT;
+    """))
+    for column in ("delivered_count", "removed_count", "failed_count"):
+        conn.execute(text(f"""
+        ALTER TABLE push_notifications
+        ADD COLUMN IF NOT EXISTS {column} INTEGER NOT NULL DEFAULT 0;
+        """))
+
+    # Migration: set once push_retention has folded the delivery rows into delivered_count
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS deliveries_compacted_at TIMESTAMPTZ;
+    """))
+
+    # Only notifications still waiting for fan-out are scanned by the scheduler
+    conn.execute(text("""
+    DROP INDEX IF EXISTS idx_push_notifications_scheduled_at;
+    """))
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_notifications_pending
+    ON push_notifications(scheduled_at)
+    WHERE fanned_out_at IS NULL;
+    """))
+
+    # Pending (notification, device) sends, expanded once per notification;
+    # rows go away with their notification
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS push_delivery_queue (
+        id BIGSERIAL PRIMARY KEY,
+        notification_id BIGINT NOT NULL REFERENCES push_notifications(id) ON DELETE CASCADE,
+        server_name TEXT NOT NULL,
+        device_id TEXT NOT NULL,
+        platform TEXT NOT NULL,
+        token TEXT NOT NULL,
+        minecraft_username TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        UNIQUE(notification_id, device_id, token)
+    );
+    """))
+
+    # Migration: worker that holds a claimed row; its lease ends at next_attempt_at
+    conn.execute(text("""
+    ALTER TABLE push_delivery_queue
+    ADD COLUMN IF NOT EXISTS leased_by TEXT;
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_delivery_queue_due
+    ON push_delivery_queue(next_attempt_at, id);
+    """))
+
+    # 12) Track deliveries per device to avoid duplicate push messages
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS push_deliveries (
+        id BIGSERIAL PRIMARY KEY,
+        notification_id BIGINT NOT NULL,
+        device_id TEXT NOT NULL,
+        minecraft_username TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        delivered_at TIMESTAMPTZ DEFAULT NOW(),
+        UNIQUE(notification_id, device_id)
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_deliveries_device
+    ON push_deliveries(device_id, server_name);
+    """))
+
+    # Per-player deletes (inactive prune wipes)
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_deliveries_server_username
+    ON push_deliveries(server_name, minecraft_username);
+    """))
+
+    # Counts reclaimed by each push_retention run
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS push_retention_runs (
+        id BIGSERIAL PRIMARY KEY,
+        started_at TIMESTAMPTZ NOT NULL,
+        finished_at TIMESTAMPTZ NOT NULL,
+        retention_days INTEGER NOT NULL,
+        notifications_compacted INTEGER NOT NULL DEFAULT 0,
+        rows_deleted BIGINT NOT NULL DEFAULT 0,
+        orphan_rows_deleted BIGINT NOT NULL DEFAULT 0
+    );
+    """))
+
+    # 13) Store device push tokens (APNs)
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS push_device_tokens (
+        id BIGSERIAL PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        server_name TEXT NOT NULL,
+        platform TEXT NOT NULL,
+        token TEXT NOT NULL,
+        sandbox BOOLEAN NOT NULL DEFAULT TRUE,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        updated_at TIMESTAMPTZ DEFAULT NOW(),
+        UNIQUE(device_id, server_name, platform, token, sandbox)
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_device_tokens_device
+    ON push_device_tokens(device_id, server_name);
+    """))
+
+    # 14) Audit log for server admin actions
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS audit_logs (
+        id BIGSERIAL PRIMARY KEY,
+        server_name TEXT NOT NULL,
+        actor_user_id BIGINT,
+        action TEXT NOT NULL,
+        summary TEXT,
+        details_json TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW()
+    );
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_audit_logs_server_time
+    ON audit_logs(server_name, created_at);
+    """))
+
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_audit_logs_actor
+    ON audit_logs(actor_user_id, created_at);
+    """))
+
+    # 15) Background cascade deletes (cascade_delete.py) and their progress
+    conn.execute(text("""
+    CREATE TABLE IF NOT EXISTS deletion_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        server_name TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress_json TEXT,
+        error TEXT,
+        created_by BIGINT,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        started_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    );
+    """))
+
+
+def _backfill_step_ingest_usernames(conn) -> None:
+    # Backfill old rows so you can later enforce NOT NULL
+    conn.execute(text("""
+    UPDATE step_ingest
+    SET minecraft_username = COALESCE(minecraft_username, device_id)
+    WHERE minecraft_username IS NULL;
+    """))
+
+
+def _backfill_player_activity(conn) -> None:
+    conn.execute(text("""
+    UPDATE player_keys pk
+    SET last_activity_at = GREATEST(
+        pk.created_at,
+        (
+            SELECT MAX(sc.claimed_at) FROM step_claims sc
+            WHERE sc.server_name = pk.server_name
+              AND sc.minecraft_username = pk.minecraft_username
+              AND sc.claimed = TRUE
+        ),
+        (
+            SELECT MAX(si.created_at) FROM step_ingest si
+            WHERE si.server_name = pk.server_name
+              AND si.minecraft_username = pk.minecraft_username
+        )
+    )
+    WHERE pk.last_activity_at IS NULL;
+    """))
+
+
+def _add_ios_fanout_pending(conn) -> None:
+    # Notifications fanned out while APNs was not configured; their iOS targets are
+    # queued once it is (push_scheduler.fan_out_pending_ios)
+    conn.execute(text("""
+    ALTER TABLE push_notifications
+    ADD COLUMN IF NOT EXISTS ios_fanout_pending BOOLEAN NOT NULL DEFAULT FALSE;
+    """))
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_push_notifications_ios_pending
+    ON push_notifications(id)
+    WHERE ios_fanout_pending;
+    """))
+
+
+def _add_deletion_job_owner(conn) -> None:
+    # The API process running a job and its last sign of life, so a process only
+    # fails jobs whose owner is gone (cascade_delete.fail_abandoned_jobs)
+    conn.execute(text("""
+    ALTER TABLE deletion_jobs
+    ADD COLUMN IF NOT EXISTS worker_id TEXT;
+    """))
+    conn.execute(text("""
+    ALTER TABLE deletion_jobs
+    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+    """))
+    conn.execute(text("""
+    CREATE INDEX IF NOT EXISTS idx_deletion_jobs_open
+    ON deletion_jobs(heartbeat_at)
+    WHERE status IN ('queued', 'running');
+    """))
+
+
+MIGRATIONS = [
+    (1, "baseline schema", _migrate_baseline),
+    (2, "backfill step_ingest.minecraft_username", _backfill_step_ingest_usernames),
+    (3, "backfill player_keys.last_activity_at", _backfill_player_activity),
+    (4, "push_notifications.ios_fanout_pending", _add_ios_fanout_pending),
+    (5, "deletion_jobs.worker_id and heartbeat_at", _add_deletion_job_owner),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_schema_version(conn) -> int:
+    """Highest applied migration, 0 for a database that predates versioning."""
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar_one()
 
-        # 14) Audit log for server admin actions
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS audit_logs (
-            id BIGSERIAL PRIMARY KEY,
-            server_name TEXT NOT NULL,
-            actor_user_id BIGINT,
-            action TEXT NOT NULL,
-            summary TEXT,
-            details_json TEXT,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        );
-        """))
 
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_audit_logs_server_time
-        ON audit_logs(server_name, created_at);
-        """))
+def init_db() -> None:
+    """Apply pending schema migrations; a no-op read when the schema is current."""
+    with direct_engine.connect() as conn:
+        version = current_schema_version(conn)
+        conn.commit()
+        if version >= SCHEMA_VERSION:
+            return
 
-        conn.execute(text("""
-        CREATE INDEX IF NOT EXISTS idx_audit_logs_actor
-        ON audit_logs(actor_user_id, created_at);
-        """))
+        if not IS_SQLITE:
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            conn.commit()
+        try:
+            with conn.begin():
+                conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                );
+                """))
+            # Another process may have migrated while we waited for the lock
+            version = current_schema_version(conn)
+            conn.commit()
+            for number, name, migrate in MIGRATIONS:
+                if number <= version:
+                    continue
+                started = time.perf_counter()
+                with conn.begin():
+                    migrate(conn)
+                    conn.execute(
+                        text("INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+                        {"version": number, "name": name},
+                    )
+                logger.info(
+                    "Applied migration %s (%s) in %.2fs", number, name, time.perf_counter() - started
+                )
+        finally:
+            if not IS_SQLITE:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                conn.commit()
+
+
+if __name__ == "__main__":
+    # Run migrations ahead of a deploy: python database.py
+    logging.basicConfig(level=logging.INFO)
+    init_db()
@@ -8,7 +8,10 @@ from typing import Any
 
 import firebase_admin
 from firebase_admin import credentials, messaging
-from firebase_admin.exceptions import FirebaseError
+from firebase_admin.exceptions import DeadlineExceededError, FirebaseError, InternalError, UnavailableError
+
+from circuit_breaker import CircuitBreaker
+from push_outcomes import DEFERRED, FAILED, INVALID_TOKEN, SENT
 
 
 class FcmConfigError(RuntimeError):
@@ -59,29 +62,111 @@ def is_unregistered_fcm_error(exc: Exception) -> bool:
     )
 
 
+def _android_config() -> messaging.AndroidConfig:
+    return messaging.AndroidConfig(
+        priority="high",
+        notification=messaging.AndroidNotification(
+            sound="default",
+            channel_id=os.getenv("ANDROID_PUSH_CHANNEL_ID", "stepcraft_push"),
+        ),
+    )
+
+
 def send_fcm_push(token: str, title: str, body: str, data: dict[str, Any] | None = None) -> None:
     app = get_fcm_app()
-    channel_id = os.getenv("ANDROID_PUSH_CHANNEL_ID", "stepcraft_push")
-
     message = messaging.Message(
         token=token,
         notification=messaging.Notification(title=title, body=body),
         data=_to_data_map(data),
-        android=messaging.AndroidConfig(
-            priority="high",
-            notification=messaging.AndroidNotification(
-                sound="default",
-                channel_id=channel_id,
-            ),
-        ),
+        android=_android_config(),
     )
     messaging.send(message, app=app)
 
 
+# FCM accepts at most 500 tokens per multicast request
+FCM_MULTICAST_MAX_TOKENS = 500
+
+# Errors meaning FCM itself is unreachable or failing, not the message
+_TRANSPORT_ERRORS = (UnavailableError, InternalError, DeadlineExceededError, OSError)
+
+_circuit = CircuitBreaker("FCM")
+
+
+def fcm_circuit_stats() -> dict[str, Any]:
+    return _circuit.stats()
+
+
+def fcm_retry_after() -> float:
+    """Seconds until deferred Android sends should be retried."""
+    return _circuit.retry_after()
+
+
+def send_fcm_multicast(
+    tokens: list[str],
+    title: str,
+    body: str,
+    data: dict[str, Any] | None = None,
+) -> list[tuple[str, str | None]]:
+    """
+    Send one notification to many tokens, up to FCM_MULTICAST_MAX_TOKENS per request.
+    Returns (outcome, error) per token in input order: sent, invalid_token (the
+    token is unregistered and should be removed), failed, or deferred while the
+    FCM circuit is open. Raises FcmConfigError when FCM is not configured.
+    """
+    app = get_fcm_app()
+    notification = messaging.Notification(title=title, body=body)
+    data_map = _to_data_map(data)
+    android = _android_config()
+
+    outcomes: list[tuple[str, str | None]] = []
+    for start in range(0, len(tokens), FCM_MULTICAST_MAX_TOKENS):
+        chunk = tokens[start:start + FCM_MULTICAST_MAX_TOKENS]
+        if not _circuit.allow():
+            outcomes.extend((DEFERRED, "FCM circuit open") for _ in chunk)
+            continue
+        message = messaging.MulticastMessage(
+            tokens=chunk,
+            notification=notification,
+            data=data_map,
+            android=android,
+        )
+        transport_failed = False
+        try:
+            # One HTTP v1 request per token (firebase-admin >= 6.2); the batch endpoint is retired
+            batch = messaging.send_each_for_multicast(message, app=app)
+            transport_failed = bool(batch.responses) and all(
+                isinstance(response.exception, _TRANSPORT_ERRORS) for response in batch.responses
+            )
+        except (FirebaseError, OSError) as exc:
+            transport_failed = isinstance(exc, _TRANSPORT_ERRORS)
+            error = format_fcm_exception(exc)
+            outcomes.extend((FAILED, error) for _ in chunk)
+            continue
+        finally:
+            # Always settle, or a half-open probe that raised would keep the circuit
+            # shut for good. Anything but a transport error means FCM was reachable.
+            if transport_failed:
+                _circuit.record_failure()
+            else:
+                _circuit.record_success()
+
+        for response in batch.responses:
+            if response.success:
+                outcomes.append((SENT, None))
+            elif is_unregistered_fcm_error(response.exception):
+                outcomes.append((INVALID_TOKEN, "unregistered"))
+            else:
+                outcomes.append((FAILED, format_fcm_exception(response.exception)))
+    return outcomes
+
+
 __all__ = [
     "FcmConfigError",
     "FirebaseError",
+    "fcm_circuit_stats",
+    "fcm_retry_after",
     "format_fcm_exception",
     "is_unregistered_fcm_error",
+    "send_fcm_multicast",
     "send_fcm_push",
 ]
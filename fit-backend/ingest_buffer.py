@@ -0,0 +1,242 @@
+"""
+Write-behind buffer for step_ingest upserts.
+
+Phones resubmit steps_today on every sync, so most submissions either do not raise
+the stored value or only raise it slightly. With INGEST_WRITE_MODE=buffered the
+ingest statement only validates (key, ban, first username of the day) and the
+upsert is staged here: the latest max per (minecraft_username, server_name, day)
+is kept in memory and flushed as one multi-row INSERT ... ON CONFLICT on a short
+interval or once INGEST_FLUSH_MAX_ROWS distinct rows are pending.
+
+Durability: in buffered mode a crash loses at most one flush interval of steps
+(phones resend the running total on the next sync). The buffer is flushed on
+application shutdown. INGEST_WRITE_MODE=sync (default) writes through as before.
+The buffer is per process; run a single API worker when buffering is enabled.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import date
+from typing import Any
+
+from sqlalchemy import text
+
+from database import engine
+
+logger = logging.getLogger("ingest_buffer")
+
+INGEST_WRITE_MODE = os.getenv("INGEST_WRITE_MODE", "sync").strip().lower()
+FLUSH_INTERVAL_SECONDS = float(os.getenv("INGEST_FLUSH_INTERVAL_SECONDS", "2"))
+FLUSH_MAX_ROWS = int(os.getenv("INGEST_FLUSH_MAX_ROWS", "500"))
+
+# Rows for keys removed since they were buffered (server deleted, player wiped)
+# are dropped instead of being resurrected.
+_FLUSH_SQL = text("""
+    INSERT INTO step_ingest (minecraft_username, device_id, day, steps_today, source, server_name)
+    SELECT r.minecraft_username, r.device_id, r.day, r.steps_today, r.source, r.server_name
+    FROM unnest(
+        CAST(:usernames AS TEXT[]),
+        CAST(:device_ids AS TEXT[]),
+        CAST(:days AS DATE[]),
+        CAST(:steps AS BIGINT[]),
+        CAST(:sources AS TEXT[]),
+        CAST(:server_names AS TEXT[])
+    ) AS r(minecraft_username, device_id, day, steps_today, source, server_name)
+    WHERE EXISTS (
+        SELECT 1 FROM player_keys pk
+        WHERE pk.server_name = r.server_name
+          AND pk.device_id = r.device_id
+          AND pk.active = TRUE
+    )
+    ON CONFLICT (minecraft_username, server_name, day)
+    WHERE minecraft_username IS NOT NULL AND server_name IS NOT NULL
+    DO UPDATE SET
+        steps_today = EXCLUDED.steps_today,
+        device_id = EXCLUDED.device_id,
+        source = EXCLUDED.source,
+        created_at = NOW()
+    WHERE EXCLUDED.steps_today > step_ingest.steps_today
+""")
+
+
+class IngestBuffer:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        # (minecraft_username, server_name, day) -> {"device_id", "steps_today", "source"}
+        self._pending: dict[tuple[str, str, date], dict[str, Any]] = {}
+        # (device_id, day) -> first username staged while the database has none yet
+        self._first_users: dict[tuple[str, date], str] = {}
+        self._submissions = 0
+        self._accepted = 0
+        self._coalesced = 0
+        self._rows_flushed = 0
+        self._flushes = 0
+        self._flush_failures = 0
+        self._last_flush_ms: float | None = None
+
+    def stage(self, rows: list[dict[str, Any]], device_id: str, minecraft_username: str, source: str | None) -> None:
+        """
+        Apply validated plan rows from ingest_engine to the buffer.
+        Fills in first_username, previous_steps and upserted so the response
+        reflects both the database and not-yet-flushed submissions.
+        """
+        with self._lock:
+            for row in rows:
+                if row["server_name"] is None or row["banned"]:
+                    continue
+                day = row["day"]
+                if row["first_username"] is None:
+                    row["first_username"] = self._first_users.setdefault((device_id, day), minecraft_username)
+                if row["first_username"] != minecraft_username:
+                    continue
+
+                self._submissions += 1
+                slot = (minecraft_username, row["server_name"], day)
+                pending = self._pending.get(slot)
+                known = [v for v in (row["previous_steps"], pending and pending["steps_today"]) if v is not None]
+                best = max(known) if known else None
+                row["previous_steps"] = best
+                row["upserted"] = best is None or row["steps_today"] > best
+                if not row["upserted"]:
+                    continue
+
+                self._accepted += 1
+                if pending is not None:
+                    self._coalesced += 1
+                self._pending[slot] = {
+                    "device_id": device_id,
+                    "steps_today": row["steps_today"],
+                    "source": source,
+                }
+
+            if len(self._pending) >= FLUSH_MAX_ROWS:
+                self._wake.set()
+
+    def flush(self) -> int:
+        """Write all pending rows in one statement. Returns the number of rows sent."""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {}
+            if not batch:
+                return 0
+
+            started = time.perf_counter()
+            slots = list(batch)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        _FLUSH_SQL,
+                        {
+                            "usernames": [s[0] for s in slots],
+                            "server_names": [s[1] for s in slots],
+                            "days": [s[2] for s in slots],
+                            "device_ids": [batch[s]["device_id"] for s in slots],
+                            "steps": [batch[s]["steps_today"] for s in slots],
+                            "sources": [batch[s]["source"] for s in slots],
+                        },
+                    )
+            except Exception:
+                logger.exception("Ingest buffer flush failed (%s rows requeued)", len(batch))
+                with self._lock:
+                    self._flush_failures += 1
+                    for slot, entry in batch.items():
+                        newer = self._pending.get(slot)
+                        if newer is None or entry["steps_today"] > newer["steps_today"]:
+                            self._pending[slot] = entry
+                return 0
+
+            with self._lock:
+                self._flushes += 1
+                self._rows_flushed += len(batch)
+                self._last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+                still_pending = {(e["device_id"], s[2]) for s, e in self._pending.items()}
+                self._first_users = {k: v for k, v in self._first_users.items() if k in still_pending}
+            return len(batch)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wake.wait(FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Ingest buffer flush loop failed")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer-flush", daemon=True)
+        self._thread.start()
+        logger.info(
+            "Ingest write-behind buffer active (interval=%ss, max_rows=%s)",
+            FLUSH_INTERVAL_SECONDS,
+            FLUSH_MAX_ROWS,
+        )
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            self._thread.join(timeout=FLUSH_INTERVAL_SECONDS + 30)
+            self._thread = None
+        flushed = self.flush()
+        if flushed:
+            logger.info("Ingest buffer flushed %s rows on shutdown", flushed)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": INGEST_WRITE_MODE,
+                "flush_interval_seconds": FLUSH_INTERVAL_SECONDS,
+                "flush_max_rows": FLUSH_MAX_ROWS,
+                "pending_rows": len(self._pending),
+                "submissions": self._submissions,
+                "accepted": self._accepted,
+                "coalesced": self._coalesced,
+                "rows_flushed": self._rows_flushed,
+                "flushes": self._flushes,
+                "flush_failures": self._flush_failures,
+                "last_flush_ms": self._last_flush_ms,
+                # Submissions per row actually written to Postgres
+                "coalescing_ratio": (
+                    round(self._submissions / self._rows_flushed, 2) if self._rows_flushed else None
+                ),
+            }
+
+
+_buffer = IngestBuffer()
+
+
+def enabled() -> bool:
+    return INGEST_WRITE_MODE == "buffered"
+
+
+def stage(rows: list[dict[str, Any]], device_id: str, minecraft_username: str, source: str | None) -> None:
+    _buffer.stage(rows, device_id, minecraft_username, source)
+
+
+def flush() -> int:
+    return _buffer.flush()
+
+
+def start() -> None:
+    """Start the background flush thread (no-op in sync mode)."""
+    if enabled():
+        _buffer.start()
+
+
+def stop() -> None:
+    """Stop the flush thread and write everything still pending."""
+    _buffer.stop()
+
+
+def stats() -> dict[str, Any]:
+    return _buffer.stats()
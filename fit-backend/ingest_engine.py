@@ -0,0 +1,358 @@
+"""Consolidated step ingest: key check, ban check, username rebind and upsert in one statement."""
+
+from __future__ import annotations
+
+from datetime import date, datetime
+from typing import Any
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from zoneinfo import ZoneInfo
+
+import auth_cache
+import ingest_buffer
+import last_used_tracker
+from database import run_in_transaction
+from utils import hash_token
+
+CENTRAL_TZ = ZoneInfo("America/Chicago")
+
+# One round trip per submission. Each entry is (key_hash, server_name, day, steps_today)
+# where server_name may be NULL to accept whichever server the key belongs to; the
+# statement validates the player key against the device, looks up bans, rebinds the
+# username, enforces the first-username-of-the-day rule and upserts the max steps.
+# Data-modifying CTEs always run, so the username rebind happens even when the
+# submission itself is rejected (same as the old multi-transaction flow). The
+# player_keys row is only written when the username actually changes; last_used
+# and last_activity_at are recorded through last_used_tracker.
+# With :write false the statement only validates and the caller stages the upsert
+# in ingest_buffer instead.
+_INGEST_SQL = text("""
+    WITH req AS (
+        SELECT *
+        FROM unnest(
+            CAST(:key_hashes AS TEXT[]),
+            CAST(:server_names AS TEXT[]),
+            CAST(:days AS DATE[]),
+            CAST(:steps AS BIGINT[])
+        ) AS r(key_hash, server_name, day, steps_today)
+    ),
+    keys AS (
+        SELECT DISTINCT pk.id, pk.key, pk.server_name, pk.minecraft_username
+        FROM player_keys pk
+        JOIN req r
+          ON r.key_hash = pk.key
+         AND (r.server_name IS NULL OR r.server_name = pk.server_name)
+        WHERE pk.device_id = :device_id
+          AND pk.active = TRUE
+    ),
+    bans_hit AS (
+        SELECT k.id AS key_id, b.reason
+        FROM keys k
+        CROSS JOIN LATERAL (
+            SELECT reason FROM bans
+            WHERE server_name = k.server_name
+              AND (
+                  minecraft_username = :username
+                  OR device_id = :device_id
+              )
+            LIMIT 1
+        ) b
+    ),
+    rebound AS (
+        -- Every key row of the device on that server, as the old flow did
+        UPDATE player_keys pk
+        SET minecraft_username = CAST(:username AS TEXT)
+        FROM keys k
+        WHERE pk.device_id = :device_id
+          AND pk.server_name = k.server_name
+          AND pk.minecraft_username IS DISTINCT FROM CAST(:username AS TEXT)
+          AND NOT EXISTS (SELECT 1 FROM bans_hit bh WHERE bh.key_id = k.id)
+        RETURNING pk.id
+    ),
+    first_user AS (
+        SELECT DISTINCT ON (si.day) si.day, si.minecraft_username
+        FROM step_ingest si
+        WHERE si.device_id = :device_id
+          AND si.day IN (SELECT day FROM req)
+        ORDER BY si.day, si.created_at ASC
+    ),
+    prev AS (
+        SELECT r.key_hash, r.day, si.steps_today
+        FROM req r
+        JOIN keys k ON k.key = r.key_hash
+        JOIN step_ingest si
+          ON si.minecraft_username = :username
+         AND si.server_name = k.server_name
+         AND si.day = r.day
+    ),
+    plan AS (
+        SELECT
+            r.key_hash,
+            r.day,
+            r.steps_today,
+            k.server_name,
+            k.minecraft_username AS previous_username,
+            bh.key_id IS NOT NULL AS banned,
+            bh.reason AS ban_reason,
+            fu.minecraft_username AS first_username,
+            p.steps_today AS previous_steps
+        FROM req r
+        LEFT JOIN keys k ON k.key = r.key_hash
+        LEFT JOIN bans_hit bh ON bh.key_id = k.id
+        LEFT JOIN first_user fu ON fu.day = r.day
+        LEFT JOIN prev p ON p.key_hash = r.key_hash AND p.day = r.day
+    ),
+    upserted AS (
+        INSERT INTO step_ingest (minecraft_username, device_id, day, steps_today, source, server_name)
+        SELECT CAST(:username AS TEXT), CAST(:device_id AS TEXT), day, steps_today, CAST(:source AS TEXT), server_name
+        FROM plan
+        WHERE CAST(:write AS BOOLEAN)
+          AND server_name IS NOT NULL
+          AND NOT banned
+          AND (first_username IS NULL OR first_username = :username)
+          AND (previous_steps IS NULL OR steps_today > previous_steps)
+        ON CONFLICT (minecraft_username, server_name, day)
+        WHERE minecraft_username IS NOT NULL AND server_name IS NOT NULL
+        DO UPDATE SET
+            steps_today = EXCLUDED.steps_today,
+            device_id = EXCLUDED.device_id,
+            source = EXCLUDED.source,
+            created_at = NOW()
+        WHERE EXCLUDED.steps_today > step_ingest.steps_today
+        RETURNING server_name, day
+    )
+    SELECT plan.*, u.server_name IS NOT NULL AS upserted
+    FROM plan
+    LEFT JOIN upserted u ON u.server_name = plan.server_name AND u.day = plan.day
+""")
+
+
+def resolve_ingest_day(day: str | None) -> date:
+    """Parse a client-supplied day, defaulting to today in the server timezone."""
+    if not day:
+        return datetime.now(CENTRAL_TZ).date()
+    try:
+        return datetime.fromisoformat(day).date()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid day format (YYYY-MM-DD)")
+
+
+def run_ingest(
+    conn,
+    device_id: str,
+    minecraft_username: str,
+    entries: list[tuple[str, str | None, date, int]],
+    source: str | None,
+    write: bool = True,
+) -> list[dict[str, Any]]:
+    """
+    Execute the ingest statement for (key_hash, server_name, day, steps_today) entries.
+    Returns one plan row per distinct (key_hash, day), keeping the highest steps.
+    """
+    best: dict[tuple[str, date], int] = {}
+    expected_server: dict[str, str | None] = {}
+    for key_hash, server_name, day, steps in entries:
+        slot = (key_hash, day)
+        best[slot] = max(int(steps), best.get(slot, -1))
+        if expected_server.setdefault(key_hash, server_name) != server_name:
+            # Listed under several server names: let the caller match the result
+            expected_server[key_hash] = None
+
+    rows = conn.execute(
+        _INGEST_SQL,
+        {
+            "key_hashes": [slot[0] for slot in best],
+            "server_names": [expected_server[slot[0]] for slot in best],
+            "days": [slot[1] for slot in best],
+            "steps": list(best.values()),
+            "device_id": device_id,
+            "username": minecraft_username,
+            "source": source,
+            "write": write,
+        },
+    ).mappings().all()
+    return [dict(row) for row in rows]
+
+
+async def _ingest_async(
+    device_id: str,
+    minecraft_username: str,
+    entries: list[tuple[str, str | None, date, int]],
+    source: str | None,
+) -> list[dict[str, Any]]:
+    """
+    Run the ingest statement through database.run_in_transaction, staging the
+    upsert in the write-behind buffer when enabled.
+    """
+    buffered = ingest_buffer.enabled()
+    rows = await run_in_transaction(
+        _run_ingest_and_invalidate, device_id, minecraft_username, entries, source, not buffered
+    )
+    return _after_ingest(rows, buffered, device_id, minecraft_username, source)
+
+
+def _run_ingest_and_invalidate(
+    conn,
+    device_id: str,
+    minecraft_username: str,
+    entries: list[tuple[str, str | None, date, int]],
+    source: str | None,
+    write: bool,
+) -> list[dict[str, Any]]:
+    # The rebind NOTIFY joins the ingest transaction instead of checking out a
+    # blocking connection on the event loop afterwards
+    rows = run_ingest(conn, device_id, minecraft_username, entries, source, write)
+    _invalidate_rebound(rows, device_id, minecraft_username, conn)
+    return rows
+
+
+def _invalidate_rebound(rows: list[dict[str, Any]], device_id: str, minecraft_username: str, conn) -> None:
+    """The statement rebinds player_keys.minecraft_username; drop cached lookups for it."""
+    rebound = {
+        row["server_name"]
+        for row in rows
+        if row["server_name"] is not None
+        and not row["banned"]
+        and row["previous_username"] != minecraft_username
+    }
+    for server_name in rebound:
+        auth_cache.invalidate_players(server_name=server_name, device_id=device_id, conn=conn)
+
+
+def _after_ingest(
+    rows: list[dict[str, Any]],
+    buffered: bool,
+    device_id: str,
+    minecraft_username: str,
+    source: str | None,
+) -> list[dict[str, Any]]:
+    if buffered:
+        ingest_buffer.stage(rows, device_id, minecraft_username, source)
+
+    for key_hash in {row["key_hash"] for row in rows if row["server_name"] is not None}:
+        last_used_tracker.touch("player_keys", key_hash)
+    # Accepted submissions count as player activity (inactive prune, player lists)
+    for key_hash in {
+        row["key_hash"]
+        for row in rows
+        if row["server_name"] is not None
+        and not row["banned"]
+        and row["first_username"] in (None, minecraft_username)
+    }:
+        last_used_tracker.touch("player_activity", key_hash)
+    return rows
+
+
+def ingest_response(row: dict[str, Any], device_id: str, minecraft_username: str) -> dict[str, Any]:
+    """Translate a plan row into the /v1/ingest response contract."""
+    if row["server_name"] is None:
+        raise HTTPException(status_code=401, detail="Invalid user token or device mismatch")
+
+    if row["banned"]:
+        reason = row["ban_reason"] if row["ban_reason"] else "No reason provided"
+        raise HTTPException(
+            status_code=403,
+            detail=f"You are banned from server '{row['server_name']}'. Reason: {reason}"
+        )
+
+    first_username = row["first_username"]
+    if first_username is not None and first_username != minecraft_username:
+        # Only allow submissions for the first username of the day
+        return {
+            "ok": False,
+            "reason": "Device already submitted a different username today",
+            "device_id": device_id,
+            "day": row["day"],
+            "first_username": first_username
+        }
+
+    if row["upserted"]:
+        return {
+            "ok": True,
+            "device_id": device_id,
+            "day": row["day"],
+            "steps_today": row["steps_today"],
+            "upserted": True,
+            "new_day": row["previous_steps"] is None
+        }
+
+    return {
+        "ok": True,
+        "device_id": device_id,
+        "day": row["day"],
+        "steps_today": row["steps_today"],
+        "upserted": False,
+        "reason": "Not higher than previous for this day"
+    }
+
+
+async def ingest_steps_async(
+    device_id: str,
+    player_api_key: str,
+    minecraft_username: str,
+    steps_today: int,
+    day: str | None = None,
+    source: str | None = None,
+) -> dict[str, Any]:
+    """Ingest a single submission in one transaction and one statement."""
+    entries = [(hash_token(player_api_key), None, resolve_ingest_day(day), steps_today)]
+    rows = await _ingest_async(device_id, minecraft_username, entries, source)
+    return ingest_response(rows[0], device_id, minecraft_username)
+
+
+async def ingest_batch_async(
+    device_id: str,
+    minecraft_username: str,
+    servers: list[tuple[str, str]],
+    day_steps: list[tuple[str | None, int]],
+    source: str | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Ingest the same step payload (or several backfill days) for several servers.
+    servers is a list of (server_name, player_api_key); day_steps is (day, steps_today).
+    Everything runs as one statement; returns one result per (server, day) in request order.
+    """
+    hashed, resolved_days, entries = _batch_entries(servers, day_steps)
+    rows = await _ingest_async(device_id, minecraft_username, entries, source)
+    return _batch_results(rows, hashed, resolved_days, device_id, minecraft_username)
+
+
+def _batch_entries(servers: list[tuple[str, str]], day_steps: list[tuple[str | None, int]]):
+    resolved_days = [(resolve_ingest_day(day), int(steps)) for day, steps in day_steps]
+    hashed = [(server_name, hash_token(api_key)) for server_name, api_key in servers]
+    entries = [
+        (key_hash, server_name, day, steps)
+        for server_name, key_hash in hashed
+        for day, steps in resolved_days
+    ]
+    return hashed, resolved_days, entries
+
+
+def _batch_results(
+    rows: list[dict[str, Any]],
+    hashed: list[tuple[str, str]],
+    resolved_days: list[tuple[date, int]],
+    device_id: str,
+    minecraft_username: str,
+) -> list[dict[str, Any]]:
+    plan = {(row["key_hash"], row["day"]): row for row in rows}
+
+    results: list[dict[str, Any]] = []
+    seen: set[tuple[str, str, date]] = set()
+    for server_name, key_hash in hashed:
+        for day, _ in resolved_days:
+            if (server_name, key_hash, day) in seen:
+                continue
+            seen.add((server_name, key_hash, day))
+            row = plan[(key_hash, day)]
+            if row["server_name"] != server_name:
+                # Key belongs to a different server than the one it was listed under
+                row = {**row, "server_name": None}
+            try:
+                result = ingest_response(row, device_id, minecraft_username)
+                result["status_code"] = 200
+            except HTTPException as e:
+                result = {"ok": False, "status_code": e.status_code, "error": e.detail, "day": day}
+            results.append({"server_name": server_name, **result})
+    return results
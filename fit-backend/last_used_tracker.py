@@ -0,0 +1,167 @@
+"""
+Batched last_used tracking for api_keys, player_keys and user_sessions, and
+last_activity_at tracking for players (accepted step submissions).
+
+Authenticated requests record a touch in memory instead of issuing an
+UPDATE ... SET last_used = NOW() per call. Touches are flushed with one bulk
+UPDATE per kind every LAST_USED_FLUSH_INTERVAL_SECONDS and on shutdown, so
+read-only endpoints need no write transaction and hot server keys no longer
+take a row lock per request. Both columns lag by at most one interval.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+from sqlalchemy import text
+
+from database import engine, IS_SQLITE
+
+logger = logging.getLogger("last_used_tracker")
+
+FLUSH_INTERVAL_SECONDS = float(os.getenv("LAST_USED_FLUSH_INTERVAL_SECONDS", "30"))
+
+# touch kind -> (table, column holding the token hash, timestamp column)
+TRACKED_TABLES = {
+    "api_keys": ("api_keys", "key", "last_used"),
+    "player_keys": ("player_keys", "key", "last_used"),
+    "user_sessions": ("user_sessions", "token_hash", "last_used"),
+    "player_activity": ("player_keys", "key", "last_activity_at"),
+}
+
+
+class LastUsedTracker:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pending: dict[str, dict[str, datetime]] = {table: {} for table in TRACKED_TABLES}
+        self._touches = 0
+        self._rows_flushed = 0
+        self._flushes = 0
+        self._flush_failures = 0
+        self._last_flush_ms: float | None = None
+
+    def touch(self, table: str, key_hash: str) -> None:
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self._pending[table][key_hash] = now
+            self._touches += 1
+
+    def flush(self) -> int:
+        """Write pending touches with one UPDATE per table. Returns rows sent."""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {table: {} for table in TRACKED_TABLES}
+            total = sum(len(touches) for touches in batch.values())
+            if not total:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    for kind, touches in batch.items():
+                        if touches:
+                            _flush_table(conn, *TRACKED_TABLES[kind], touches)
+            except Exception:
+                logger.exception("last_used flush failed (%s touches requeued)", total)
+                with self._lock:
+                    self._flush_failures += 1
+                    for table, touches in batch.items():
+                        for key_hash, ts in touches.items():
+                            newer = self._pending[table].get(key_hash)
+                            if newer is None or ts > newer:
+                                self._pending[table][key_hash] = ts
+                return 0
+
+            with self._lock:
+                self._flushes += 1
+                self._rows_flushed += total
+                self._last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+            return total
+
+    def _run(self) -> None:
+        while not self._stopping.wait(FLUSH_INTERVAL_SECONDS):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("last_used flush loop failed")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="last-used-flush", daemon=True)
+        self._thread.start()
+        logger.info("last_used tracker active (interval=%ss)", FLUSH_INTERVAL_SECONDS)
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=30)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "flush_interval_seconds": FLUSH_INTERVAL_SECONDS,
+                "pending": {table: len(touches) for table, touches in self._pending.items()},
+                "touches": self._touches,
+                "rows_flushed": self._rows_flushed,
+                "flushes": self._flushes,
+                "flush_failures": self._flush_failures,
+                "last_flush_ms": self._last_flush_ms,
+            }
+
+
+def _flush_table(conn, table: str, column: str, ts_column: str, touches: dict[str, datetime]) -> None:
+    if IS_SQLITE:
+        conn.execute(
+            text(f"UPDATE {table} SET {ts_column} = :ts WHERE {column} = :key_hash"),
+            [{"key_hash": k, "ts": ts} for k, ts in touches.items()],
+        )
+        return
+    conn.execute(
+        text(f"""
+            UPDATE {table} t
+            SET {ts_column} = v.ts
+            FROM unnest(
+                CAST(:key_hashes AS TEXT[]),
+                CAST(:timestamps AS TIMESTAMPTZ[])
+            ) AS v(key_hash, ts)
+            WHERE t.{column} = v.key_hash
+              AND (t.{ts_column} IS NULL OR t.{ts_column} < v.ts)
+        """),
+        {"key_hashes": list(touches), "timestamps": list(touches.values())},
+    )
+
+
+_tracker = LastUsedTracker()
+
+
+def touch(table: str, key_hash: str) -> None:
+    """Record that a key/session was used just now (or, for player_activity, that the player was active)."""
+    _tracker.touch(table, key_hash)
+
+
+def flush() -> int:
+    return _tracker.flush()
+
+
+def start() -> None:
+    _tracker.start()
+
+
+def stop() -> None:
+    """Stop the flush thread and write everything still pending."""
+    _tracker.stop()
+
+
+def stats() -> dict[str, Any]:
+    return _tracker.stats()
@@ -3,6 +3,12 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from database import init_db
+import auth_cache  # registers its invalidation channel
+import cascade_delete
+import server_config  # registers its invalidation channel
+import notify_listener
+import ingest_buffer
+import last_used_tracker
 from routes import health, players, ingest, push
 from routes import auth as auth_routes
 from routes.servers import router as servers_router
@@ -38,6 +44,18 @@ app.include_router(push.router)
 def on_startup():
     """Initialize database on startup."""
     init_db()
+    cascade_delete.start()
+    ingest_buffer.start()
+    last_used_tracker.start()
+    notify_listener.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    """Flush buffered ingest rows and last_used touches before the process exits."""
+    ingest_buffer.stop()
+    last_used_tracker.stop()
+    cascade_delete.stop()
 
 
 @app.exception_handler(FastAPIHTTPException)
@@ -17,15 +17,14 @@ Usage:
     python manage_keys.py player enable <key>
 """
 
-import os
+import json
 import secrets
 import sys
 import hashlib
 from datetime import datetime
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///fitcollector.db")
-engine = create_engine(DATABASE_URL, future=True)
+from database import engine
 
 
 def hash_token(token: str) -> str:
@@ -38,6 +37,16 @@ def generate_opaque_token(length: int = 32) -> str:
     return secrets.token_urlsafe(length)
 
 
+def notify_auth_cache(conn, key_hash: str) -> None:
+    """Tell running API processes to drop a cached key (delivered on commit, Postgres only)."""
+    if engine.dialect.name != "postgresql":
+        return
+    conn.execute(
+        text("SELECT pg_notify('auth_cache', :payload)"),
+        {"payload": json.dumps({"scope": "token", "key_hash": key_hash})}
+    )
+
+
 def add_server_key(server_name: str, key_length: int = 32) -> str:
     """Add a new API key for a server (hashed opaque token)."""
     plaintext_key = generate_opaque_token(key_length)
@@ -96,6 +105,7 @@ def disable_server_key(api_key: str) -> None:
                 text("UPDATE api_keys SET active = FALSE WHERE key = :key_hash"),
                 {"key_hash": key_hash}
             )
+            notify_auth_cache(conn, key_hash)
             if result.rowcount == 0:
                 print(f"✗ Key not found: {api_key[:12]}...")
             else:
@@ -203,6 +213,7 @@ def disable_player_key(api_key: str) -> None:
                 text("UPDATE player_keys SET active = FALSE WHERE key = :key_hash"),
                 {"key_hash": key_hash}
             )
+            notify_auth_cache(conn, key_hash)
             if result.rowcount == 0:
                 print(f"✗ Key not found: {api_key[:12]}...")
             else:
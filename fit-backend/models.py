@@ -14,6 +14,40 @@ class IngestPayload(BaseModel):
     timestamp: Optional[str] = None
 
 
+class IngestBatchServer(BaseModel):
+    server_name: str = Field(..., min_length=3, max_length=50)
+    player_api_key: str = Field(..., min_length=20)
+
+
+class IngestBatchDay(BaseModel):
+    day: str
+    steps_today: int = Field(..., ge=0, le=500_000)
+
+
+class IngestBatchPayload(BaseModel):
+    minecraft_username: str = Field(..., min_length=3, max_length=16)
+    device_id: str = Field(..., min_length=6, max_length=128)
+    servers: list[IngestBatchServer] = Field(..., min_length=1, max_length=50)
+    steps_today: Optional[int] = Field(None, ge=0, le=500_000)
+    day: Optional[str] = None
+    days: list[IngestBatchDay] = Field(default_factory=list, max_length=31)
+    source: Optional[str] = "health_connect"
+    timestamp: Optional[str] = None
+
+
+class ClaimRewardItem(BaseModel):
+    day: Optional[str] = None
+    min_steps: int = Field(..., ge=0)
+
+
+class ClaimRewardsRequest(BaseModel):
+    claims: list[ClaimRewardItem] = Field(..., min_length=1, max_length=1000)
+
+
+class ClaimAvailableRequest(BaseModel):
+    usernames: list[str] = Field(..., min_length=1, max_length=500)
+
+
 class PlayerRegistrationRequest(BaseModel):
     minecraft_username: str = Field(..., min_length=3, max_length=16)
     device_id: str = Field(..., min_length=6, max_length=128)
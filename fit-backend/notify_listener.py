@@ -0,0 +1,109 @@
+"""
+Shared Postgres LISTEN/NOTIFY connection for in-process caches and wakeups.
+
+Caches (auth_cache, server_config) and the push scheduler register a channel with
+a handler for each payload and a reset callback. One background thread LISTENs on
+every registered channel over a dedicated connection; if that connection drops,
+every reset callback runs because notifications may have been missed. No-op on
+SQLite.
+"""
+
+import json
+import logging
+import select
+import threading
+import time
+from typing import Any, Callable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import direct_engine, engine, IS_SQLITE
+
+logger = logging.getLogger("notify_listener")
+
+# channel -> (handler(payload), reset())
+_channels: dict[str, tuple[Callable[[Any], None], Callable[[], None]]] = {}
+_thread: threading.Thread | None = None
+
+
+def register(channel: str, handler: Callable[[Any], None], reset: Callable[[], None]) -> None:
+    """Dispatch JSON payloads on channel to handler. Register before start()."""
+    _channels[channel] = (handler, reset)
+
+
+def publish(channel: str, payload: Any, conn: Connection | None = None) -> None:
+    """
+    NOTIFY other processes. Call after the change has committed; failures are logged.
+    With conn the NOTIFY joins conn's transaction instead (Postgres delivers it when
+    that commits) and failures propagate with the transaction.
+    """
+    if IS_SQLITE:
+        return
+    if conn is not None:
+        conn.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": channel, "payload": json.dumps(payload)},
+        )
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": channel, "payload": json.dumps(payload)},
+            )
+    except Exception:
+        logger.exception("Failed to publish notification on %s", channel)
+
+
+def _reset_all() -> None:
+    for _, reset in _channels.values():
+        reset()
+
+
+def _listen_forever() -> None:
+    while True:
+        raw = None
+        try:
+            # LISTEN needs a real session, not a PgBouncer transaction
+            raw = direct_engine.raw_connection()
+            dbapi_conn = raw.driver_connection
+            # Keep this connection out of the pool for its whole life
+            raw.detach()
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cur:
+                for channel in _channels:
+                    cur.execute(f"LISTEN {channel}")
+            logger.info("Listening for notifications on %s", ", ".join(_channels))
+            while True:
+                if select.select([dbapi_conn], [], [], 30) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    note = dbapi_conn.notifies.pop(0)
+                    entry = _channels.get(note.channel)
+                    if entry is None:
+                        continue
+                    try:
+                        entry[0](json.loads(note.payload))
+                    except Exception:
+                        logger.exception("Bad %s notification: %s", note.channel, note.payload)
+        except Exception:
+            logger.exception("Notification listener failed; resetting and reconnecting")
+            # Notifications may have been missed while disconnected
+            _reset_all()
+            if raw is not None:
+                try:
+                    raw.close()
+                except Exception:
+                    pass
+            time.sleep(5)
+
+
+def start() -> None:
+    """Start the listener thread (Postgres only, once, if any channel is registered)."""
+    global _thread
+    if IS_SQLITE or not _channels or _thread is not None:
+        return
+    _thread = threading.Thread(target=_listen_forever, name="notify-listener", daemon=True)
+    _thread.start()
@@ -0,0 +1,176 @@
+"""
+Inactive-player prune engine, shared by the daily job (inactive_prune_job.py)
+and POST /v1/servers/inactive-prune/run.
+
+Candidates are the active players on a server whose last_activity_at
+(registration, accepted step submission or claimed reward) is older than the
+cutoff: one range scan on idx_player_keys_server_activity, also used by the
+dry-run report. They are then deactivated or wiped with set-based statements
+over chunks of INACTIVE_PRUNE_CHUNK_SIZE players, one short transaction per
+chunk, so pruning a large server never holds row locks for long; a wipe removes
+the same dependent rows as any other player wipe (cascade_delete.py). Each chunk
+re-checks inactivity, so a player who claims while a prune is running is left
+alone.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import text
+
+from database import jobs_engine
+import auth_cache
+import cascade_delete
+
+logger = logging.getLogger("prune_engine")
+
+CHUNK_SIZE = max(1, int(os.getenv("INACTIVE_PRUNE_CHUNK_SIZE", "500")))
+
+MODE_DEACTIVATE = "deactivate"
+MODE_WIPE = "wipe"
+
+# Kept current by registration, ingest (via last_used_tracker) and claims
+_INACTIVE = "pk.last_activity_at < :cutoff"
+
+
+def _cutoff(days: int) -> datetime:
+    return datetime.now(timezone.utc) - timedelta(days=days)
+
+
+def find_candidates(server_name: str, cutoff: datetime) -> list[dict[str, Any]]:
+    """Active players on server_name with no activity since cutoff, oldest key first."""
+    with jobs_engine.begin() as conn:
+        rows = conn.execute(
+            text(f"""
+                SELECT
+                    pk.id,
+                    pk.minecraft_username,
+                    pk.device_id,
+                    pk.created_at,
+                    pk.last_activity_at
+                FROM player_keys pk
+                WHERE pk.server_name = :server
+                  AND pk.active = TRUE
+                  AND {_INACTIVE}
+                ORDER BY pk.last_activity_at, pk.id
+            """),
+            {"server": server_name, "cutoff": cutoff},
+        ).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def _last_claims(server_name: str, usernames: list[str]) -> dict[str, Any]:
+    with jobs_engine.begin() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT minecraft_username, MAX(claimed_at) AS last_claimed_at
+                FROM step_claims
+                WHERE server_name = :server
+                  AND minecraft_username = ANY(CAST(:usernames AS TEXT[]))
+                  AND claimed = TRUE
+                GROUP BY minecraft_username
+            """),
+            {"server": server_name, "usernames": usernames},
+        ).all()
+    return {row[0]: row[1] for row in rows}
+
+
+def dry_run_report(server_name: str, days: int, mode: str) -> dict[str, Any]:
+    candidates = find_candidates(server_name, _cutoff(days))
+    # Reported for the candidates only
+    last_claims = _last_claims(server_name, list({row["minecraft_username"] for row in candidates}))
+    return {
+        "server_name": server_name,
+        "dry_run": True,
+        "mode": mode,
+        "max_inactive_days": days,
+        "candidates": [
+            {
+                "minecraft_username": row["minecraft_username"],
+                "device_id": row["device_id"],
+                "last_claimed_at": last_claims.get(row["minecraft_username"]),
+                "last_activity_at": row["last_activity_at"],
+                "created_at": row["created_at"],
+            }
+            for row in candidates
+        ],
+        "total_candidates": len(candidates),
+    }
+
+
+def _prune_chunk(conn, server_name: str, ids: list[int], cutoff: datetime, mode: str, counts: dict[str, int]) -> list[str]:
+    params = {"server": server_name, "ids": ids, "cutoff": cutoff}
+    if mode == MODE_DEACTIVATE:
+        usernames = conn.execute(
+            text(f"""
+                UPDATE player_keys pk
+                SET active = FALSE
+                WHERE pk.id = ANY(CAST(:ids AS BIGINT[]))
+                  AND pk.active = TRUE
+                  AND {_INACTIVE}
+                RETURNING pk.minecraft_username
+            """),
+            params,
+        ).scalars().all()
+        counts["player_keys"] += len(usernames)
+        return list(usernames)
+
+    rows = conn.execute(
+        text(f"""
+            DELETE FROM player_keys pk
+            WHERE pk.id = ANY(CAST(:ids AS BIGINT[]))
+              AND pk.active = TRUE
+              AND {_INACTIVE}
+            RETURNING pk.minecraft_username, pk.device_id
+        """),
+        params,
+    ).all()
+    counts["player_keys"] += len(rows)
+    if not rows:
+        return []
+    usernames = [row[0] for row in rows]
+    deleted = cascade_delete.delete_player_rows(
+        conn, server_name, list(set(usernames)), list({row[1] for row in rows})
+    )
+    for table, count in deleted.items():
+        counts[table] = counts.get(table, 0) + count
+    return usernames
+
+
+def prune_server(server_name: str, days: int, mode: str) -> dict[str, Any]:
+    """
+    Deactivate or wipe a server's inactive players in chunks. Returns the pruned
+    usernames and per-table counts of rows affected.
+    """
+    cutoff = _cutoff(days)
+    candidates = find_candidates(server_name, cutoff)
+    counts = {"player_keys": 0}
+    removed: list[str] = []
+
+    for start in range(0, len(candidates), CHUNK_SIZE):
+        ids = [row["id"] for row in candidates[start:start + CHUNK_SIZE]]
+        with jobs_engine.begin() as conn:
+            removed.extend(_prune_chunk(conn, server_name, ids, cutoff, mode, counts))
+        # Pruned keys must stop authenticating as soon as their chunk commits
+        auth_cache.invalidate_players(server_name=server_name)
+
+    if candidates:
+        logger.info(
+            "Inactive prune (%s): %s of %s candidates on %s (%s)",
+            mode,
+            len(removed),
+            len(candidates),
+            server_name,
+            counts,
+        )
+    return {
+        "server_name": server_name,
+        "dry_run": False,
+        "mode": mode,
+        "max_inactive_days": days,
+        "removed_players": removed,
+        "total_removed": len(removed),
+        "records_affected": counts,
+    }
@@ -0,0 +1,223 @@
+"""
+Concurrent push delivery engine.
+
+deliver() sends a batch of push messages with a bounded thread pool per provider
+(PUSH_APNS_CONCURRENCY / PUSH_FCM_CONCURRENCY), then records every successful
+delivery with one multi-row INSERT into push_deliveries and removes every token the
+provider rejected as unregistered with one DELETE. Messages with the same content
+are sent as one batch call per provider: FCM multicast for Android, multiplexed
+HTTP/2 streams on a pooled APNs connection for iOS. Providers are plain callables
+(see default_senders) so tests and benchmarks can swap in fakes. While a
+provider's circuit breaker is open its messages come back deferred without being
+sent, so an outage on one platform does not hold up the other.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from sqlalchemy import text
+
+from database import engine
+from apns_service import APNS_BATCH_MAX_TOKENS, APNS_POOL_SIZE, apns_retry_after, send_push_batch
+from fcm_service import FCM_MULTICAST_MAX_TOKENS, fcm_retry_after, send_fcm_multicast
+from push_outcomes import DEFERRED, FAILED, INVALID_TOKEN, SENT
+
+logger = logging.getLogger("push_delivery")
+
+# Each iOS worker holds one pooled APNs connection while it sends, so more workers
+# than connections would only queue
+APNS_CONCURRENCY = int(os.getenv("PUSH_APNS_CONCURRENCY", str(APNS_POOL_SIZE)))
+FCM_CONCURRENCY = int(os.getenv("PUSH_FCM_CONCURRENCY", "16"))
+
+# (tokens, title, body, data) -> [(outcome, error)] per token
+BatchSender = Callable[[list[str], str, str, dict], list[tuple[str, str | None]]]
+
+
+def default_senders() -> dict[str, BatchSender]:
+    """Both providers take a batch of tokens per call."""
+    return {"ios": send_push_batch, "android": send_fcm_multicast}
+
+
+def _provider(message: dict[str, Any]) -> str:
+    return "android" if str(message.get("platform") or "").lower() == "android" else "ios"
+
+
+def retry_after(message: dict[str, Any]) -> float:
+    """Seconds until a deferred message's provider circuit allows a probe."""
+    return fcm_retry_after() if _provider(message) == "android" else apns_retry_after()
+
+
+# Long-lived worker pools, one per provider
+_pools: dict[str, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(provider: str) -> ThreadPoolExecutor:
+    with _pools_lock:
+        pool = _pools.get(provider)
+        if pool is None:
+            limit = FCM_CONCURRENCY if provider == "android" else APNS_CONCURRENCY
+            pool = ThreadPoolExecutor(max_workers=max(1, limit), thread_name_prefix=f"push-{provider}")
+            _pools[provider] = pool
+        return pool
+
+
+def _send_group(
+    provider: str,
+    messages: list[dict[str, Any]],
+    batch_sender: BatchSender,
+) -> list[tuple[str, str | None]]:
+    """Send messages sharing title/body/data as one batch call."""
+    first = messages[0]
+    name = "FCM" if provider == "android" else "APNs"
+    try:
+        outcomes = batch_sender([m["token"] for m in messages], first["title"], first["body"], first["data"])
+    except Exception as e:
+        logger.warning("%s batch failed for %s tokens on %s: %s", name, len(messages), first["server_name"], e)
+        return [(FAILED, str(e))] * len(messages)
+
+    deferred = sum(1 for outcome, _ in outcomes if outcome == DEFERRED)
+    if deferred:
+        logger.info("%s circuit open; deferred %s tokens on %s", name, deferred, first["server_name"])
+    # One line per distinct error, so an outage does not log every token
+    failed: dict[str, int] = {}
+    for message, (outcome, error) in zip(messages, outcomes):
+        if outcome == INVALID_TOKEN:
+            logger.info("Invalid %s token for device %s on %s; removing", name, message["device_id"], message["server_name"])
+        elif outcome == FAILED:
+            failed[str(error)] = failed.get(str(error), 0) + 1
+    for error, count in failed.items():
+        logger.warning("%s error for %s tokens on %s: %s", name, count, first["server_name"], error)
+    return outcomes
+
+
+def _chunk_size(provider: str, count: int) -> int:
+    if provider == "android":
+        return FCM_MULTICAST_MAX_TOKENS
+    # Spread a broadcast over the APNs workers (one pooled connection each)
+    return max(1, min(APNS_BATCH_MAX_TOKENS, -(-count // max(1, APNS_CONCURRENCY))))
+
+
+def send_all(
+    messages: list[dict[str, Any]],
+    senders: dict[str, BatchSender] | None = None,
+) -> list[tuple[str, str | None]]:
+    """
+    Send messages concurrently, bounded per provider. Messages that share provider,
+    title, body and data are split into batch calls: FCM multicasts of up to
+    FCM_MULTICAST_MAX_TOKENS tokens, and APNs batches spread over the pooled
+    connections. Returns (outcome, error) per message in input order. Does not
+    touch the database.
+    """
+    senders = senders or default_senders()
+    outcomes: list[tuple[str, str | None]] = [(FAILED, None)] * len(messages)
+    jobs: list[tuple[list[int], Any]] = []
+
+    groups: dict[tuple, list[int]] = {}
+    for idx, message in enumerate(messages):
+        key = (
+            _provider(message),
+            message["title"],
+            message["body"],
+            json.dumps(message["data"], sort_keys=True, default=str),
+        )
+        groups.setdefault(key, []).append(idx)
+
+    for key, indexes in groups.items():
+        provider = key[0]
+        size = _chunk_size(provider, len(indexes))
+        for start in range(0, len(indexes), size):
+            chunk = indexes[start:start + size]
+            future = _pool(provider).submit(
+                _send_group, provider, [messages[i] for i in chunk], senders[provider]
+            )
+            jobs.append((chunk, future))
+
+    for indexes, future in jobs:
+        for idx, outcome in zip(indexes, future.result()):
+            outcomes[idx] = outcome
+    return outcomes
+
+
+def record_deliveries(conn, messages: list[dict[str, Any]]) -> None:
+    """Insert push_deliveries rows for delivered messages in one statement."""
+    if not messages:
+        return
+    conn.execute(
+        text("""
+            INSERT INTO push_deliveries (notification_id, device_id, minecraft_username, server_name)
+            SELECT * FROM unnest(
+                CAST(:notification_ids AS BIGINT[]),
+                CAST(:device_ids AS TEXT[]),
+                CAST(:usernames AS TEXT[]),
+                CAST(:server_names AS TEXT[])
+            )
+            ON CONFLICT (notification_id, device_id) DO NOTHING
+        """),
+        {
+            "notification_ids": [m["notification_id"] for m in messages],
+            "device_ids": [m["device_id"] for m in messages],
+            "usernames": [m["username"] for m in messages],
+            "server_names": [m["server_name"] for m in messages],
+        },
+    )
+
+
+def remove_tokens(conn, messages: list[dict[str, Any]]) -> None:
+    """Delete the (device_id, token) pairs of rejected messages in one statement."""
+    if not messages:
+        return
+    conn.execute(
+        text("""
+            DELETE FROM push_device_tokens pdt
+            USING unnest(CAST(:device_ids AS TEXT[]), CAST(:tokens AS TEXT[])) AS bad(device_id, token)
+            WHERE pdt.device_id = bad.device_id AND pdt.token = bad.token
+        """),
+        {
+            "device_ids": [m["device_id"] for m in messages],
+            "tokens": [m["token"] for m in messages],
+        },
+    )
+
+
+def deliver(
+    messages: list[dict[str, Any]],
+    senders: dict[str, BatchSender] | None = None,
+    settle: Callable[[Any, list[dict[str, Any]], list[tuple[str, str | None]]], None] | None = None,
+) -> dict[str, Any]:
+    """
+    Send a batch and persist the results (deliveries and invalid-token removals)
+    in one transaction. Each message needs notification_id, server_name, device_id,
+    username, platform, token, title, body and data. settle(conn, messages,
+    outcomes), when given, runs in the same transaction (the scheduler uses it to
+    update its queue).
+    Returns counts of sent, invalid_token, failed and deferred messages, up to five
+    distinct error messages and elapsed ms.
+    """
+    started = time.perf_counter()
+    outcomes = send_all(messages, senders)
+    sent = [m for m, (outcome, _) in zip(messages, outcomes) if outcome == SENT]
+    invalid = [m for m, (outcome, _) in zip(messages, outcomes) if outcome == INVALID_TOKEN]
+    deferred = sum(1 for outcome, _ in outcomes if outcome == DEFERRED)
+    errors = list(dict.fromkeys(error for outcome, error in outcomes if outcome == FAILED and error))
+
+    if sent or invalid or settle is not None:
+        with engine.begin() as conn:
+            record_deliveries(conn, [m for m in sent if m.get("notification_id") is not None])
+            remove_tokens(conn, invalid)
+            if settle is not None:
+                settle(conn, messages, outcomes)
+
+    return {
+        SENT: len(sent),
+        INVALID_TOKEN: len(invalid),
+        FAILED: len(messages) - len(sent) - len(invalid) - deferred,
+        DEFERRED: deferred,
+        "errors": errors[:5],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
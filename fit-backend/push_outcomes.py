@@ -0,0 +1,8 @@
+"""Per-token push send outcomes shared by apns_service, fcm_service and push_delivery."""
+
+SENT = "sent"
+# The provider rejected the token as unregistered; push_delivery removes it
+INVALID_TOKEN = "invalid_token"
+FAILED = "failed"
+# Not attempted because the provider's circuit is open
+DEFERRED = "deferred"
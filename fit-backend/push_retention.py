@@ -0,0 +1,195 @@
+"""
+Retention for push delivery history.
+
+push_deliveries keeps one row per notification per device. Once a notification
+has completed and is older than PUSH_DELIVERY_RETENTION_DAYS its detail rows are
+no longer needed for dedup (the scheduler only consults them while fanning out),
+so run_push_retention_once() folds them into the notification's delivered_count,
+deletes them in chunks of PUSH_RETENTION_CHUNK_ROWS (one short transaction per
+chunk, so the scheduler and API are never blocked behind one long DELETE) and
+then stamps deliveries_compacted_at. A run interrupted before the stamp simply
+recounts next time; the count never goes down. Detail rows whose notification no
+longer exists are removed the same way. Each run is recorded in
+push_retention_runs (see GET /v1/admin/push/retention).
+"""
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy import text
+
+from database import engine, jobs_engine
+
+logger = logging.getLogger("push_retention")
+
+RETENTION_DAYS = int(os.getenv("PUSH_DELIVERY_RETENTION_DAYS", "30"))
+CHUNK_ROWS = int(os.getenv("PUSH_RETENTION_CHUNK_ROWS", "5000"))
+# Notifications compacted per transaction
+NOTIFICATION_BATCH = 100
+
+
+def _count_batch(cutoff: datetime) -> list[int]:
+    """Record aggregate counts for the next batch of expired notifications."""
+    with jobs_engine.begin() as conn:
+        return conn.execute(
+            text("""
+                WITH expired AS (
+                    SELECT id FROM push_notifications
+                    WHERE completed_at IS NOT NULL
+                      AND deliveries_compacted_at IS NULL
+                      AND scheduled_at < :cutoff
+                    ORDER BY scheduled_at ASC
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                ),
+                totals AS (
+                    SELECT e.id, COUNT(pd.id) AS delivered
+                    FROM expired e
+                    LEFT JOIN push_deliveries pd ON pd.notification_id = e.id
+                    GROUP BY e.id
+                )
+                UPDATE push_notifications pn
+                -- Notifications from before the delivery queue have no counts yet
+                SET delivered_count = GREATEST(pn.delivered_count, totals.delivered)
+                FROM totals
+                WHERE pn.id = totals.id
+                RETURNING pn.id
+            """),
+            {"cutoff": cutoff, "limit": NOTIFICATION_BATCH},
+        ).scalars().all()
+
+
+def _delete_chunked(where: str, params: dict[str, Any]) -> int:
+    deleted = 0
+    while True:
+        with jobs_engine.begin() as conn:
+            count = conn.execute(
+                text(f"""
+                    DELETE FROM push_deliveries
+                    WHERE id IN (
+                        SELECT id FROM push_deliveries
+                        WHERE {where}
+                        LIMIT :chunk
+                    )
+                """),
+                {**params, "chunk": CHUNK_ROWS},
+            ).rowcount
+        deleted += count
+        if count < CHUNK_ROWS:
+            return deleted
+
+
+def _delete_orphans(cutoff: datetime) -> int:
+    """
+    Delete expired detail rows whose notification no longer exists. Walks the table
+    once in id order, CHUNK_ROWS rows per transaction: re-running a LIMIT query
+    would rescan every kept row on each chunk.
+    """
+    deleted = 0
+    after_id = 0
+    while True:
+        with jobs_engine.begin() as conn:
+            row = conn.execute(
+                text("""
+                    WITH page AS (
+                        SELECT id, notification_id, delivered_at FROM push_deliveries
+                        WHERE id > :after_id
+                        ORDER BY id
+                        LIMIT :chunk
+                    ),
+                    orphans AS (
+                        DELETE FROM push_deliveries pd
+                        USING page
+                        WHERE pd.id = page.id
+                          AND page.delivered_at < :cutoff
+                          AND NOT EXISTS (
+                              SELECT 1 FROM push_notifications pn WHERE pn.id = page.notification_id
+                          )
+                        RETURNING pd.id
+                    )
+                    SELECT (SELECT MAX(id) FROM page) AS last_id, (SELECT COUNT(*) FROM orphans) AS deleted
+                """),
+                {"after_id": after_id, "cutoff": cutoff, "chunk": CHUNK_ROWS},
+            ).mappings().one()
+        if row["last_id"] is None:
+            return deleted
+        deleted += row["deleted"]
+        after_id = row["last_id"]
+
+
+def run_push_retention_once(retention_days: int | None = None) -> dict[str, Any]:
+    """Compact and delete expired delivery rows. Returns (and records) the run's counts."""
+    days = RETENTION_DAYS if retention_days is None else retention_days
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    cutoff = started_at - timedelta(days=days)
+
+    notifications = 0
+    rows_deleted = 0
+    while True:
+        ids = list(_count_batch(cutoff))
+        if not ids:
+            break
+        rows_deleted += _delete_chunked("notification_id = ANY(CAST(:ids AS BIGINT[]))", {"ids": ids})
+        with jobs_engine.begin() as conn:
+            conn.execute(
+                text("""
+                    UPDATE push_notifications SET deliveries_compacted_at = NOW()
+                    WHERE id = ANY(CAST(:ids AS BIGINT[]))
+                """),
+                {"ids": ids},
+            )
+        notifications += len(ids)
+
+    orphan_rows_deleted = _delete_orphans(cutoff)
+
+    result = {
+        "retention_days": days,
+        "cutoff": cutoff.isoformat(),
+        "notifications_compacted": notifications,
+        "rows_deleted": rows_deleted,
+        "orphan_rows_deleted": orphan_rows_deleted,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+    with jobs_engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO push_retention_runs
+                    (started_at, finished_at, retention_days, notifications_compacted,
+                     rows_deleted, orphan_rows_deleted)
+                VALUES (:started_at, NOW(), :days, :notifications, :rows_deleted, :orphans)
+            """),
+            {
+                "started_at": started_at,
+                "days": days,
+                "notifications": notifications,
+                "rows_deleted": rows_deleted,
+                "orphans": orphan_rows_deleted,
+            },
+        )
+    logger.info(
+        "Push retention: compacted %s notifications, deleted %s delivery rows (+%s orphaned) in %sms",
+        notifications,
+        rows_deleted,
+        orphan_rows_deleted,
+        result["elapsed_ms"],
+    )
+    return result
+
+
+def recent_runs(limit: int = 20) -> list[dict[str, Any]]:
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT started_at, finished_at, retention_days, notifications_compacted,
+                       rows_deleted, orphan_rows_deleted
+                FROM push_retention_runs
+                ORDER BY id DESC
+                LIMIT :limit
+            """),
+            {"limit": limit},
+        ).mappings().all()
+    return [dict(row) for row in rows]
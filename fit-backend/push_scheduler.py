@@ -1,187 +1,691 @@
+"""
+Scheduled push delivery process (run by supervisord).
+
+Delivery runs in two stages. When a notification becomes due it is fanned out
+exactly once: one push_delivery_queue row per target device token (not yet
+delivered), after which the notification is marked fanned_out_at and never
+scanned again. While APNs is not configured its iOS targets are held back
+(ios_fanout_pending) and queued by the first pass after it is. Send-now jobs
+(enqueue_send_now) skip this stage: the API queues their targets directly.
+Batches are then popped from the queue: delivered and invalid-token rows are
+deleted, failed rows are retried with exponential backoff up to
+PUSH_MAX_ATTEMPTS. Progress is counted on the notification, which is marked
+completed_at when its last queue row is gone and no iOS targets are held back.
+Scheduler cost therefore follows pending work, not the size of push_deliveries.
+
+Several scheduler processes can run against Postgres: each claims batches
+with SELECT ... FOR UPDATE SKIP LOCKED and leases them by stamping leased_by and
+pushing next_attempt_at PUSH_WORKER_LEASE_SECONDS ahead, so a crashed worker's
+rows simply become due again and are picked up by the others. A worker only
+settles rows it still holds. The queue relies on Postgres (row locks, arrays,
+NOTIFY); on SQLite the scheduler logs an error and exits with status 2.
+
+Instead of polling, the scheduler sleeps until the next notification's
+scheduled_at or the next queued retry. schedule_push_notification and
+enqueue_send_now publish on NOTIFY_CHANNEL in the transaction that inserts a
+row (Postgres delivers it on commit), which wakes it early. An idle wakeup
+costs two indexed lookups.
+
+Sends go through a circuit breaker per provider (circuit_breaker.py). While
+APNs or FCM is down its rows come back deferred and are parked until the next
+probe without spending an attempt, so the other platform keeps draining.
+"""
+
 import os
-import time
+import json
+import socket
+import sys
 import logging
-from datetime import datetime, timezone
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
-from database import engine
-from apns_service import (
-    ApnsConfigError,
-    APNsException,
-    Unregistered,
-    apns_use_sandbox,
-    format_apns_exception,
-    send_push,
-)
-from apns2.errors import BadDeviceToken
-from fcm_service import (
-    FcmConfigError,
-    FirebaseError,
-    format_fcm_exception,
-    is_unregistered_fcm_error,
-    send_fcm_push,
-)
+from database import engine, IS_SQLITE
+from apns_service import ApnsConfigError, apns_use_sandbox
+from audit import log_audit_event
+import notify_listener
+import push_delivery
 
 logger = logging.getLogger("push_scheduler")
 
+# Notifications expanded into the queue per fan-out statement
+FANOUT_BATCH = int(os.getenv("PUSH_FANOUT_BATCH", "50"))
+# Exit status when the database cannot run the queue (see supervisord.conf)
+EXIT_UNSUPPORTED_DATABASE = 2
+# Sends per device before a failing queue row is dropped (counted as failed)
+MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", "5"))
+# How long a claimed batch is held before other workers may reclaim it; must
+# comfortably exceed the time to send one batch
+LEASE_SECONDS = int(os.getenv("PUSH_WORKER_LEASE_SECONDS", "120"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# push_notifications.kind: scheduled announcements are fanned out when due; send-now
+# jobs are queued by the API with their targets (audited when the server's job
+# completes)
+KIND_SCHEDULED = "scheduled"
+KIND_SEND_NOW = "send_now"
+KIND_PLAYER_SEND = "player_send"
+
+# Channel the API publishes on after adding work so the scheduler wakes early
+NOTIFY_CHANNEL = "push_scheduled"
+
+_wakeup = threading.Event()
+
+
+def notify_scheduled(notification_id: int, scheduled_at: datetime, conn: Connection | None = None) -> None:
+    """
+    Wake the scheduler process(es) after a new notification has committed (or,
+    with conn, when the transaction that inserted it commits).
+    """
+    notify_listener.publish(
+        NOTIFY_CHANNEL,
+        {"notification_id": notification_id, "scheduled_at": scheduled_at.isoformat()},
+        conn,
+    )
+
+
+def enqueue_send_now(
+    server_name: str,
+    kind: str,
+    title: str,
+    body: str,
+    data: dict,
+    targets: list[tuple[str, str, str]],
+    created_by: int | None = None,
+    conn: Connection | None = None,
+) -> int:
+    """
+    Queue an immediate push to (device_id, platform, token) targets as a job (a
+    push_notifications row that is already fanned out) and wake the scheduler.
+    Returns the job id; progress is on the row (see GET /v1/servers/push/jobs/{id}).
+    With conn the job joins conn's transaction and the wake-up is sent when it commits.
+    """
+    if conn is None:
+        with engine.begin() as own_conn:
+            return enqueue_send_now(server_name, kind, title, body, data, targets, created_by, own_conn)
+
+    job_id = conn.execute(
+        text("""
+            INSERT INTO push_notifications
+                (server_name, message, scheduled_at, scheduled_date, created_by,
+                 kind, title, data_json, fanned_out_at, target_count)
+            VALUES
+                (:server, :message, NOW(), CURRENT_DATE, :created_by,
+                 :kind, :title, :data_json, NOW(), 0)
+            RETURNING id
+        """),
+        {
+            "server": server_name,
+            "message": body,
+            "created_by": created_by,
+            "kind": kind,
+            "title": title,
+            "data_json": json.dumps(data),
+        },
+    ).scalar_one()
+    queued = conn.execute(
+        text("""
+            INSERT INTO push_delivery_queue
+                (notification_id, server_name, device_id, platform, token, minecraft_username)
+            SELECT
+                :job_id,
+                :server,
+                t.device_id,
+                t.platform,
+                t.token,
+                COALESCE(pk.minecraft_username, 'unknown')
+            FROM unnest(
+                CAST(:device_ids AS TEXT[]),
+                CAST(:platforms AS TEXT[]),
+                CAST(:tokens AS TEXT[])
+            ) AS t(device_id, platform, token)
+            LEFT JOIN player_keys pk
+              ON pk.device_id = t.device_id
+             AND pk.server_name = :server
+             AND pk.active = TRUE
+            ON CONFLICT (notification_id, device_id, token) DO NOTHING
+        """),
+        {
+            "job_id": job_id,
+            "server": server_name,
+            "device_ids": [t[0] for t in targets],
+            "platforms": [t[1] for t in targets],
+            "tokens": [t[2] for t in targets],
+        },
+    ).rowcount
+    conn.execute(
+        text("UPDATE push_notifications SET target_count = :count WHERE id = :id"),
+        {"count": queued, "id": job_id},
+    )
+    notify_listener.publish(NOTIFY_CHANNEL, {"notification_id": job_id}, conn)
+    return job_id
+
+
+def _wake(_payload=None) -> None:
+    _wakeup.set()
+
+
+def _as_utc(value) -> datetime | None:
+    if value is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def has_pending_work(now: datetime) -> bool:
+    """
+    Whether a notification is waiting for fan-out (including held-back iOS targets
+    once APNs is configured) or a queued send is due.
+    """
+    try:
+        apns_use_sandbox()
+        apns_configured = True
+    except ApnsConfigError:
+        apns_configured = False
+    with engine.begin() as conn:
+        due = conn.execute(
+            text("""
+                SELECT 1 FROM push_notifications
+                WHERE (fanned_out_at IS NULL AND scheduled_at <= :now)
+                   OR (ios_fanout_pending AND :apns_configured)
+                LIMIT 1
+            """),
+            {"now": now, "apns_configured": apns_configured},
+        ).first()
+        if due is not None:
+            return True
+        return conn.execute(
+            text("SELECT 1 FROM push_delivery_queue WHERE next_attempt_at <= :now LIMIT 1"),
+            {"now": now},
+        ).first() is not None
+
+
+def next_wakeup_at() -> datetime | None:
+    """Earliest scheduled_at awaiting fan-out or queued retry, if any."""
+    with engine.begin() as conn:
+        scheduled = conn.execute(
+            text("SELECT MIN(scheduled_at) FROM push_notifications WHERE fanned_out_at IS NULL")
+        ).scalar()
+        retry = conn.execute(text("SELECT MIN(next_attempt_at) FROM push_delivery_queue")).scalar()
+    candidates = [value for value in (_as_utc(scheduled), _as_utc(retry)) if value is not None]
+    return min(candidates) if candidates else None
+
 
 def run_push_scheduler() -> None:
     enabled = os.getenv("ENABLE_PUSH_SCHEDULER", "true").lower() in {"1", "true", "yes"}
     if not enabled:
         logger.info("Push scheduler disabled")
         return
+    if IS_SQLITE:
+        logger.error("Push scheduler requires Postgres (DATABASE_URL is SQLite); not starting")
+        # Listed in supervisord.conf exitcodes, so it is not restarted
+        sys.exit(EXIT_UNSUPPORTED_DATABASE)
 
+    # Base retry delay for failed sends
     interval = int(os.getenv("PUSH_SCHEDULER_INTERVAL_SECONDS", "30"))
-    logger.info("Push scheduler active (interval=%ss)", interval)
+    # Upper bound on an idle sleep, in case a wakeup is missed
+    max_sleep = int(os.getenv("PUSH_SCHEDULER_MAX_SLEEP_SECONDS", "300"))
+    notify_listener.register(NOTIFY_CHANNEL, _wake, _wake)
+    notify_listener.start()
+    logger.info(
+        "Push scheduler %s active (retry interval=%ss, max sleep=%ss, lease=%ss)",
+        WORKER_ID,
+        interval,
+        max_sleep,
+        LEASE_SECONDS,
+    )
 
     while True:
+        _wakeup.clear()
+        timeout = float(max_sleep)
         try:
-            run_push_once()
+            if has_pending_work(datetime.now(timezone.utc)):
+                run_push_until_drained()
+            next_at = next_wakeup_at()
+            if next_at is not None:
+                timeout = min(timeout, (next_at - datetime.now(timezone.utc)).total_seconds())
         except Exception:
             logger.exception("Push scheduler run failed")
-        time.sleep(interval)
+            timeout = min(timeout, interval)
+        _wakeup.wait(max(0.0, timeout))
+
+
+def run_push_until_drained(senders: dict | None = None) -> int:
+    """
+    Fan out every due notification, then pop batches back to back until no queued
+    send is due, so a large announcement drains in one pass. Failed sends are
+    rescheduled by the queue and do not stop the pass.
+    Returns the number of queue rows resolved.
+    """
+    limit = int(os.getenv("PUSH_SCHEDULER_BATCH", "200"))
+    total = 0
+    while True:
+        selected, resolved = run_push_once(senders)
+        total += resolved
+        if selected < limit:
+            return total
+
+
+def run_push_once(senders: dict | None = None) -> tuple[int, int]:
+    """
+    Fan out due notifications and deliver one batch from the queue.
+    Returns (rows selected, rows resolved); resolved rows were delivered or had their
+    token removed and have left the queue.
+    """
+    now = datetime.now(timezone.utc)
+    while fan_out_due(now) == FANOUT_BATCH:
+        pass
+
+    messages = load_due_messages(int(os.getenv("PUSH_SCHEDULER_BATCH", "200")))
+    if not messages:
+        return 0, 0
+    selected = len(messages)
+
+    completed: list[dict] = []
+    # Out of attempts through expired leases alone: drop without sending again
+    exhausted = [m for m in messages if m["attempts"] >= MAX_ATTEMPTS]
+    if exhausted:
+        messages = [m for m in messages if m["attempts"] < MAX_ATTEMPTS]
+        with engine.begin() as conn:
+            completed.extend(
+                settle_queue(conn, exhausted, [(push_delivery.FAILED, "lease expired")] * len(exhausted))
+            )
+        logger.warning("Dropped %s queued sends whose leases kept expiring", len(exhausted))
+
+    resolved = 0
+    if messages:
+        result = push_delivery.deliver(
+            messages,
+            senders,
+            settle=lambda conn, batch, outcomes: completed.extend(settle_queue(conn, batch, outcomes)),
+        )
+        logger.info(
+            "Push batch: %s sent, %s invalid tokens removed, %s failed, %s deferred in %sms",
+            result["sent"],
+            result["invalid_token"],
+            result["failed"],
+            result["deferred"],
+            result["elapsed_ms"],
+        )
+        resolved = result["sent"] + result["invalid_token"]
+    for job in completed:
+        if job["kind"] == KIND_SEND_NOW:
+            _log_send_now_completed(job)
+    return selected, resolved
 
 
-def run_push_once() -> None:
-    target_sandbox: bool | None = None
+def fan_out_due(now: datetime) -> int:
+    """
+    Expand up to FANOUT_BATCH due notifications into push_delivery_queue and mark
+    them fanned out. Targets are the server's device tokens registered before
+    scheduled_at without a delivery row; iOS tokens only when they match the APNs
+    environment. While APNs is not configured the iOS targets are held back: the
+    notification is flagged ios_fanout_pending and stays incomplete until
+    fan_out_pending_ios queues them.
+    Returns the number of notifications expanded.
+    """
+    target_sandbox = _apns_sandbox()
+    if target_sandbox is not None:
+        while fan_out_pending_ios(target_sandbox) == FANOUT_BATCH:
+            pass
+
+    with engine.begin() as conn:
+        ids = conn.execute(
+            text("""
+                SELECT id FROM push_notifications
+                WHERE fanned_out_at IS NULL AND scheduled_at <= :now
+                ORDER BY scheduled_at ASC, id ASC
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            """),
+            {"now": now, "limit": FANOUT_BATCH},
+        ).scalars().all()
+        if not ids:
+            return 0
+
+        _queue_targets(conn, list(ids), target_sandbox, include_android=True)
+
+        conn.execute(
+            text("""
+                UPDATE push_notifications pn
+                SET fanned_out_at = :now,
+                    target_count = queued.count,
+                    ios_fanout_pending = queued.ios_pending,
+                    completed_at = CASE WHEN queued.count = 0 AND NOT queued.ios_pending THEN :now END
+                FROM (
+                    SELECT
+                        n.id,
+                        (SELECT COUNT(*) FROM push_delivery_queue q WHERE q.notification_id = n.id) AS count,
+                        (
+                            CAST(:sandbox AS BOOLEAN) IS NULL
+                            AND EXISTS (
+                                SELECT 1
+                                FROM push_notifications p
+                                JOIN push_device_tokens pdt
+                                  ON pdt.server_name = p.server_name
+                                 AND pdt.platform = 'ios'
+                                 AND p.scheduled_at >= pdt.created_at
+                                WHERE p.id = n.id
+                            )
+                        ) AS ios_pending
+                    FROM unnest(CAST(:ids AS BIGINT[])) AS n(id)
+                ) AS queued
+                WHERE pn.id = queued.id
+            """),
+            {"ids": list(ids), "now": now, "sandbox": target_sandbox},
+        )
+
+    logger.info("Fanned out %s notification(s)", len(ids))
+    return len(ids)
+
+
+def fan_out_pending_ios(target_sandbox: bool) -> int:
+    """
+    Queue the iOS targets of up to FANOUT_BATCH notifications that were fanned out
+    while APNs was not configured, and complete those left with nothing queued.
+    Returns the number of notifications handled.
+    """
+    with engine.begin() as conn:
+        ids = conn.execute(
+            text("""
+                SELECT id FROM push_notifications
+                WHERE ios_fanout_pending
+                ORDER BY id ASC
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            """),
+            {"limit": FANOUT_BATCH},
+        ).scalars().all()
+        if not ids:
+            return 0
+
+        queued = Counter(_queue_targets(conn, list(ids), target_sandbox, include_android=False))
+        conn.execute(
+            text("""
+                UPDATE push_notifications pn
+                SET ios_fanout_pending = FALSE,
+                    target_count = pn.target_count + added.count,
+                    completed_at = CASE
+                        WHEN pn.completed_at IS NULL
+                         AND NOT EXISTS (SELECT 1 FROM push_delivery_queue q WHERE q.notification_id = pn.id)
+                        THEN NOW()
+                        ELSE pn.completed_at
+                    END
+                FROM unnest(CAST(:ids AS BIGINT[]), CAST(:counts AS INTEGER[])) AS added(id, count)
+                WHERE pn.id = added.id
+            """),
+            {"ids": list(ids), "counts": [queued[i] for i in ids]},
+        )
+
+    logger.info("Queued held-back iOS targets for %s notification(s)", len(ids))
+    return len(ids)
+
+
+def _apns_sandbox() -> bool | None:
+    """The APNs environment iOS tokens must match, or None while APNs is not configured."""
     try:
-        target_sandbox = apns_use_sandbox()
+        return apns_use_sandbox()
     except ApnsConfigError as e:
-        logger.warning("APNs config error (iOS pushes disabled): %s", e)
+        logger.warning("APNs config error (iOS pushes held back): %s", e)
+        return None
+
 
+def _queue_targets(conn, ids: list[int], target_sandbox: bool | None, include_android: bool) -> list[int]:
+    """Insert queue rows for the notifications' targets; returns the notification id of each row added."""
+    return conn.execute(
+        text("""
+            INSERT INTO push_delivery_queue
+                (notification_id, server_name, device_id, platform, token, minecraft_username)
+            SELECT
+                pn.id,
+                pn.server_name,
+                pdt.device_id,
+                LOWER(pdt.platform),
+                pdt.token,
+                COALESCE(pk.minecraft_username, 'unknown')
+            FROM push_notifications pn
+            JOIN push_device_tokens pdt
+              ON pdt.server_name = pn.server_name
+            LEFT JOIN player_keys pk
+              ON pk.device_id = pdt.device_id
+             AND pk.server_name = pn.server_name
+             AND pk.active = TRUE
+            WHERE pn.id = ANY(CAST(:ids AS BIGINT[]))
+              AND pn.scheduled_at >= pdt.created_at
+              AND (
+                    (pdt.platform = 'ios' AND :sandbox IS NOT NULL AND pdt.sandbox = :sandbox)
+                 OR (pdt.platform = 'android' AND :include_android)
+              )
+              AND NOT EXISTS (
+                    SELECT 1 FROM push_deliveries pd
+                    WHERE pd.notification_id = pn.id
+                      AND pd.device_id = pdt.device_id
+              )
+            ON CONFLICT (notification_id, device_id, token) DO NOTHING
+            RETURNING notification_id
+        """),
+        {"ids": ids, "sandbox": target_sandbox, "include_android": include_android},
+    ).scalars().all()
+
+
+def load_due_messages(limit: int) -> list[dict]:
+    """
+    Claim up to limit due queue rows for this worker and return them as
+    push_delivery messages (carrying queue_id). Rows locked by another worker's
+    claim are skipped; claimed rows stay leased for LEASE_SECONDS. Reclaiming a
+    row whose lease expired counts as an attempt, so a send that keeps killing
+    its worker still reaches PUSH_MAX_ATTEMPTS.
+    """
     now = datetime.now(timezone.utc)
-    limit = int(os.getenv("PUSH_SCHEDULER_BATCH", "200"))
     default_title = os.getenv("PUSH_DEFAULT_TITLE", "StepCraft")
 
     with engine.begin() as conn:
         rows = conn.execute(
             text(
                 """
+                WITH claimed AS (
+                    UPDATE push_delivery_queue
+                    SET leased_by = :worker,
+                        next_attempt_at = :lease_until,
+                        -- Still leased: the previous holder never settled it (crashed
+                        -- or hung mid-send), which costs an attempt like a failure
+                        attempts = attempts + CASE WHEN leased_by IS NULL THEN 0 ELSE 1 END
+                    WHERE id IN (
+                        SELECT id FROM push_delivery_queue
+                        WHERE next_attempt_at <= :now
+                        ORDER BY next_attempt_at ASC, id ASC
+                        LIMIT :limit
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, attempts, notification_id, server_name, device_id,
+                              platform, token, minecraft_username
+                )
                 SELECT
-                    pn.id,
-                    pn.server_name,
+                    claimed.id AS queue_id,
+                    claimed.attempts,
+                    claimed.notification_id,
+                    claimed.server_name,
+                    claimed.device_id,
+                    claimed.platform,
+                    claimed.token,
+                    claimed.minecraft_username,
                     pn.message,
                     pn.scheduled_at,
-                    pdt.device_id,
-                    pdt.platform,
-                    pdt.token,
-                    pdt.sandbox,
-                    COALESCE(pk.minecraft_username, 'unknown') AS minecraft_username
-                FROM push_notifications pn
-                JOIN push_device_tokens pdt
-                  ON pdt.server_name = pn.server_name
-                LEFT JOIN player_keys pk
-                  ON pk.device_id = pdt.device_id
-                 AND pk.server_name = pn.server_name
-                 AND pk.active = TRUE
-                LEFT JOIN push_deliveries pd
-                  ON pd.notification_id = pn.id
-                 AND pd.device_id = pdt.device_id
-                WHERE pn.scheduled_at <= :now
-                  AND pn.scheduled_at >= pdt.created_at
-                  AND pd.id IS NULL
-                  AND (
-                        (pdt.platform = 'ios' AND :sandbox IS NOT NULL AND pdt.sandbox = :sandbox)
-                     OR (pdt.platform = 'android')
-                  )
-                ORDER BY pn.scheduled_at ASC
-                LIMIT :limit
+                    pn.title,
+                    pn.data_json
+                FROM claimed
+                JOIN push_notifications pn
+                  ON pn.id = claimed.notification_id
+                ORDER BY claimed.id ASC
                 """
             ),
-            {"now": now, "sandbox": target_sandbox, "limit": limit},
+            {
+                "now": now,
+                "lease_until": now + timedelta(seconds=LEASE_SECONDS),
+                "worker": WORKER_ID,
+                "limit": limit,
+            },
         ).mappings().all()
 
-    if not rows:
-        return
-
+    messages = []
     for row in rows:
-        token = row["token"]
-        device_id = row["device_id"]
         server_name = row["server_name"]
-        platform = str(row["platform"] or "").lower()
-        username = row["minecraft_username"]
-        title = default_title
-        if server_name and server_name.lower() not in default_title.lower():
+        # Send-now jobs carry their own title and data
+        title = row["title"] or default_title
+        if not row["title"] and server_name and server_name.lower() not in default_title.lower():
             title = f"{default_title} • {server_name}"
+        if row["data_json"]:
+            data = json.loads(row["data_json"])
+        else:
+            data = {
+                "server_name": server_name,
+                "notification_id": row["notification_id"],
+                "scheduled_at": row["scheduled_at"].isoformat() if row["scheduled_at"] else None,
+            }
 
-        payload_data = {
+        messages.append({
+            "queue_id": row["queue_id"],
+            "attempts": row["attempts"],
+            "notification_id": row["notification_id"],
             "server_name": server_name,
-            "notification_id": row["id"],
-            "scheduled_at": row["scheduled_at"].isoformat() if row["scheduled_at"] else None,
-        }
+            "device_id": row["device_id"],
+            "username": row["minecraft_username"],
+            "platform": row["platform"],
+            "token": row["token"],
+            "title": title,
+            "body": row["message"],
+            "data": data,
+        })
+    return messages
 
-        try:
-            if platform == "android":
-                send_fcm_push(token, title, row["message"], payload_data)
-            else:
-                send_push(token, title, row["message"], payload_data)
-        except (Unregistered, BadDeviceToken):
-            logger.info("Invalid APNs token for device %s on %s; removing", device_id, server_name)
-            with engine.begin() as conn:
-                conn.execute(
-                    text(
-                        """
-                        DELETE FROM push_device_tokens
-                        WHERE device_id = :device_id AND token = :token
-                        """
-                    ),
-                    {"device_id": device_id, "token": token},
-                )
-            continue
-        except FirebaseError as e:
-            if is_unregistered_fcm_error(e):
-                logger.info("Invalid FCM token for device %s on %s; removing", device_id, server_name)
-                with engine.begin() as conn:
-                    conn.execute(
-                        text(
-                            """
-                            DELETE FROM push_device_tokens
-                            WHERE device_id = :device_id AND token = :token
-                            """
-                        ),
-                        {"device_id": device_id, "token": token},
-                    )
-                continue
-            logger.warning(
-                "FCM error for %s/%s: %s",
-                server_name,
-                device_id,
-                format_fcm_exception(e),
-                exc_info=True,
-            )
-            continue
-        except FcmConfigError as e:
-            logger.warning("FCM config error: %s", e)
-            continue
-        except APNsException as e:
-            logger.warning(
-                "APNs error for %s/%s: %s",
-                server_name,
-                device_id,
-                format_apns_exception(e),
-                exc_info=True,
-            )
-            continue
-        except Exception:
-            logger.exception("Push send failed for %s/%s", server_name, device_id)
-            continue
 
-        with engine.begin() as conn:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO push_deliveries (notification_id, device_id, minecraft_username, server_name)
-                    VALUES (:notification_id, :device_id, :username, :server)
-                    ON CONFLICT (notification_id, device_id) DO NOTHING
-                    """
-                ),
-                {
-                    "notification_id": row["id"],
-                    "device_id": device_id,
-                    "username": username,
-                    "server": server_name,
-                },
-            )
+def settle_queue(conn, messages: list[dict], outcomes: list[tuple[str, str | None]]) -> list[dict]:
+    """
+    Apply a batch's outcomes to the queue (push_delivery.deliver settle hook):
+    remove resolved rows, back off or drop failed ones, park deferred ones (provider
+    circuit open) until the circuit's next probe without spending an attempt,
+    update per-notification counts and complete notifications with nothing left
+    queued. Only rows this
+    worker still leases are touched; a row whose lease expired and was reclaimed
+    is left to the worker that holds it now.
+    Returns the notifications this call completed.
+    """
+    retry_base = int(os.getenv("PUSH_SCHEDULER_INTERVAL_SECONDS", "30"))
+    outcome_by_id: dict[int, str] = {}
+    done: list[int] = []
+    retry: list[int] = []
+    deferred: list[int] = []
+    deferred_secs: list[float] = []
+    for message, (outcome, _) in zip(messages, outcomes):
+        if outcome == push_delivery.DEFERRED:
+            deferred.append(message["queue_id"])
+            deferred_secs.append(max(1.0, push_delivery.retry_after(message)))
+        elif outcome == push_delivery.FAILED and message["attempts"] + 1 < MAX_ATTEMPTS:
+            retry.append(message["queue_id"])
+        else:
+            done.append(message["queue_id"])
+            outcome_by_id[message["queue_id"]] = outcome
+
+    settled: list[int] = []
+    if done:
+        settled = conn.execute(
+            text("""
+                DELETE FROM push_delivery_queue
+                WHERE id = ANY(CAST(:ids AS BIGINT[])) AND leased_by = :worker
+                RETURNING id
+            """),
+            {"ids": done, "worker": WORKER_ID},
+        ).scalars().all()
+    if retry:
+        conn.execute(
+            text("""
+                UPDATE push_delivery_queue
+                SET attempts = attempts + 1,
+                    leased_by = NULL,
+                    next_attempt_at = NOW() + make_interval(secs => :base * POWER(2, attempts))
+                WHERE id = ANY(CAST(:ids AS BIGINT[])) AND leased_by = :worker
+            """),
+            {"ids": retry, "base": retry_base, "worker": WORKER_ID},
+        )
+    if deferred:
+        conn.execute(
+            text("""
+                UPDATE push_delivery_queue q
+                SET leased_by = NULL,
+                    next_attempt_at = NOW() + make_interval(secs => d.secs)
+                FROM unnest(CAST(:ids AS BIGINT[]), CAST(:secs AS DOUBLE PRECISION[])) AS d(id, secs)
+                WHERE q.id = d.id AND q.leased_by = :worker
+            """),
+            {"ids": deferred, "secs": deferred_secs, "worker": WORKER_ID},
+        )
+
+    notification_by_id = {m["queue_id"]: m["notification_id"] for m in messages}
+    counts: dict[int, Counter] = {notification_id: Counter() for notification_id in notification_by_id.values()}
+    for queue_id in settled:
+        counts[notification_by_id[queue_id]][outcome_by_id[queue_id]] += 1
+
+    # Locks the notification rows, so concurrent workers finishing the same
+    # notification run the completion check one after the other
+    ids = list(counts)
+    conn.execute(
+        text("""
+            UPDATE push_notifications pn
+            SET delivered_count = pn.delivered_count + c.delivered,
+                removed_count = pn.removed_count + c.removed,
+                failed_count = pn.failed_count + c.failed
+            FROM unnest(
+                CAST(:ids AS BIGINT[]),
+                CAST(:delivered AS INTEGER[]),
+                CAST(:removed AS INTEGER[]),
+                CAST(:failed AS INTEGER[])
+            ) AS c(id, delivered, removed, failed)
+            WHERE pn.id = c.id
+        """),
+        {
+            "ids": ids,
+            "delivered": [counts[i][push_delivery.SENT] for i in ids],
+            "removed": [counts[i][push_delivery.INVALID_TOKEN] for i in ids],
+            "failed": [counts[i][push_delivery.FAILED] for i in ids],
+        },
+    )
+    return [
+        dict(row)
+        for row in conn.execute(
+            text("""
+                UPDATE push_notifications pn
+                SET completed_at = NOW()
+                WHERE pn.id = ANY(CAST(:ids AS BIGINT[]))
+                  AND pn.completed_at IS NULL
+                  AND NOT pn.ios_fanout_pending
+                  AND NOT EXISTS (SELECT 1 FROM push_delivery_queue q WHERE q.notification_id = pn.id)
+                RETURNING id, kind, server_name, created_by, title, message,
+                          target_count, delivered_count, removed_count, failed_count
+            """),
+            {"ids": ids},
+        ).mappings()
+    ]
+
+
+def _log_send_now_completed(job: dict) -> None:
+    try:
+        log_audit_event(
+            server_name=job["server_name"],
+            actor_user_id=job["created_by"],
+            action="push_sent_now",
+            summary="Sent push notification",
+            details={
+                "job_id": job["id"],
+                "title": job["title"],
+                "body": job["message"],
+                "tokens": job["target_count"],
+                "sent": job["delivered_count"],
+                "failed": job["removed_count"] + job["failed_count"],
+            },
+        )
+    except Exception:
+        logger.exception("Failed to write audit event for push job %s", job["id"])
 
 
 if __name__ == "__main__":
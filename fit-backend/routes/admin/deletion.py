@@ -5,6 +5,8 @@ from sqlalchemy import text
 
 from database import engine
 from auth import require_master_admin
+import cascade_delete
+import push_retention
 
 router = APIRouter()
 
@@ -21,9 +23,9 @@ def admin_delete_player(
     
     Parameters:
     - server_name: Server to delete from
-    - minecraft_username: Player username to delete
+    - minecraft_username: Player username to delete (any case)
     
-    Returns deletion summary with number of records removed.
+    Returns deletion summary with number of records removed per table.
     """
     
     if not minecraft_username or len(minecraft_username.strip()) == 0:
@@ -33,74 +35,25 @@ def admin_delete_player(
         raise HTTPException(status_code=400, detail="server_name cannot be empty")
     
     try:
-        with engine.begin() as conn:
-            # Check if player exists on this server (in any table)
-            exists = conn.execute(
-                text("""
-                    SELECT
-                        (SELECT COUNT(*) FROM step_ingest WHERE server_name = :server_name AND LOWER(minecraft_username) = LOWER(:minecraft_username)) AS ingest_count,
-                        (SELECT COUNT(*) FROM player_keys WHERE server_name = :server_name AND LOWER(minecraft_username) = LOWER(:minecraft_username)) AS keys_count,
-                        (SELECT COUNT(*) FROM step_claims WHERE server_name = :server_name AND LOWER(minecraft_username) = LOWER(:minecraft_username)) AS claims_count,
-                        (SELECT COUNT(*) FROM bans WHERE server_name = :server_name AND LOWER(minecraft_username) = LOWER(:minecraft_username)) AS bans_count
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).fetchone()
-
-            if not exists or sum(exists) == 0:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"Player '{minecraft_username}' not found on server '{server_name}'"
-                )
-
-            deleted = {"step_ingest": 0, "player_keys": 0, "step_claims": 0, "bans": 0}
-
-            deleted["step_claims"] = conn.execute(
-                text("""
-                    DELETE FROM step_claims
-                    WHERE server_name = :server_name
-                    AND LOWER(minecraft_username) = LOWER(:minecraft_username)
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).rowcount
-
-            deleted["step_ingest"] = conn.execute(
-                text("""
-                    DELETE FROM step_ingest
-                    WHERE server_name = :server_name
-                    AND LOWER(minecraft_username) = LOWER(:minecraft_username)
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).rowcount
-
-            deleted["player_keys"] = conn.execute(
-                text("""
-                    DELETE FROM player_keys
-                    WHERE server_name = :server_name
-                    AND LOWER(minecraft_username) = LOWER(:minecraft_username)
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).rowcount
+        players = cascade_delete.resolve_players(minecraft_username, server_name)
+        if not players:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Player '{minecraft_username}' not found on server '{server_name}'"
+            )
 
-            deleted["bans"] = conn.execute(
-                text("""
-                    DELETE FROM bans
-                    WHERE server_name = :server_name
-                    AND LOWER(minecraft_username) = LOWER(:minecraft_username)
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).rowcount
+        deleted = cascade_delete.wipe_players(players)
+        total = sum(deleted.values())
 
-            total = sum(deleted.values())
-
-            return {
-                "ok": True,
-                "action": "admin_deleted_player",
-                "server_name": server_name,
-                "minecraft_username": minecraft_username,
-                "deleted": deleted,
-                "rows_deleted": total,
-                "message": f"Deleted {total} record(s) for '{minecraft_username}' on server '{server_name}'"
-            }
+        return {
+            "ok": True,
+            "action": "admin_deleted_player",
+            "server_name": server_name,
+            "minecraft_username": minecraft_username,
+            "deleted": deleted,
+            "rows_deleted": total,
+            "message": f"Deleted {total} record(s) for '{minecraft_username}' on server '{server_name}'"
+        }
     
     except HTTPException:
         raise
@@ -108,7 +61,7 @@ def admin_delete_player(
         raise HTTPException(status_code=500, detail=f"Failed to delete player: {str(e)}")
 
 
-@router.delete("/v1/admin/servers/{server_name}/players")
+@router.delete("/v1/admin/servers/{server_name}/players", status_code=202)
 def admin_delete_all_server_players(
     server_name: str,
     _: bool = Depends(require_master_admin),
@@ -120,7 +73,8 @@ def admin_delete_all_server_players(
     Parameters:
     - server_name: Server to clear all player data from
     
-    Returns deletion summary with number of records removed.
+    The wipe runs in the background; poll GET /v1/admin/deletion-jobs/{job_id}
+    for progress.
     """
     
     if not server_name or len(server_name.strip()) == 0:
@@ -128,73 +82,61 @@ def admin_delete_all_server_players(
     
     try:
         with engine.begin() as conn:
-            # Check if server has any data (in any table)
+            # Check if server has any player data (in any table)
             exists = conn.execute(
                 text("""
                     SELECT
-                        (SELECT COUNT(*) FROM step_ingest WHERE server_name = :server_name) AS ingest_count,
-                        (SELECT COUNT(*) FROM player_keys WHERE server_name = :server_name) AS keys_count,
-                        (SELECT COUNT(*) FROM step_claims WHERE server_name = :server_name) AS claims_count,
-                        (SELECT COUNT(*) FROM bans WHERE server_name = :server_name) AS bans_count
+                        EXISTS (SELECT 1 FROM player_keys WHERE server_name = :server_name)
+                        OR EXISTS (SELECT 1 FROM step_ingest WHERE server_name = :server_name)
+                        OR EXISTS (SELECT 1 FROM step_claims WHERE server_name = :server_name)
+                        OR EXISTS (SELECT 1 FROM bans WHERE server_name = :server_name)
                 """),
                 {"server_name": server_name}
-            ).fetchone()
-
-            if not exists or sum(exists) == 0:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"No player data found on server '{server_name}'"
-                )
-
-            deleted = {"step_ingest": 0, "player_keys": 0, "step_claims": 0, "bans": 0}
+            ).scalar_one()
 
-            deleted["step_claims"] = conn.execute(
-                text("""
-                    DELETE FROM step_claims
-                    WHERE server_name = :server_name
-                """),
-                {"server_name": server_name}
-            ).rowcount
+        if not exists:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No player data found on server '{server_name}'"
+            )
 
-            deleted["step_ingest"] = conn.execute(
-                text("""
-                    DELETE FROM step_ingest
-                    WHERE server_name = :server_name
-                """),
-                {"server_name": server_name}
-            ).rowcount
+        job_id = cascade_delete.start_job(
+            "server_players",
+            lambda progress: cascade_delete.wipe_server_players(server_name, progress),
+            server_name=server_name,
+        )
 
-            deleted["player_keys"] = conn.execute(
-                text("""
-                    DELETE FROM player_keys
-                    WHERE server_name = :server_name
-                """),
-                {"server_name": server_name}
-            ).rowcount
+        return {
+            "ok": True,
+            "action": "admin_deleting_all_server_players",
+            "server_name": server_name,
+            "job_id": job_id,
+            "status": cascade_delete.JOB_QUEUED,
+            "message": f"Deleting all player data on server '{server_name}' (job {job_id})"
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete server players: {str(e)}")
 
-            deleted["bans"] = conn.execute(
-                text("""
-                    DELETE FROM bans
-                    WHERE server_name = :server_name
-                """),
-                {"server_name": server_name}
-            ).rowcount
 
-            total = sum(deleted.values())
+@router.get("/v1/admin/deletion-jobs/{job_id}")
+def admin_get_deletion_job(
+    job_id: int,
+    _: bool = Depends(require_master_admin),
+):
+    """Status and per-table progress of a background deletion (master admin only)."""
+    try:
+        job = cascade_delete.get_job(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Deletion job {job_id} not found")
+        return {"ok": True, **job}
 
-            return {
-                "ok": True,
-                "action": "admin_deleted_all_server_players",
-                "server_name": server_name,
-                "deleted": deleted,
-                "rows_deleted": total,
-                "message": f"Deleted {total} record(s) for all players on server '{server_name}'"
-            }
-    
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to delete server players: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get deletion job: {str(e)}")
 
 
 @router.delete("/v1/admin/all-data")
@@ -209,8 +151,8 @@ def admin_delete_all_data(
     Requires X-Admin-Key header and confirm=yes query parameter to prevent accidents.
     
     Deletes:
-    - All step submissions from all servers
-    - All player keys/tokens
+    - All step submissions and reward claims from all servers
+    - All player keys/tokens, device push tokens and push delivery history
     - All server API keys
     
     Keeps:
@@ -224,24 +166,10 @@ def admin_delete_all_data(
         )
     
     try:
-        with engine.begin() as conn:
-            # Delete all step data
-            step_result = conn.execute(
-                text("DELETE FROM step_ingest")
-            )
-            steps_deleted = step_result.rowcount
-            
-            # Delete all player keys
-            keys_result = conn.execute(
-                text("DELETE FROM player_keys")
-            )
-            keys_deleted = keys_result.rowcount
-            
-            # Delete all server API keys
-            api_result = conn.execute(
-                text("DELETE FROM api_keys")
-            )
-            api_deleted = api_result.rowcount
+        deleted = cascade_delete.truncate_player_data(include_server_keys=True)
+        steps_deleted = deleted["step_ingest"]
+        keys_deleted = deleted["player_keys"]
+        api_deleted = deleted["api_keys"]
         
         return {
             "ok": True,
@@ -252,6 +180,7 @@ def admin_delete_all_data(
                 "player_tokens": keys_deleted,
                 "server_api_keys": api_deleted
             },
+            "deleted": deleted,
             "message": f"Deleted {steps_deleted} step records, {keys_deleted} player tokens, and {api_deleted} server keys"
         }
     
@@ -271,7 +200,8 @@ def admin_list_pending_push_notifications(
     """
     List pending push notifications (master admin only).
 
-    Pending is defined as notifications with no delivery rows yet.
+    Pending is defined as notifications with no delivery rows yet (compacted
+    notifications have had theirs removed by push retention).
     By default, only already-due notifications are returned.
     """
     if limit < 1 or limit > 5000:
@@ -291,6 +221,7 @@ def admin_list_pending_push_notifications(
                     FROM push_notifications
                     WHERE (:server_name IS NULL OR server_name = :server_name)
                       AND (:due_only = FALSE OR scheduled_at <= CURRENT_TIMESTAMP)
+                      AND deliveries_compacted_at IS NULL
                       AND NOT EXISTS (
                           SELECT 1
                           FROM push_deliveries pd
@@ -310,6 +241,7 @@ def admin_list_pending_push_notifications(
                     FROM push_notifications
                     WHERE (:server_name IS NULL OR server_name = :server_name)
                       AND (:due_only = FALSE OR scheduled_at <= CURRENT_TIMESTAMP)
+                      AND deliveries_compacted_at IS NULL
                       AND NOT EXISTS (
                           SELECT 1
                           FROM push_deliveries pd
@@ -371,6 +303,7 @@ def admin_delete_pending_push_notifications(
                     DELETE FROM push_notifications
                     WHERE (:server_name IS NULL OR server_name = :server_name)
                       AND (:due_only = FALSE OR scheduled_at <= CURRENT_TIMESTAMP)
+                      AND deliveries_compacted_at IS NULL
                       AND NOT EXISTS (
                           SELECT 1
                           FROM push_deliveries pd
@@ -394,3 +327,55 @@ def admin_delete_pending_push_notifications(
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete pending push notifications: {str(e)}")
+
+
+@router.get("/v1/admin/push/retention")
+def admin_push_retention_runs(
+    limit: int = 20,
+    _: bool = Depends(require_master_admin),
+):
+    """
+    Recent push delivery retention runs with the rows each one reclaimed
+    (master admin only).
+    """
+    if limit < 1 or limit > 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+
+    try:
+        runs = push_retention.recent_runs(limit)
+        for run in runs:
+            run["started_at"] = run["started_at"].isoformat()
+            run["finished_at"] = run["finished_at"].isoformat()
+        return {
+            "ok": True,
+            "retention_days": push_retention.RETENTION_DAYS,
+            "chunk_rows": push_retention.CHUNK_ROWS,
+            "runs": runs,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to list push retention runs: {str(e)}")
+
+
+@router.post("/v1/admin/push/retention/run")
+def admin_run_push_retention(
+    retention_days: int | None = None,
+    _: bool = Depends(require_master_admin),
+):
+    """
+    Compact and delete expired push delivery rows now instead of waiting for the
+    daily job (master admin only).
+    """
+    if retention_days is not None and retention_days < 1:
+        raise HTTPException(status_code=400, detail="retention_days must be at least 1")
+
+    try:
+        result = push_retention.run_push_retention_once(retention_days)
+        return {"ok": True, "action": "admin_ran_push_retention", **result}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to run push retention: {str(e)}")
@@ -2,9 +2,16 @@
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from zoneinfo import ZoneInfo
 
-from database import engine
+import apns_service
+import auth_cache
+import fcm_service
+import ingest_buffer
+import last_used_tracker
+import server_config
+from database import REQUEST_CONNECTION, engine, pool_stats
 from auth import require_api_key, require_master_admin
 
 CENTRAL_TZ = ZoneInfo("America/Chicago")
@@ -12,27 +19,30 @@ router = APIRouter()
 
 
 @router.get("/v1/latest/{device_id}")
-def latest(device_id: str, server_name: str = Depends(require_api_key)):
+def latest(
+    device_id: str,
+    server_name: str = Depends(require_api_key),
+    conn: Connection = REQUEST_CONNECTION,
+):
     """Get latest submission for a device (server-authenticated)."""
     # server_name is validated by require_api_key dependency
 
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-            SELECT
-                minecraft_username,
-                device_id,
-                day::text AS day,
-                steps_today,
-                source,
-                created_at
-            FROM step_ingest
-            WHERE device_id = :device_id
-            ORDER BY created_at DESC
-            LIMIT 1
-            """),
-            {"device_id": device_id},
-        ).mappings().first()
+    row = conn.execute(
+        text("""
+        SELECT
+            minecraft_username,
+            device_id,
+            day::text AS day,
+            steps_today,
+            source,
+            created_at
+        FROM step_ingest
+        WHERE device_id = :device_id
+        ORDER BY created_at DESC
+        LIMIT 1
+        """),
+        {"device_id": device_id},
+    ).mappings().first()
 
     if not row:
         return {"error": "No data for device_id"}
@@ -85,4 +95,24 @@ def admin_all(
             grouped[srv] = []
         grouped[srv].append(d)
 
-    return grouped
\ No newline at end of file
+    return grouped
+
+
+@router.get("/v1/admin/metrics")
+def admin_metrics(_: bool = Depends(require_master_admin)):
+    """
+    In-process performance counters (master admin only).
+    Requires master admin key (X-Admin-Key header).
+    """
+    return {
+        "ingest_buffer": ingest_buffer.stats(),
+        "auth_cache": auth_cache.stats(),
+        "last_used_tracker": last_used_tracker.stats(),
+        "server_config": server_config.stats(),
+        "apns_pool": apns_service.apns_pool_stats(),
+        "db_pools": pool_stats(),
+        "push_circuits": {
+            "apns": apns_service.apns_circuit_stats(),
+            "fcm": fcm_service.fcm_circuit_stats(),
+        },
+    }
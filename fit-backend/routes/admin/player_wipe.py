@@ -1,9 +1,8 @@
 """Admin endpoints to fully remove player data, including API keys and all related records."""
 
 from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy import text
-from database import engine
 from auth import require_master_admin
+import cascade_delete
 from typing import Optional
 
 router = APIRouter()
@@ -14,33 +13,22 @@ def admin_delete_player_everywhere(
     _: bool = Depends(require_master_admin),
 ):
     """
-    Delete ALL data for a specific player across all servers (step data, player keys).
+    Delete ALL data for a specific player (any case) across all servers: step data,
+    claims, player keys, bans, push tokens and history, recovery and audit records.
     Master admin only (requires X-Admin-Key header).
     """
     if not minecraft_username or len(minecraft_username.strip()) == 0:
         raise HTTPException(status_code=400, detail="minecraft_username cannot be empty")
     try:
-        with engine.begin() as conn:
-            # Delete from step_ingest
-            step_result = conn.execute(
-                text("""
-                    DELETE FROM step_ingest WHERE minecraft_username = :minecraft_username
-                """),
-                {"minecraft_username": minecraft_username}
-            )
-            # Delete from player_keys
-            key_result = conn.execute(
-                text("""
-                    DELETE FROM player_keys WHERE minecraft_username = :minecraft_username
-                """),
-                {"minecraft_username": minecraft_username}
-            )
+        deleted = cascade_delete.wipe_players(cascade_delete.resolve_players(minecraft_username))
         return {
             "ok": True,
             "action": "admin_deleted_player_everywhere",
             "minecraft_username": minecraft_username,
-            "step_records_deleted": step_result.rowcount,
-            "player_keys_deleted": key_result.rowcount,
+            "step_records_deleted": deleted.get("step_ingest", 0),
+            "player_keys_deleted": deleted["player_keys"],
+            "deleted": deleted,
+            "rows_deleted": sum(deleted.values()),
             "message": f"Deleted all data for '{minecraft_username}' across all servers."
         }
     except Exception as e:
@@ -52,25 +40,22 @@ def admin_delete_all_players(
     _: bool = Depends(require_master_admin),
 ):
     """
-    Delete ALL player data (step data and player keys) for ALL players across all servers.
+    Delete ALL player data (step data, claims, player keys, push tokens and history)
+    for ALL players across all servers. Bans and server keys are kept.
     Requires confirm=yes query parameter.
     Master admin only (requires X-Admin-Key header).
     """
     if confirm != "yes":
         raise HTTPException(status_code=400, detail="This operation deletes ALL player data. Confirm by passing ?confirm=yes")
     try:
-        with engine.begin() as conn:
-            step_result = conn.execute(text("DELETE FROM step_ingest"))
-            key_result = conn.execute(text("DELETE FROM player_keys"))
+        deleted = cascade_delete.truncate_player_data()
         return {
             "ok": True,
             "action": "admin_deleted_all_players",
-            "step_records_deleted": step_result.rowcount,
-            "player_keys_deleted": key_result.rowcount,
+            "step_records_deleted": deleted["step_ingest"],
+            "player_keys_deleted": deleted["player_keys"],
+            "deleted": deleted,
             "message": f"Deleted all player data and keys from the system."
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete all players: {str(e)}")
-
-
-
@@ -18,7 +18,7 @@ def admin_list_players_and_keys(_: bool = Depends(require_master_admin)):
         with engine.begin() as conn:
             rows = conn.execute(
                 text("""
-                    SELECT server_name, minecraft_username, device_id, key, active, created_at, last_used
+                    SELECT server_name, minecraft_username, device_id, key, active, created_at, last_used, last_activity_at
                     FROM player_keys
                     ORDER BY server_name ASC, minecraft_username ASC
                 """),
@@ -33,7 +33,8 @@ def admin_list_players_and_keys(_: bool = Depends(require_master_admin)):
                     "api_key_hash": r["key"],
                     "active": r["active"],
                     "created_at": dt_to_str(r["created_at"]),
-                    "last_used": dt_to_str(r["last_used"])
+                    "last_used": dt_to_str(r["last_used"]),
+                    "last_activity_at": dt_to_str(r["last_activity_at"])
                 } for r in rows
             ]
             return JSONResponse(content={
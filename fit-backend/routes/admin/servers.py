@@ -5,6 +5,8 @@ from fastapi.responses import JSONResponse
 from sqlalchemy import text
 from database import engine
 from auth import require_master_admin
+import auth_cache
+import server_config
 
 router = APIRouter()
 
@@ -65,6 +67,8 @@ def admin_delete_server(server_name: str, _: bool = Depends(require_master_admin
             )
             if result.rowcount == 0:
                 raise HTTPException(status_code=404, detail=f"Server '{server_name}' not found")
+        auth_cache.invalidate_server(server_name)
+        server_config.invalidate(server_name)
         return {"ok": True, "message": f"Server '{server_name}' and all related data deleted."}
     except HTTPException:
         raise
@@ -3,12 +3,14 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel, Field
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 import json
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-from database import engine
+from database import REQUEST_CONNECTION
 from auth import require_user
+import server_config
 
 router = APIRouter()
 
@@ -34,100 +36,97 @@ DEFAULT_REWARDS = [
 
 
 @router.get("/v1/owner/servers")
-def list_owned_servers(user=Depends(require_user)):
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-                SELECT server_name, owner_email, server_address, server_version, created_at
-                FROM servers
-                WHERE owner_user_id = :user_id
-                ORDER BY created_at DESC
-            """),
-            {"user_id": user["id"]}
-        ).mappings().all()
+def list_owned_servers(
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    rows = conn.execute(
+        text("""
+            SELECT server_name, owner_email, server_address, server_version, created_at
+            FROM servers
+            WHERE owner_user_id = :user_id
+            ORDER BY created_at DESC
+        """),
+        {"user_id": user["id"]}
+    ).mappings().all()
 
     return {"servers": list(rows)}
 
 
 @router.get("/v1/owner/servers/{server_name}/rewards")
-def get_rewards(server_name: str, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-                SELECT min_steps, label, rewards_json
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).fetchall()
-
+def get_rewards(
+    server_name: str,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    _ensure_owner(conn, server_name, user["id"])
+    rows = server_config.tiers(server_name, conn)
     if not rows:
         return {"server_name": server_name, "tiers": [t.model_dump() for t in DEFAULT_REWARDS], "is_default": True}
 
-    tiers = []
-    for row in rows:
-        try:
-            rewards = json.loads(row[2]) if row[2] else []
-        except Exception:
-            rewards = []
-        tiers.append({"min_steps": row[0], "label": row[1], "rewards": rewards})
-
+    tiers = [{"min_steps": t["min_steps"], "label": t["label"], "rewards": t["rewards"]} for t in rows]
     return {"server_name": server_name, "tiers": tiers, "is_default": False}
 
 
 @router.post("/v1/owner/servers/{server_name}/rewards/default")
-def seed_default(server_name: str, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
-    with engine.begin() as conn:
-        conn.execute(text("DELETE FROM server_rewards WHERE server_name = :server"), {"server": server_name})
-        for idx, tier in enumerate(DEFAULT_REWARDS):
-            conn.execute(
-                text("""
-                    INSERT INTO server_rewards (server_name, min_steps, label, rewards_json, position)
-                    VALUES (:server, :min_steps, :label, :rewards_json, :position)
-                """),
-                {
-                    "server": server_name,
-                    "min_steps": tier.min_steps,
-                    "label": tier.label,
-                    "rewards_json": json.dumps(tier.rewards),
-                    "position": idx,
-                },
-            )
+def seed_default(
+    server_name: str,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    _ensure_owner(conn, server_name, user["id"])
+    conn.execute(text("DELETE FROM server_rewards WHERE server_name = :server"), {"server": server_name})
+    for idx, tier in enumerate(DEFAULT_REWARDS):
+        conn.execute(
+            text("""
+                INSERT INTO server_rewards (server_name, min_steps, label, rewards_json, position)
+                VALUES (:server, :min_steps, :label, :rewards_json, :position)
+            """),
+            {
+                "server": server_name,
+                "min_steps": tier.min_steps,
+                "label": tier.label,
+                "rewards_json": json.dumps(tier.rewards),
+                "position": idx,
+            },
+        )
+    server_config.invalidate(server_name, conn)
 
     return {"server_name": server_name, "tiers": [t.model_dump() for t in DEFAULT_REWARDS], "is_default": False}
 
 
 @router.put("/v1/owner/servers/{server_name}/rewards")
-def replace_rewards(server_name: str, payload: RewardsPayload, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
-    with engine.begin() as conn:
-        conn.execute(text("DELETE FROM server_rewards WHERE server_name = :server"), {"server": server_name})
-        for idx, tier in enumerate(payload.tiers):
-            conn.execute(
-                text("""
-                    INSERT INTO server_rewards (server_name, min_steps, label, rewards_json, position)
-                    VALUES (:server, :min_steps, :label, :rewards_json, :position)
-                """),
-                {
-                    "server": server_name,
-                    "min_steps": tier.min_steps,
-                    "label": tier.label,
-                    "rewards_json": json.dumps(tier.rewards),
-                    "position": idx,
-                },
-            )
+def replace_rewards(
+    server_name: str,
+    payload: RewardsPayload,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    _ensure_owner(conn, server_name, user["id"])
+    conn.execute(text("DELETE FROM server_rewards WHERE server_name = :server"), {"server": server_name})
+    for idx, tier in enumerate(payload.tiers):
+        conn.execute(
+            text("""
+                INSERT INTO server_rewards (server_name, min_steps, label, rewards_json, position)
+                VALUES (:server, :min_steps, :label, :rewards_json, :position)
+            """),
+            {
+                "server": server_name,
+                "min_steps": tier.min_steps,
+                "label": tier.label,
+                "rewards_json": json.dumps(tier.rewards),
+                "position": idx,
+            },
+        )
+    server_config.invalidate(server_name, conn)
 
     return {"server_name": server_name, "tiers": [t.model_dump() for t in payload.tiers]}
 
 
-def _ensure_owner(server_name: str, user_id: int) -> None:
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
-            {"server": server_name, "user_id": user_id}
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=403, detail="Not authorized for this server")
+def _ensure_owner(conn, server_name: str, user_id: int) -> None:
+    row = conn.execute(
+        text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
+        {"server": server_name, "user_id": user_id}
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=403, detail="Not authorized for this server")
@@ -4,11 +4,13 @@ from fastapi import APIRouter, HTTPException, Depends, Query
 from sqlalchemy import text
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone
-from database import engine
+from database import REQUEST_TRANSACTION, RequestTransaction, engine
 from models import PlayerRegistrationRequest, PlayerApiKeyResponse, KeyRecoveryRequest, DeviceUsernameResponse
 from utils import generate_opaque_token, hash_token
-import json
-from auth import require_api_key, validate_and_get_server
+import auth_cache
+import claim_engine
+import server_config
+from auth import require_api_key, validate_and_get_server_async
 
 CENTRAL_TZ = ZoneInfo("America/Chicago")
 router = APIRouter()
@@ -20,25 +22,16 @@ DEFAULT_REWARDS = [
 ]
  
 
-def _get_claim_buffer_days(server_name: str) -> int:
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT claim_buffer_days FROM servers WHERE server_name = :server"),
-            {"server": server_name},
-        ).fetchone()
-    if not row or row[0] is None:
-        return 1
-    return max(0, int(row[0]))
-
 # ...existing code...
 
 
 @router.get("/v1/players/claim-status/{minecraft_username}")
-def get_claim_status_player(
+async def get_claim_status_player(
     minecraft_username: str,
     server_name: str = Query(...),
     day: str | None = Query(default=None),
     min_steps: int | None = Query(default=None),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Check if the player has claimed a specific reward tier for a day (app use).
@@ -61,8 +54,8 @@ def get_claim_status_player(
     if target_day > today:
         raise HTTPException(status_code=400, detail="Cannot claim future days")
 
-    with engine.begin() as conn:
-        row = conn.execute(
+    def load(conn):
+        return conn.execute(
             text("""
                 SELECT claimed, claimed_at FROM step_claims
                 WHERE minecraft_username = :username
@@ -78,6 +71,8 @@ def get_claim_status_player(
                 "min_steps": min_steps,
             }
         ).fetchone()
+
+    row = await tx.run(load)
     if row:
         return {"claimed": row[0], "claimed_at": row[1], "day": str(target_day), "min_steps": min_steps}
     else:
@@ -85,19 +80,21 @@ def get_claim_status_player(
 
 
 @router.get("/v1/players/claim-available")
-def get_claim_available_player(
+async def get_claim_available_player(
     device_id: str = Query(...),
     player_api_key: str = Query(...),
     debug: bool = Query(default=False),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     List all claimable reward tiers within the claim window for the authenticated player.
     Returns items with day + min_steps + label (one entry per tier per day).
     """
-    server_name, minecraft_username = validate_and_get_server(device_id, player_api_key)
-    today = datetime.now(CENTRAL_TZ).date()
-    buffer_days = _get_claim_buffer_days(server_name)
-    days = [today - timedelta(days=offset) for offset in range(buffer_days + 1)]
+    server_name, minecraft_username = await validate_and_get_server_async(device_id, player_api_key, tx)
+    config = await server_config.get_async(server_name, tx)
+    buffer_days = config["claim_buffer_days"]
+    days = claim_engine.claim_window_days(buffer_days)
+    tiers = claim_engine.load_tiers(server_name, DEFAULT_REWARDS, config)
 
     debug_info = {
         "server_name": server_name,
@@ -109,161 +106,53 @@ def get_claim_available_player(
         "claimed_by_day": {},
     }
 
-    with engine.begin() as conn:
-        tiers = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).mappings().all()
-
-        if debug:
-            debug_info["tiers"] = [
-                {"min_steps": t["min_steps"], "label": t["label"]}
-                for t in tiers
-            ]
-
-        if not tiers:
-            tiers = [{"min_steps": r["min_steps"], "label": r["label"], "item_id": r.get("item_id")} for r in DEFAULT_REWARDS]
-            if debug:
-                debug_info["tiers"] = [
-                    {"min_steps": t["min_steps"], "label": t["label"], "item_id": t.get("item_id")}
-                    for t in tiers
-                ]
-
-        items = []
-        for day in days:
-            day_str = str(day)
-            steps_row = conn.execute(
-                text("""
-                    SELECT steps_today FROM step_ingest
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                    LIMIT 1
-                """),
-                {"username": minecraft_username, "server": server_name, "day": day_str},
-            ).fetchone()
-
-            if not steps_row:
-                if debug:
-                    debug_info["steps_by_day"][day_str] = None
-                continue
+    if debug:
+        debug_info["tiers"] = [
+            {"min_steps": t["min_steps"], "label": t["label"], "item_id": t.get("item_id")}
+            for t in tiers
+        ]
 
-            steps = steps_row[0]
-            if debug:
-                debug_info["steps_by_day"][day_str] = steps
+    def load(conn):
+        return claim_engine.claim_items(
+            conn,
+            server_name,
+            [minecraft_username],
+            tiers,
+            days,
+            debug_info=debug_info if debug else None,
+        )[minecraft_username]
 
-            eligible = [tier for tier in tiers if steps >= tier["min_steps"]]
-            if not eligible:
-                continue
-
-            claimed_rows = conn.execute(
-                text("""
-                    SELECT min_steps FROM step_claims
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                      AND claimed = TRUE
-                """),
-                {"username": minecraft_username, "server": server_name, "day": day_str},
-            ).fetchall()
-            claimed_set = {row[0] for row in claimed_rows}
-            if debug:
-                debug_info["claimed_by_day"][day_str] = sorted(claimed_set)
-
-            for tier in eligible:
-                if tier["min_steps"] in claimed_set:
-                    continue
-                items.append(
-                    {
-                        "day": day_str,
-                        "min_steps": tier["min_steps"],
-                        "label": tier["label"],
-                        "item_id": tier.get("item_id"),
-                    }
-                )
+    items = await tx.run(load)
 
     return {"server_name": server_name, "items": items, "debug": debug_info} if debug else {"server_name": server_name, "items": items}
 
 
 @router.get("/v1/players/claim-status-list")
-def get_claim_status_list_player(
+async def get_claim_status_list_player(
     device_id: str = Query(...),
     player_api_key: str = Query(...),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     List claim status for all eligible reward tiers within the claim window for the authenticated player.
     Returns one entry per eligible tier per day with claimed status.
     """
-    server_name, minecraft_username = validate_and_get_server(device_id, player_api_key)
-    today = datetime.now(CENTRAL_TZ).date()
-    buffer_days = _get_claim_buffer_days(server_name)
-    days = [today - timedelta(days=offset) for offset in range(buffer_days + 1)]
-
-    with engine.begin() as conn:
-        tiers = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).mappings().all()
-
-        if not tiers:
-            tiers = [{"min_steps": r["min_steps"], "label": r["label"], "item_id": r.get("item_id")} for r in DEFAULT_REWARDS]
-
-        items = []
-        for day in days:
-            day_str = str(day)
-            steps_row = conn.execute(
-                text("""
-                    SELECT steps_today FROM step_ingest
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                    LIMIT 1
-                """),
-                {"username": minecraft_username, "server": server_name, "day": day_str},
-            ).fetchone()
-
-            if not steps_row:
-                continue
-
-            steps = steps_row[0]
-            eligible = [tier for tier in tiers if steps >= tier["min_steps"]]
-            if not eligible:
-                continue
-
-            claimed_rows = conn.execute(
-                text("""
-                    SELECT min_steps, claimed, claimed_at FROM step_claims
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                """),
-                {"username": minecraft_username, "server": server_name, "day": day_str},
-            ).fetchall()
-
-            claimed_map = {row[0]: (bool(row[1]), row[2]) for row in claimed_rows}
-
-            for tier in eligible:
-                claimed, claimed_at = claimed_map.get(tier["min_steps"], (False, None))
-                items.append(
-                    {
-                        "day": day_str,
-                        "min_steps": tier["min_steps"],
-                        "label": tier["label"],
-                        "item_id": tier.get("item_id"),
-                        "claimed": claimed,
-                        "claimed_at": claimed_at,
-                    }
-                )
+    server_name, minecraft_username = await validate_and_get_server_async(device_id, player_api_key, tx)
+    config = await server_config.get_async(server_name, tx)
+    days = claim_engine.claim_window_days(config["claim_buffer_days"])
+    tiers = claim_engine.load_tiers(server_name, DEFAULT_REWARDS, config)
+
+    def load(conn):
+        return claim_engine.claim_items(
+            conn,
+            server_name,
+            [minecraft_username],
+            tiers,
+            days,
+            include_claimed=True,
+        )[minecraft_username]
+
+    items = await tx.run(load)
 
     return {"server_name": server_name, "items": items}
 
@@ -311,27 +200,10 @@ def get_player_rewards(
         if not valid:
             raise HTTPException(status_code=403, detail="Invalid player API key")
 
-        rows = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id, rewards_json
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).fetchall()
-
-    if not rows:
+        tiers = server_config.tiers(server_name, conn)
+    if not tiers:
         return {"server_name": server_name, "tiers": DEFAULT_REWARDS, "is_default": True}
 
-    tiers = []
-    for row in rows:
-        try:
-            rewards = json.loads(row[3]) if row[3] else []
-        except Exception:
-            rewards = []
-        tiers.append({"min_steps": row[0], "label": row[1], "item_id": row[2], "rewards": rewards})
-
     return {"server_name": server_name, "tiers": tiers, "is_default": False}
 
 """Player registration and authentication endpoints."""
@@ -398,23 +270,19 @@ def register_player(request: PlayerRegistrationRequest) -> PlayerApiKeyResponse:
     
     try:
         with engine.begin() as conn:
-            # Check if server exists and get max_players limit
+            # Check if server exists; privacy and max_players come from server_config
             server_info = conn.execute(
-                text("""
-                    SELECT k.id, k.max_players, s.is_private, s.invite_code
-                    FROM api_keys k
-                    JOIN servers s ON s.server_name = k.server_name
-                    WHERE k.server_name = :server_name AND k.active = TRUE
-                """),
+                text("SELECT id FROM api_keys WHERE server_name = :server_name AND active = TRUE"),
                 {"server_name": request.server_name}
             ).fetchone()
+            config = server_config.get(request.server_name, conn)
             
-            if not server_info:
+            if not server_info or not config["exists"]:
                 raise HTTPException(status_code=404, detail=f"Server '{request.server_name}' not found. Register with a valid server name.")
             
-            max_players = server_info[1]  # Can be NULL (unlimited) or an integer
-            is_private = bool(server_info[2])
-            server_invite = server_info[3]
+            max_players = config["max_players"]  # Can be NULL (unlimited) or an integer
+            is_private = config["is_private"]
+            server_invite = config["invite_code"]
 
             if is_private and request.invite_code != server_invite:
                 raise HTTPException(
@@ -462,7 +330,8 @@ def register_player(request: PlayerRegistrationRequest) -> PlayerApiKeyResponse:
                         UPDATE player_keys
                         SET key = :key_hash,
                             minecraft_username = :username,
-                            active = TRUE
+                            active = TRUE,
+                            last_activity_at = NOW()
                         WHERE id = :id
                     """),
                     {
@@ -486,6 +355,10 @@ def register_player(request: PlayerRegistrationRequest) -> PlayerApiKeyResponse:
                     }
                 )
         
+        if existing_row:
+            # The previous key for this device/server was rotated
+            auth_cache.invalidate_players(server_name=request.server_name, device_id=request.device_id)
+        
         # Return the plaintext token ONLY on creation (never again)
         return PlayerApiKeyResponse(
             player_api_key=plaintext_token,
@@ -546,7 +419,8 @@ def recover_key(request: KeyRecoveryRequest) -> PlayerApiKeyResponse:
                     UPDATE player_keys 
                     SET key = :new_key_hash,
                         minecraft_username = :minecraft_username,
-                        active = TRUE
+                        active = TRUE,
+                        last_activity_at = NOW()
                     WHERE id = :id
                 """),
                 {
@@ -569,6 +443,8 @@ def recover_key(request: KeyRecoveryRequest) -> PlayerApiKeyResponse:
                 }
             )
         
+        auth_cache.invalidate_players(server_name=request.server_name, device_id=request.device_id)
+        
         # Return the new plaintext token
         return PlayerApiKeyResponse(
             player_api_key=plaintext_token,
@@ -2,42 +2,62 @@
 
 from fastapi import APIRouter, HTTPException
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
 from auth import validate_and_get_server
-from database import engine
+from database import REQUEST_CONNECTION
 from models import PushSendRequest, PushTokenRegistrationRequest, PushTokenUnregisterRequest
-from apns_service import (
-    ApnsConfigError,
-    APNsException,
-    Unregistered,
-    apns_use_sandbox,
-    format_apns_exception,
-    send_push,
-)
-from apns2.errors import BadDeviceToken
-from fcm_service import (
-    FcmConfigError,
-    FirebaseError,
-    format_fcm_exception,
-    is_unregistered_fcm_error,
-    send_fcm_push,
-)
+from apns_service import ApnsConfigError, apns_use_sandbox
+import push_scheduler
 
 router = APIRouter()
 
 
 @router.post("/v1/players/push/register-device")
-def register_push_device(request: PushTokenRegistrationRequest):
-    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key)
+def register_push_device(
+    request: PushTokenRegistrationRequest,
+    conn: Connection = REQUEST_CONNECTION,
+):
+    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key, conn)
     try:
-        with engine.begin() as conn:
-            conn.execute(
+        conn.execute(
+            text(
+                """
+                INSERT INTO push_device_tokens (device_id, server_name, platform, token, sandbox)
+                VALUES (:device_id, :server_name, :platform, :token, :sandbox)
+                ON CONFLICT (device_id, server_name, platform, token, sandbox)
+                DO UPDATE SET updated_at = NOW()
+                """
+            ),
+            {
+                "device_id": request.device_id,
+                "server_name": server_name,
+                "platform": request.platform,
+                "token": request.apns_token,
+                "sandbox": request.sandbox,
+            },
+        )
+        return {"status": "ok"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to register push token: {str(e)}")
+
+
+@router.post("/v1/players/push/unregister-device")
+def unregister_push_device(
+    request: PushTokenUnregisterRequest,
+    conn: Connection = REQUEST_CONNECTION,
+):
+    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key, conn)
+    try:
+        if request.apns_token:
+            result = conn.execute(
                 text(
                     """
-                    INSERT INTO push_device_tokens (device_id, server_name, platform, token, sandbox)
-                    VALUES (:device_id, :server_name, :platform, :token, :sandbox)
-                    ON CONFLICT (device_id, server_name, platform, token, sandbox)
-                    DO UPDATE SET updated_at = NOW()
+                    DELETE FROM push_device_tokens
+                    WHERE device_id = :device_id
+                      AND server_name = :server_name
+                      AND platform = :platform
+                      AND token = :token
                     """
                 ),
                 {
@@ -45,61 +65,35 @@ def register_push_device(request: PushTokenRegistrationRequest):
                     "server_name": server_name,
                     "platform": request.platform,
                     "token": request.apns_token,
-                    "sandbox": request.sandbox,
                 },
             )
-        return {"status": "ok"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to register push token: {str(e)}")
-
-
-@router.post("/v1/players/push/unregister-device")
-def unregister_push_device(request: PushTokenUnregisterRequest):
-    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key)
-    try:
-        with engine.begin() as conn:
-            if request.apns_token:
-                result = conn.execute(
-                    text(
-                        """
-                        DELETE FROM push_device_tokens
-                        WHERE device_id = :device_id
-                          AND server_name = :server_name
-                          AND platform = :platform
-                          AND token = :token
-                        """
-                    ),
-                    {
-                        "device_id": request.device_id,
-                        "server_name": server_name,
-                        "platform": request.platform,
-                        "token": request.apns_token,
-                    },
-                )
-            else:
-                result = conn.execute(
-                    text(
-                        """
-                        DELETE FROM push_device_tokens
-                        WHERE device_id = :device_id
-                          AND server_name = :server_name
-                          AND platform = :platform
-                        """
-                    ),
-                    {
-                        "device_id": request.device_id,
-                        "server_name": server_name,
-                        "platform": request.platform,
-                    },
-                )
+        else:
+            result = conn.execute(
+                text(
+                    """
+                    DELETE FROM push_device_tokens
+                    WHERE device_id = :device_id
+                      AND server_name = :server_name
+                      AND platform = :platform
+                    """
+                ),
+                {
+                    "device_id": request.device_id,
+                    "server_name": server_name,
+                    "platform": request.platform,
+                },
+            )
         return {"status": "ok", "deleted": result.rowcount}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to unregister push token: {str(e)}")
 
 
-@router.post("/v1/players/push/send")
-def send_push_notification(request: PushSendRequest):
-    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key)
+@router.post("/v1/players/push/send", status_code=202)
+def send_push_notification(
+    request: PushSendRequest,
+    conn: Connection = REQUEST_CONNECTION,
+):
+    server_name, _ = validate_and_get_server(request.device_id, request.player_api_key, conn)
     target_sandbox: bool | None = None
     try:
         target_sandbox = apns_use_sandbox()
@@ -107,36 +101,35 @@ def send_push_notification(request: PushSendRequest):
         target_sandbox = None
 
     try:
-        with engine.begin() as conn:
+        rows = conn.execute(
+            text(
+                """
+                SELECT token, sandbox, platform
+                FROM push_device_tokens
+                WHERE device_id = :device_id
+                  AND server_name = :server_name
+                ORDER BY updated_at DESC
+                """
+            ),
+            {
+                "device_id": request.device_id,
+                "server_name": server_name,
+            },
+        ).fetchall()
+
+        if not rows:
             rows = conn.execute(
                 text(
                     """
                     SELECT token, sandbox, platform
                     FROM push_device_tokens
                     WHERE device_id = :device_id
-                      AND server_name = :server_name
                     ORDER BY updated_at DESC
                     """
                 ),
-                {
-                    "device_id": request.device_id,
-                    "server_name": server_name,
-                },
+                {"device_id": request.device_id},
             ).fetchall()
 
-            if not rows:
-                rows = conn.execute(
-                    text(
-                        """
-                        SELECT token, sandbox, platform
-                        FROM push_device_tokens
-                        WHERE device_id = :device_id
-                        ORDER BY updated_at DESC
-                        """
-                    ),
-                    {"device_id": request.device_id},
-                ).fetchall()
-
         eligible = [
             r for r in rows
             if (str(r[2] or "").lower() == "android")
@@ -149,56 +142,22 @@ def send_push_notification(request: PushSendRequest):
         if not eligible:
             raise HTTPException(status_code=404, detail="No push tokens registered for this environment")
 
-        failures = 0
         title = request.title
         if server_name and server_name.lower() not in title.lower():
             title = f"{title} • {server_name}"
         data = dict(request.data or {})
         data.setdefault("server_name", server_name)
-        for token, _sandbox, platform in eligible:
-            try:
-                if str(platform or "").lower() == "android":
-                    send_fcm_push(token, title, request.body, data)
-                else:
-                    send_push(token, title, request.body, data)
-            except (Unregistered, BadDeviceToken):
-                with engine.begin() as conn:
-                    conn.execute(
-                        text(
-                            """
-                            DELETE FROM push_device_tokens
-                            WHERE device_id = :device_id AND token = :token
-                            """
-                        ),
-                        {"device_id": request.device_id, "token": token},
-                    )
-                failures += 1
-            except FirebaseError as e:
-                if is_unregistered_fcm_error(e):
-                    with engine.begin() as conn:
-                        conn.execute(
-                            text(
-                                """
-                                DELETE FROM push_device_tokens
-                                WHERE device_id = :device_id AND token = :token
-                                """
-                            ),
-                            {"device_id": request.device_id, "token": token},
-                        )
-                    failures += 1
-                    continue
-                raise HTTPException(status_code=502, detail=f"FCM error: {format_fcm_exception(e)}")
-            except APNsException as e:
-                raise HTTPException(status_code=502, detail=f"APNs error: {format_apns_exception(e)}")
-
-        return {
-            "status": "sent",
-            "tokens": len(eligible),
-            "failed": failures,
-        }
+        job_id = push_scheduler.enqueue_send_now(
+            server_name,
+            push_scheduler.KIND_PLAYER_SEND,
+            title,
+            request.body,
+            data,
+            [(request.device_id, str(platform or "").lower(), token) for token, _sandbox, platform in eligible],
+            conn=conn,
+        )
+        return {"status": "queued", "job_id": job_id, "tokens": len(eligible)}
 
-    except FcmConfigError as e:
-        raise HTTPException(status_code=500, detail=f"FCM config error: {str(e)}")
     except HTTPException:
         raise
     except Exception as e:
@@ -2,10 +2,11 @@
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 import json
 
 from auth import require_user
-from database import engine
+from database import REQUEST_CONNECTION
 
 router = APIRouter()
 
@@ -16,6 +17,7 @@ def list_audit_events(
     action: str | None = Query(default=None),
     limit: int = Query(default=200, ge=1, le=1000),
     user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     params = {"user_id": user["id"], "limit": limit}
     server_filter = ""
@@ -29,34 +31,33 @@ def list_audit_events(
         action_filter = "AND a.action = :action"
         params["action"] = action
 
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text(
-                f"""
-                SELECT
-                    a.id,
-                    a.server_name,
-                    a.actor_user_id,
-                    a.action,
-                    a.summary,
-                    a.details_json,
-                    a.created_at,
-                    u.email AS actor_email
-                FROM audit_logs a
-                JOIN servers s
-                  ON s.server_name = a.server_name
-                 AND s.owner_user_id = :user_id
-                LEFT JOIN users u
-                  ON u.id = a.actor_user_id
-                WHERE 1=1
-                  {server_filter}
-                  {action_filter}
-                ORDER BY a.created_at DESC
-                LIMIT :limit
-                """
-            ),
-            params,
-        ).mappings().all()
+    rows = conn.execute(
+        text(
+            f"""
+            SELECT
+                a.id,
+                a.server_name,
+                a.actor_user_id,
+                a.action,
+                a.summary,
+                a.details_json,
+                a.created_at,
+                u.email AS actor_email
+            FROM audit_logs a
+            JOIN servers s
+              ON s.server_name = a.server_name
+             AND s.owner_user_id = :user_id
+            LEFT JOIN users u
+              ON u.id = a.actor_user_id
+            WHERE 1=1
+              {server_filter}
+              {action_filter}
+            ORDER BY a.created_at DESC
+            LIMIT :limit
+            """
+        ),
+        params,
+    ).mappings().all()
 
     items = []
     for row in rows:
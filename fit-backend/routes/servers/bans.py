@@ -3,10 +3,11 @@
 from fastapi import APIRouter, HTTPException, Depends, Header
 from pydantic import BaseModel, Field
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from zoneinfo import ZoneInfo
 import secrets
 
-from database import engine
+from database import REQUEST_CONNECTION
 from auth import require_server_access
 from audit import log_audit_event, maybe_get_user
 
@@ -22,6 +23,7 @@ class BanRequest(BaseModel):
 def get_server_bans(
     limit: int = 1000,
     server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     """
     Get all bans for this server.
@@ -29,22 +31,21 @@ def get_server_bans(
     
     Returns banned usernames and devices with reasons.
     """
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-            SELECT
-                ban_group_id,
-                minecraft_username,
-                device_id,
-                reason,
-                banned_at
-            FROM bans
-            WHERE server_name = :server_name
-            ORDER BY banned_at DESC
-            LIMIT :limit
-            """),
-            {"server_name": server_name, "limit": limit},
-        ).mappings().all()
+    rows = conn.execute(
+        text("""
+        SELECT
+            ban_group_id,
+            minecraft_username,
+            device_id,
+            reason,
+            banned_at
+        FROM bans
+        WHERE server_name = :server_name
+        ORDER BY banned_at DESC
+        LIMIT :limit
+        """),
+        {"server_name": server_name, "limit": limit},
+    ).mappings().all()
 
     # Group by ban_group_id
     grouped: dict[str, dict] = {}
@@ -82,6 +83,7 @@ def ban_player(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     """
     Ban a player from this server.
@@ -99,84 +101,84 @@ def ban_player(
         raise HTTPException(status_code=400, detail="minecraft_username cannot be empty")
     
     try:
-        with engine.begin() as conn:
-            banned_items = []
-            ban_group_id = secrets.token_urlsafe(16)
+        banned_items = []
+        ban_group_id = secrets.token_urlsafe(16)
+            
+        # First, find all device_ids associated with this username
+        devices = conn.execute(
+            text("""
+                SELECT DISTINCT device_id FROM player_keys
+                WHERE minecraft_username = :minecraft_username
+                AND server_name = :server_name
+            """),
+            {"minecraft_username": minecraft_username, "server_name": server_name}
+        ).fetchall()
+            
+        device_ids = [d[0] for d in devices]
+            
+        # Ban the username
+        existing = conn.execute(
+            text("""
+                SELECT id FROM bans
+                WHERE server_name = :server_name
+                AND minecraft_username = :minecraft_username
+                AND device_id IS NULL
+            """),
+            {"server_name": server_name, "minecraft_username": minecraft_username}
+        ).fetchone()
             
-            # First, find all device_ids associated with this username
-            devices = conn.execute(
+        if not existing:
+            conn.execute(
                 text("""
-                    SELECT DISTINCT device_id FROM player_keys
-                    WHERE minecraft_username = :minecraft_username
-                    AND server_name = :server_name
+                    INSERT INTO bans (ban_group_id, server_name, minecraft_username, reason)
+                    VALUES (:ban_group_id, :server_name, :minecraft_username, :reason)
                 """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            ).fetchall()
-            
-            device_ids = [d[0] for d in devices]
+                {
+                    "ban_group_id": ban_group_id,
+                    "server_name": server_name,
+                    "minecraft_username": minecraft_username,
+                    "reason": request.reason
+                }
+            )
+            banned_items.append(f"username '{minecraft_username}'")
+        else:
+            banned_items.append(f"username '{minecraft_username}' (already banned)")
             
-            # Ban the username
+        # Ban all associated devices
+        for device_id in device_ids:
             existing = conn.execute(
                 text("""
                     SELECT id FROM bans
                     WHERE server_name = :server_name
-                    AND minecraft_username = :minecraft_username
-                    AND device_id IS NULL
+                    AND device_id = :device_id
+                    AND minecraft_username IS NULL
                 """),
-                {"server_name": server_name, "minecraft_username": minecraft_username}
+                {"server_name": server_name, "device_id": device_id}
             ).fetchone()
-            
+                
             if not existing:
                 conn.execute(
                     text("""
-                        INSERT INTO bans (ban_group_id, server_name, minecraft_username, reason)
-                        VALUES (:ban_group_id, :server_name, :minecraft_username, :reason)
+                        INSERT INTO bans (ban_group_id, server_name, device_id, reason)
+                        VALUES (:ban_group_id, :server_name, :device_id, :reason)
                     """),
                     {
                         "ban_group_id": ban_group_id,
                         "server_name": server_name,
-                        "minecraft_username": minecraft_username,
+                        "device_id": device_id,
                         "reason": request.reason
                     }
                 )
-                banned_items.append(f"username '{minecraft_username}'")
-            else:
-                banned_items.append(f"username '{minecraft_username}' (already banned)")
-            
-            # Ban all associated devices
-            for device_id in device_ids:
-                existing = conn.execute(
-                    text("""
-                        SELECT id FROM bans
-                        WHERE server_name = :server_name
-                        AND device_id = :device_id
-                        AND minecraft_username IS NULL
-                    """),
-                    {"server_name": server_name, "device_id": device_id}
-                ).fetchone()
-                
-                if not existing:
-                    conn.execute(
-                        text("""
-                            INSERT INTO bans (ban_group_id, server_name, device_id, reason)
-                            VALUES (:ban_group_id, :server_name, :device_id, :reason)
-                        """),
-                        {
-                            "ban_group_id": ban_group_id,
-                            "server_name": server_name,
-                            "device_id": device_id,
-                            "reason": request.reason
-                        }
-                    )
-                    banned_items.append(f"device '{device_id}'")
+                banned_items.append(f"device '{device_id}'")
         
-        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
         log_audit_event(
             server_name=server_name,
             actor_user_id=user["id"] if user else None,
             action="player_banned",
             summary=f"Banned {minecraft_username}",
             details={"minecraft_username": minecraft_username, "reason": request.reason, "device_count": len(device_ids)},
+            conn=conn,
         )
         return {
             "ok": True,
@@ -200,6 +202,7 @@ def unban_player(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     """
     Unban a player from this server.
@@ -216,54 +219,54 @@ def unban_player(
         raise HTTPException(status_code=400, detail="minecraft_username cannot be empty")
     
     try:
-        with engine.begin() as conn:
-            # Find the username ban to get the ban_group_id
-            username_ban = conn.execute(
-                text("""
-                    SELECT ban_group_id FROM bans
-                    WHERE server_name = :server_name
-                    AND minecraft_username = :minecraft_username
-                    AND device_id IS NULL
-                """),
-                {"server_name": server_name, "minecraft_username": minecraft_username}
-            ).fetchone()
+        # Find the username ban to get the ban_group_id
+        username_ban = conn.execute(
+            text("""
+                SELECT ban_group_id FROM bans
+                WHERE server_name = :server_name
+                AND minecraft_username = :minecraft_username
+                AND device_id IS NULL
+            """),
+            {"server_name": server_name, "minecraft_username": minecraft_username}
+        ).fetchone()
             
-            if not username_ban:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"No bans found for '{minecraft_username}' on server '{server_name}'"
-                )
+        if not username_ban:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No bans found for '{minecraft_username}' on server '{server_name}'"
+            )
             
-            ban_group_id = username_ban[0]
+        ban_group_id = username_ban[0]
             
-            # Find all device bans with this ban_group_id
-            device_bans = conn.execute(
-                text("""
-                    SELECT device_id FROM bans
-                    WHERE ban_group_id = :ban_group_id
-                    AND device_id IS NOT NULL
-                """),
-                {"ban_group_id": ban_group_id}
-            ).fetchall()
+        # Find all device bans with this ban_group_id
+        device_bans = conn.execute(
+            text("""
+                SELECT device_id FROM bans
+                WHERE ban_group_id = :ban_group_id
+                AND device_id IS NOT NULL
+            """),
+            {"ban_group_id": ban_group_id}
+        ).fetchall()
             
-            device_ids = [d[0] for d in device_bans]
+        device_ids = [d[0] for d in device_bans]
             
-            # Delete all bans with this ban_group_id
-            result = conn.execute(
-                text("""
-                    DELETE FROM bans
-                    WHERE ban_group_id = :ban_group_id
-                """),
-                {"ban_group_id": ban_group_id}
-            )
+        # Delete all bans with this ban_group_id
+        result = conn.execute(
+            text("""
+                DELETE FROM bans
+                WHERE ban_group_id = :ban_group_id
+            """),
+            {"ban_group_id": ban_group_id}
+        )
         
-        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
         log_audit_event(
             server_name=server_name,
             actor_user_id=user["id"] if user else None,
             action="player_unbanned",
             summary=f"Unbanned {minecraft_username}",
             details={"minecraft_username": minecraft_username, "device_count": len(device_ids)},
+            conn=conn,
         )
         return {
             "ok": True,
@@ -3,11 +3,14 @@
 from fastapi import APIRouter, HTTPException, Depends, Query, Header
 from pydantic import BaseModel, Field
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from typing import Optional, Literal
-from datetime import datetime, timezone, timedelta
 
-from database import engine
+from database import REQUEST_CONNECTION, engine
 from auth import require_server_access, require_master_admin
+import cascade_delete
+import prune_engine
+import server_config
 from audit import log_audit_event, maybe_get_user
 from fastapi.responses import JSONResponse
 
@@ -33,49 +36,51 @@ class ClaimWindowSettingsRequest(BaseModel):
 
 
 @router.get("/v1/servers/info")
-def get_server_info(server_name: str = Depends(require_server_access)):
+def get_server_info(
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
     """
     Get your server's information and settings.
     Requires server API key (X-API-Key header).
     """
     try:
-        with engine.begin() as conn:
-            server = conn.execute(
-                text("""
-                    SELECT 
-                        k.server_name,
-                        k.max_players,
-                        k.created_at,
-                        k.last_used,
-                        k.active,
-                        s.is_private,
-                        s.invite_code,
-                        s.claim_buffer_days
-                    FROM api_keys k
-                    JOIN servers s ON s.server_name = k.server_name
-                    WHERE k.server_name = :server_name
-                """),
-                {"server_name": server_name}
-            ).mappings().fetchone()
+        server = conn.execute(
+            text("""
+                SELECT 
+                    k.server_name,
+                    k.max_players,
+                    k.created_at,
+                    k.last_used,
+                    k.active,
+                    s.is_private,
+                    s.invite_code,
+                    s.claim_buffer_days
+                FROM api_keys k
+                JOIN servers s ON s.server_name = k.server_name
+                WHERE k.server_name = :server_name
+            """),
+            {"server_name": server_name}
+        ).mappings().fetchone()
             
-            if not server:
-                raise HTTPException(status_code=404, detail="Server not found")
+        if not server:
+            raise HTTPException(status_code=404, detail="Server not found")
             
-            # Get current player count
-            player_count = conn.execute(
-                text("""
-                    SELECT COUNT(DISTINCT minecraft_username) 
-                    FROM player_keys 
-                    WHERE server_name = :server_name AND active = TRUE
-                """),
-                {"server_name": server_name}
-            ).scalar()
+        # Get current player count
+        player_count = conn.execute(
+            text("""
+                SELECT COUNT(DISTINCT minecraft_username) 
+                FROM player_keys 
+                WHERE server_name = :server_name AND active = TRUE
+            """),
+            {"server_name": server_name}
+        ).scalar()
             
-            result = dict(server)
-            result["current_players"] = player_count
-            result["slots_available"] = None if result["max_players"] is None else result["max_players"] - player_count
+        result = dict(server)
+        result["current_players"] = player_count
+        result["slots_available"] = None if result["max_players"] is None else result["max_players"] - player_count
             
-            return result
+        return result
     
     except HTTPException:
         raise
@@ -84,23 +89,17 @@ def get_server_info(server_name: str = Depends(require_server_access)):
 
 
 @router.get("/v1/servers/claim-window")
-def get_claim_window(server_name: str = Depends(require_server_access)):
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT claim_buffer_days
-                FROM servers
-                WHERE server_name = :server
-            """),
-            {"server": server_name},
-        ).fetchone()
-
-    if not row:
+def get_claim_window(
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    config = server_config.get(server_name, conn)
+    if not config["exists"]:
         raise HTTPException(status_code=404, detail="Server not found")
 
     return {
         "server_name": server_name,
-        "claim_buffer_days": row[0] if row[0] is not None else 1,
+        "claim_buffer_days": config["claim_buffer_days"],
     }
 
 
@@ -108,16 +107,17 @@ def get_claim_window(server_name: str = Depends(require_server_access)):
 def update_claim_window(
     payload: ClaimWindowSettingsRequest,
     server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
 ):
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
-                UPDATE servers
-                SET claim_buffer_days = :days
-                WHERE server_name = :server
-            """),
-            {"days": payload.claim_buffer_days, "server": server_name},
-        )
+    conn.execute(
+        text("""
+            UPDATE servers
+            SET claim_buffer_days = :days
+            WHERE server_name = :server
+        """),
+        {"days": payload.claim_buffer_days, "server": server_name},
+    )
+    server_config.invalidate(server_name, conn)
 
     return {
         "server_name": server_name,
@@ -126,39 +126,43 @@ def update_claim_window(
 
 
 @router.post("/v1/servers/toggle-privacy")
-def toggle_server_privacy(request: TogglePrivacyRequest, server_name: str = Depends(require_server_access)):
+def toggle_server_privacy(
+    request: TogglePrivacyRequest,
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
     """
     Toggle server privacy (public/private) and regenerate invite code if switching to private.
     Requires server API key (X-API-Key header).
     """
     from utils import generate_invite_code
     try:
-        with engine.begin() as conn:
-            server = conn.execute(
-                text("SELECT is_private, invite_code FROM servers WHERE server_name = :server_name"),
-                {"server_name": server_name}
-            ).mappings().fetchone()
+        server = conn.execute(
+            text("SELECT is_private, invite_code FROM servers WHERE server_name = :server_name"),
+            {"server_name": server_name}
+        ).mappings().fetchone()
 
-            if not server:
-                raise HTTPException(status_code=404, detail=f"Server '{server_name}' not found")
+        if not server:
+            raise HTTPException(status_code=404, detail=f"Server '{server_name}' not found")
 
-            invite_code = server["invite_code"]
-            if request.is_private and (not server["is_private"] or not invite_code):
-                invite_code = generate_invite_code()
+        invite_code = server["invite_code"]
+        if request.is_private and (not server["is_private"] or not invite_code):
+            invite_code = generate_invite_code()
 
-            conn.execute(
-                text("""
-                    UPDATE servers
-                    SET is_private = :is_private,
-                        invite_code = :invite_code
-                    WHERE server_name = :server_name
-                """),
-                {
-                    "is_private": request.is_private,
-                    "invite_code": invite_code if request.is_private else invite_code,
-                    "server_name": server_name,
-                }
-            )
+        conn.execute(
+            text("""
+                UPDATE servers
+                SET is_private = :is_private,
+                    invite_code = :invite_code
+                WHERE server_name = :server_name
+            """),
+            {
+                "is_private": request.is_private,
+                "invite_code": invite_code if request.is_private else invite_code,
+                "server_name": server_name,
+            }
+        )
+        server_config.invalidate(server_name, conn)
 
         return {"ok": True, "is_private": request.is_private, "invite_code": invite_code if request.is_private else None}
     except HTTPException:
@@ -221,7 +225,7 @@ def admin_update_server_settings(
                 if request.max_players < current_players:
                     warning = f"Warning: You set max_players to {request.max_players}, but server currently has {current_players} registered players. New registrations will be blocked until players are removed."
                 
-                return {
+                result = {
                     "ok": True,
                     "server_name": server_name,
                     "max_players": request.max_players,
@@ -241,13 +245,15 @@ def admin_update_server_settings(
                     {"server_name": server_name}
                 )
                 
-                return {
+                result = {
                     "ok": True,
                     "server_name": server_name,
                     "max_players": None,
                     "current_players": current_players,
                     "message": f"Set '{server_name}' to unlimited players"
                 }
+        server_config.invalidate(server_name)
+        return result
     
     except HTTPException:
         raise
@@ -260,73 +266,81 @@ def list_server_players(
     server_name: str = Depends(require_server_access),
     limit: int = 100,
     offset: int = 0,
-    q: str | None = None
+    q: str | None = None,
+    sort: Literal["registered", "last_activity"] = "registered",
+    conn: Connection = REQUEST_CONNECTION,
 ):
     """
     List all registered players on your server.
     Requires server API key (X-API-Key header).
     
-    Returns paginated list of players with their registration info.
+    Returns paginated list of players with their registration info, newest
+    registration first or (sort=last_activity) most recently active first.
     """
     try:
-        with engine.begin() as conn:
-            query_params = {"server_name": server_name, "limit": limit, "offset": offset}
-            query_filter = ""
-            if q:
-                query_filter = "AND minecraft_username ILIKE :q"
-                query_params["q"] = f"%{q}%"
-
-            players = conn.execute(
-                text(f"""
-                    SELECT
-                        minecraft_username,
-                        COUNT(DISTINCT device_id) AS device_count,
-                        MAX(created_at) AS created_at,
-                        MAX(last_used) AS last_used,
-                        BOOL_OR(active) AS active
-                    FROM player_keys
-                    WHERE server_name = :server_name
-                      {query_filter}
-                    GROUP BY minecraft_username
-                    ORDER BY MAX(created_at) DESC
-                    LIMIT :limit OFFSET :offset
-                """),
-                query_params,
-            ).mappings().all()
-
-            total = conn.execute(
-                text(f"""
-                    SELECT COUNT(DISTINCT minecraft_username)
-                    FROM player_keys
-                    WHERE server_name = :server_name
-                      {query_filter}
-                """),
-                query_params,
-            ).scalar()
+        query_params = {"server_name": server_name, "limit": limit, "offset": offset}
+        query_filter = ""
+        order_by = "MAX(created_at) DESC"
+        if sort == "last_activity":
+            order_by = "MAX(last_activity_at) DESC NULLS LAST, minecraft_username"
+        if q:
+            query_filter = "AND minecraft_username ILIKE :q"
+            query_params["q"] = f"%{q}%"
+
+        players = conn.execute(
+            text(f"""
+                SELECT
+                    minecraft_username,
+                    COUNT(DISTINCT device_id) AS device_count,
+                    MAX(created_at) AS created_at,
+                    MAX(last_used) AS last_used,
+                    MAX(last_activity_at) AS last_activity_at,
+                    BOOL_OR(active) AS active
+                FROM player_keys
+                WHERE server_name = :server_name
+                  {query_filter}
+                GROUP BY minecraft_username
+                ORDER BY {order_by}
+                LIMIT :limit OFFSET :offset
+            """),
+            query_params,
+        ).mappings().all()
+
+        total = conn.execute(
+            text(f"""
+                SELECT COUNT(DISTINCT minecraft_username)
+                FROM player_keys
+                WHERE server_name = :server_name
+                  {query_filter}
+            """),
+            query_params,
+        ).scalar()
             
-            return {
-                "server_name": server_name,
-                "total_players": total,
-                "players": [dict(p) for p in players],
-                "limit": limit,
-                "offset": offset
-            }
+        return {
+            "server_name": server_name,
+            "total_players": total,
+            "players": [dict(p) for p in players],
+            "limit": limit,
+            "offset": offset
+        }
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list players: {str(e)}")
 
 
 @router.get("/v1/servers/inactive-prune")
-def get_inactive_prune_settings(server_name: str = Depends(require_server_access)):
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT inactive_prune_enabled, inactive_prune_days, inactive_prune_mode
-                FROM servers
-                WHERE server_name = :server
-            """),
-            {"server": server_name},
-        ).fetchone()
+def get_inactive_prune_settings(
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    row = conn.execute(
+        text("""
+            SELECT inactive_prune_enabled, inactive_prune_days, inactive_prune_mode
+            FROM servers
+            WHERE server_name = :server
+        """),
+        {"server": server_name},
+    ).fetchone()
 
     if not row:
         raise HTTPException(status_code=404, detail="Server not found")
@@ -343,26 +357,26 @@ def get_inactive_prune_settings(server_name: str = Depends(require_server_access
 def update_inactive_prune_settings(
     payload: InactivePruneSettingsRequest,
     server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     if payload.enabled and payload.max_inactive_days is None:
         raise HTTPException(status_code=400, detail="max_inactive_days is required when enabled")
 
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
-                UPDATE servers
-                SET inactive_prune_enabled = :enabled,
-                    inactive_prune_days = :days,
-                    inactive_prune_mode = :mode
-                WHERE server_name = :server
-            """),
-            {
-                "enabled": payload.enabled,
-                "days": payload.max_inactive_days,
-                "mode": payload.mode,
-                "server": server_name,
-            },
-        )
+    conn.execute(
+        text("""
+            UPDATE servers
+            SET inactive_prune_enabled = :enabled,
+                inactive_prune_days = :days,
+                inactive_prune_mode = :mode
+            WHERE server_name = :server
+        """),
+        {
+            "enabled": payload.enabled,
+            "days": payload.max_inactive_days,
+            "mode": payload.mode,
+            "server": server_name,
+        },
+    )
 
     return {
         "server_name": server_name,
@@ -376,142 +390,32 @@ def update_inactive_prune_settings(
 def run_inactive_prune(
     dry_run: bool = Query(False),
     server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
 ):
-    with engine.begin() as conn:
-        settings = conn.execute(
-            text("""
-                SELECT inactive_prune_enabled, inactive_prune_days, inactive_prune_mode
-                FROM servers
-                WHERE server_name = :server
-            """),
-            {"server": server_name},
-        ).fetchone()
-
-        if not settings:
-            raise HTTPException(status_code=404, detail="Server not found")
-
-        enabled = bool(settings[0]) if settings[0] is not None else False
-        days = settings[1]
-        mode = settings[2] or "deactivate"
-
-        if not enabled:
-            raise HTTPException(status_code=400, detail="Inactive prune is disabled for this server")
-        if days is None or days <= 0:
-            raise HTTPException(status_code=400, detail="Invalid max_inactive_days setting")
-
-        rows = conn.execute(
-            text("""
-                SELECT
-                    pk.id,
-                    pk.minecraft_username,
-                    pk.device_id,
-                    pk.created_at,
-                    MAX(sc.claimed_at) AS last_claimed_at
-                FROM player_keys pk
-                LEFT JOIN step_claims sc
-                  ON sc.server_name = pk.server_name
-                 AND sc.minecraft_username = pk.minecraft_username
-                 AND sc.claimed = TRUE
-                WHERE pk.server_name = :server
-                  AND pk.active = TRUE
-                GROUP BY pk.id, pk.minecraft_username, pk.device_id, pk.created_at
-            """),
-            {"server": server_name},
-        ).mappings().all()
-
-        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-        candidates = []
-        for row in rows:
-            last_claimed = _coerce_dt(row["last_claimed_at"])
-            created_at = _coerce_dt(row["created_at"])
-            last_activity = last_claimed or created_at
-            if last_activity and last_activity < cutoff:
-                candidates.append(row)
-
-        if dry_run:
-            return {
-                "server_name": server_name,
-                "dry_run": True,
-                "mode": mode,
-                "max_inactive_days": days,
-                "candidates": [
-                    {
-                        "minecraft_username": r["minecraft_username"],
-                        "device_id": r["device_id"],
-                        "last_claimed_at": r["last_claimed_at"],
-                        "created_at": r["created_at"],
-                    }
-                    for r in candidates
-                ],
-                "total_candidates": len(candidates),
-            }
-
-        removed = []
-        delete_counts = {
-            "player_keys": 0,
-            "step_ingest": 0,
-            "step_claims": 0,
-            "push_deliveries": 0,
-            "bans": 0,
-        }
+    settings = conn.execute(
+        text("""
+            SELECT inactive_prune_enabled, inactive_prune_days, inactive_prune_mode
+            FROM servers
+            WHERE server_name = :server
+        """),
+        {"server": server_name},
+    ).fetchone()
+
+    if not settings:
+        raise HTTPException(status_code=404, detail="Server not found")
 
-        for row in candidates:
-            username = row["minecraft_username"]
-            if mode == "deactivate":
-                result = conn.execute(
-                    text("UPDATE player_keys SET active = FALSE WHERE id = :id"),
-                    {"id": row["id"]},
-                )
-                delete_counts["player_keys"] += result.rowcount
-            else:
-                delete_counts["player_keys"] += conn.execute(
-                    text("DELETE FROM player_keys WHERE id = :id"),
-                    {"id": row["id"]},
-                ).rowcount
-                delete_counts["step_ingest"] += conn.execute(
-                    text("""
-                        DELETE FROM step_ingest
-                        WHERE server_name = :server
-                          AND minecraft_username = :username
-                    """),
-                    {"server": server_name, "username": username},
-                ).rowcount
-                delete_counts["step_claims"] += conn.execute(
-                    text("""
-                        DELETE FROM step_claims
-                        WHERE server_name = :server
-                          AND minecraft_username = :username
-                    """),
-                    {"server": server_name, "username": username},
-                ).rowcount
-                delete_counts["push_deliveries"] += conn.execute(
-                    text("""
-                        DELETE FROM push_deliveries
-                        WHERE server_name = :server
-                          AND minecraft_username = :username
-                    """),
-                    {"server": server_name, "username": username},
-                ).rowcount
-                delete_counts["bans"] += conn.execute(
-                    text("""
-                        DELETE FROM bans
-                        WHERE server_name = :server
-                          AND minecraft_username = :username
-                    """),
-                    {"server": server_name, "username": username},
-                ).rowcount
+    enabled = bool(settings[0]) if settings[0] is not None else False
+    days = settings[1]
+    mode = settings[2] or "deactivate"
 
-            removed.append(username)
+    if not enabled:
+        raise HTTPException(status_code=400, detail="Inactive prune is disabled for this server")
+    if days is None or days <= 0:
+        raise HTTPException(status_code=400, detail="Invalid max_inactive_days setting")
 
-        return {
-            "server_name": server_name,
-            "dry_run": False,
-            "mode": mode,
-            "max_inactive_days": days,
-            "removed_players": removed,
-            "total_removed": len(removed),
-            "records_affected": delete_counts,
-        }
+    if dry_run:
+        return prune_engine.dry_run_report(server_name, days, mode)
+    return prune_engine.prune_server(server_name, days, mode)
 
 
 @router.delete("/v1/servers/players/{minecraft_username}")
@@ -520,16 +424,15 @@ def server_wipe_player(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     """
     Wipe all data for a specific player on your server only.
     Server owners can use this to reset a player's data and API key.
     Requires server API key (X-API-Key header).
     
-    This deletes:
-    - Player's API key registration for this server
-    - All step data for this player on this server
-    - Any bans for this player on this server
+    This deletes the player's API key registration, step data, claims, bans,
+    push tokens and delivery history on this server (see cascade_delete.py).
     
     After wiping, the player will need to re-register to submit data again.
     """
@@ -537,38 +440,9 @@ def server_wipe_player(
         raise HTTPException(status_code=400, detail="minecraft_username cannot be empty")
     
     try:
-        with engine.begin() as conn:
-            # Delete player's API key for this server
-            key_result = conn.execute(
-                text("""
-                    DELETE FROM player_keys 
-                    WHERE minecraft_username = :minecraft_username 
-                      AND server_name = :server_name
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            )
-            
-            # Delete player's step data for this server
-            step_result = conn.execute(
-                text("""
-                    DELETE FROM step_ingest 
-                    WHERE minecraft_username = :minecraft_username 
-                      AND server_name = :server_name
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            )
-            
-            # Delete any bans for this player on this server
-            ban_result = conn.execute(
-                text("""
-                    DELETE FROM bans 
-                    WHERE minecraft_username = :minecraft_username 
-                      AND server_name = :server_name
-                """),
-                {"minecraft_username": minecraft_username, "server_name": server_name}
-            )
+        deleted = cascade_delete.wipe_players(cascade_delete.resolve_players(minecraft_username, server_name))
         
-        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
         log_audit_event(
             server_name=server_name,
             actor_user_id=user["id"] if user else None,
@@ -576,37 +450,23 @@ def server_wipe_player(
             summary=f"Wiped {minecraft_username}",
             details={
                 "minecraft_username": minecraft_username,
-                "player_keys_deleted": key_result.rowcount,
-                "step_records_deleted": step_result.rowcount,
-                "bans_deleted": ban_result.rowcount,
+                "player_keys_deleted": deleted["player_keys"],
+                "step_records_deleted": deleted.get("step_ingest", 0),
+                "bans_deleted": deleted.get("bans", 0),
             },
+            conn=conn,
         )
         return {
             "ok": True,
             "action": "server_wiped_player",
             "minecraft_username": minecraft_username,
             "server_name": server_name,
-            "player_keys_deleted": key_result.rowcount,
-            "step_records_deleted": step_result.rowcount,
-            "bans_deleted": ban_result.rowcount,
+            "player_keys_deleted": deleted["player_keys"],
+            "step_records_deleted": deleted.get("step_ingest", 0),
+            "bans_deleted": deleted.get("bans", 0),
+            "deleted": deleted,
             "message": f"Wiped all data for '{minecraft_username}' on server '{server_name}'. Player will need to re-register."
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to wipe player data: {str(e)}")
 
-
-def _coerce_dt(value) -> datetime | None:
-    if value is None:
-        return None
-    if isinstance(value, datetime):
-        dt = value
-    elif isinstance(value, str):
-        try:
-            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
-        except Exception:
-            return None
-    else:
-        return None
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt
@@ -2,62 +2,68 @@
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
-from database import engine
+from database import REQUEST_CONNECTION, engine
 from auth import require_user
+import auth_cache
+import cascade_delete
+import server_config
 from audit import log_audit_event
 
 router = APIRouter()
 
 
 @router.get("/v1/servers/owned")
-def list_owned_servers(user=Depends(require_user)):
-    with engine.begin() as conn:
-        # Backfill ownership for legacy rows that only have owner_email
-        conn.execute(
-            text("""
-                UPDATE servers
-                SET owner_user_id = :user_id
-                WHERE owner_user_id IS NULL
-                  AND owner_email = :owner_email
-            """),
-            {"user_id": user["id"], "owner_email": user["email"]},
-        )
+def list_owned_servers(
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    # Backfill ownership for legacy rows that only have owner_email
+    conn.execute(
+        text("""
+            UPDATE servers
+            SET owner_user_id = :user_id
+            WHERE owner_user_id IS NULL
+              AND owner_email = :owner_email
+        """),
+        {"user_id": user["id"], "owner_email": user["email"]},
+    )
 
-        conn.execute(
-            text("""
-                UPDATE api_keys
-                SET owner_user_id = :user_id
-                WHERE owner_user_id IS NULL
-                  AND server_name IN (
-                      SELECT server_name FROM servers WHERE owner_email = :owner_email
-                  )
-            """),
-            {"user_id": user["id"], "owner_email": user["email"]},
-        )
+    conn.execute(
+        text("""
+            UPDATE api_keys
+            SET owner_user_id = :user_id
+            WHERE owner_user_id IS NULL
+              AND server_name IN (
+                  SELECT server_name FROM servers WHERE owner_email = :owner_email
+              )
+        """),
+        {"user_id": user["id"], "owner_email": user["email"]},
+    )
 
-        rows = conn.execute(
-            text("""
-                SELECT 
-                    s.server_name,
-                    s.owner_email,
-                    s.server_address,
-                    s.server_version,
-                    s.created_at,
-                    s.is_private,
-                    s.invite_code,
-                    COALESCE(MAX(CASE WHEN k.active THEN 1 ELSE 0 END), 0) AS api_active,
-                    COUNT(k.id) AS key_count
-                FROM servers s
-                LEFT JOIN api_keys k
-                  ON k.server_name = s.server_name
-                 AND k.owner_user_id = s.owner_user_id
-                WHERE s.owner_user_id = :user_id
-                GROUP BY s.server_name, s.owner_email, s.server_address, s.server_version, s.created_at, s.is_private, s.invite_code
-                ORDER BY s.created_at DESC
-            """),
-            {"user_id": user["id"]}
-        ).mappings().all()
+    rows = conn.execute(
+        text("""
+            SELECT 
+                s.server_name,
+                s.owner_email,
+                s.server_address,
+                s.server_version,
+                s.created_at,
+                s.is_private,
+                s.invite_code,
+                COALESCE(MAX(CASE WHEN k.active THEN 1 ELSE 0 END), 0) AS api_active,
+                COUNT(k.id) AS key_count
+            FROM servers s
+            LEFT JOIN api_keys k
+              ON k.server_name = s.server_name
+             AND k.owner_user_id = s.owner_user_id
+            WHERE s.owner_user_id = :user_id
+            GROUP BY s.server_name, s.owner_email, s.server_address, s.server_version, s.created_at, s.is_private, s.invite_code
+            ORDER BY s.created_at DESC
+        """),
+        {"user_id": user["id"]}
+    ).mappings().all()
 
     servers = []
     for row in rows:
@@ -72,25 +78,31 @@ def list_owned_servers(user=Depends(require_user)):
 
 
 @router.post("/v1/servers/{server_name}/pause")
-def pause_server(server_name: str, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
-    with engine.begin() as conn:
-        _backfill_api_owner(conn, server_name, user["id"])
-        result = conn.execute(
-            text("""
-                UPDATE api_keys
-                SET active = FALSE
-                WHERE server_name = :server
-                  AND owner_user_id = :user_id
-            """),
-            {"server": server_name, "user_id": user["id"]},
-        )
+def pause_server(
+    server_name: str,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    _ensure_owner(conn, server_name, user["id"])
+    _backfill_api_owner(conn, server_name, user["id"])
+    result = conn.execute(
+        text("""
+            UPDATE api_keys
+            SET active = FALSE
+            WHERE server_name = :server
+              AND owner_user_id = :user_id
+        """),
+        {"server": server_name, "user_id": user["id"]},
+    )
+    auth_cache.invalidate_server(server_name, conn)
+    server_config.invalidate(server_name, conn)
     log_audit_event(
         server_name=server_name,
         actor_user_id=user["id"],
         action="server_paused",
         summary="Paused server (API key deactivated)",
         details={"keys_deactivated": result.rowcount},
+        conn=conn,
     )
     return {
         "ok": True,
@@ -101,43 +113,49 @@ def pause_server(server_name: str, user=Depends(require_user)):
 
 
 @router.post("/v1/servers/{server_name}/resume")
-def resume_server(server_name: str, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
-    with engine.begin() as conn:
-        _backfill_api_owner(conn, server_name, user["id"])
-        key_row = conn.execute(
-            text("""
-                SELECT id
-                FROM api_keys
-                WHERE server_name = :server
-                  AND owner_user_id = :user_id
-                ORDER BY created_at DESC
-                LIMIT 1
-            """),
-            {"server": server_name, "user_id": user["id"]},
-        ).fetchone()
-        if not key_row:
-            raise HTTPException(status_code=404, detail="No API key found for this server")
-
-        conn.execute(
-            text("""
-                UPDATE api_keys
-                SET active = FALSE
-                WHERE server_name = :server
-                  AND owner_user_id = :user_id
-            """),
-            {"server": server_name, "user_id": user["id"]},
-        )
-        conn.execute(
-            text("UPDATE api_keys SET active = TRUE WHERE id = :id"),
-            {"id": key_row[0]},
-        )
+def resume_server(
+    server_name: str,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    _ensure_owner(conn, server_name, user["id"])
+    _backfill_api_owner(conn, server_name, user["id"])
+    key_row = conn.execute(
+        text("""
+            SELECT id
+            FROM api_keys
+            WHERE server_name = :server
+              AND owner_user_id = :user_id
+            ORDER BY created_at DESC
+            LIMIT 1
+        """),
+        {"server": server_name, "user_id": user["id"]},
+    ).fetchone()
+    if not key_row:
+        raise HTTPException(status_code=404, detail="No API key found for this server")
+
+    conn.execute(
+        text("""
+            UPDATE api_keys
+            SET active = FALSE
+            WHERE server_name = :server
+              AND owner_user_id = :user_id
+        """),
+        {"server": server_name, "user_id": user["id"]},
+    )
+    conn.execute(
+        text("UPDATE api_keys SET active = TRUE WHERE id = :id"),
+        {"id": key_row[0]},
+    )
+    auth_cache.invalidate_server(server_name, conn)
+    server_config.invalidate(server_name, conn)
 
     log_audit_event(
         server_name=server_name,
         actor_user_id=user["id"],
         action="server_resumed",
         summary="Resumed server (API key activated)",
+        conn=conn,
     )
     return {
         "ok": True,
@@ -146,80 +164,74 @@ def resume_server(server_name: str, user=Depends(require_user)):
     }
 
 
-@router.delete("/v1/servers/{server_name}")
-def delete_server(server_name: str, user=Depends(require_user)):
-    _ensure_owner(server_name, user["id"])
+@router.delete("/v1/servers/{server_name}", status_code=202)
+def delete_server(
+    server_name: str,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    """
+    Delete a server and all of its data. The server key is revoked first; the rest
+    is deleted in the background (poll GET /v1/servers/deletion-jobs/{job_id}).
+    """
+    _ensure_owner(conn, server_name, user["id"])
     try:
-        with engine.begin() as conn:
-            _backfill_api_owner(conn, server_name, user["id"])
-            conn.execute(
-                text("DELETE FROM push_deliveries WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM push_notifications WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM push_device_tokens WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM step_claims WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM step_ingest WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM player_keys WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM bans WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM key_recovery_audit WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM server_rewards WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            conn.execute(
-                text("DELETE FROM api_keys WHERE server_name = :server"),
-                {"server": server_name},
-            )
-            result = conn.execute(
-                text("DELETE FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
-                {"server": server_name, "user_id": user["id"]},
-            )
-            if result.rowcount == 0:
-                raise HTTPException(status_code=404, detail=f"Server '{server_name}' not found")
+        def work(progress):
+            deleted = cascade_delete.delete_server_data(server_name, progress)
+            with engine.begin() as conn:
+                deleted["servers"] = conn.execute(
+                    text("DELETE FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
+                    {"server": server_name, "user_id": user["id"]},
+                ).rowcount
+            server_config.invalidate(server_name)
+            return deleted
+
+        # Queued with the audit row: the deletion starts only once this request commits
+        job_id = cascade_delete.start_job(
+            "server", work, server_name=server_name, created_by=user["id"], conn=conn
+        )
 
         log_audit_event(
             server_name=server_name,
             actor_user_id=user["id"],
             action="server_deleted",
             summary="Deleted server and all data",
+            details={"job_id": job_id},
+            conn=conn,
         )
-        return {"ok": True, "message": f"Server '{server_name}' deleted."}
+        return {
+            "ok": True,
+            "job_id": job_id,
+            "status": cascade_delete.JOB_QUEUED,
+            "message": f"Server '{server_name}' is being deleted.",
+        }
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete server: {str(e)}")
 
 
-def _ensure_owner(server_name: str, user_id: int) -> None:
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
-            {"server": server_name, "user_id": user_id},
-        ).fetchone()
-        if not row:
-            raise HTTPException(status_code=403, detail="Not authorized for this server")
+@router.get("/v1/servers/deletion-jobs/{job_id}")
+def get_deletion_job(job_id: int, user=Depends(require_user)):
+    """Progress of a server deletion started by the current user."""
+    try:
+        job = cascade_delete.get_job(job_id)
+        if job is None or job["created_by"] != user["id"]:
+            raise HTTPException(status_code=404, detail=f"Deletion job {job_id} not found")
+        return {"ok": True, **job}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get deletion job: {str(e)}")
+
+
+def _ensure_owner(conn, server_name: str, user_id: int) -> None:
+    row = conn.execute(
+        text("SELECT id FROM servers WHERE server_name = :server AND owner_user_id = :user_id"),
+        {"server": server_name, "user_id": user_id},
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=403, detail="Not authorized for this server")
 
 
 def _backfill_api_owner(conn, server_name: str, user_id: int) -> None:
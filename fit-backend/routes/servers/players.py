@@ -4,8 +4,12 @@ from fastapi import APIRouter, HTTPException, Depends, Query
 from sqlalchemy import text
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta, timezone
-from database import engine
-from auth import require_server_access
+from database import REQUEST_TRANSACTION, RequestTransaction
+from auth import require_server_access, require_server_access_async
+from models import ClaimAvailableRequest, ClaimRewardsRequest
+import cascade_delete
+import claim_engine
+import server_config
 
 CENTRAL_TZ = ZoneInfo("America/Chicago")
 router = APIRouter()
@@ -16,13 +20,18 @@ DEFAULT_REWARDS = [
     {"min_steps": 10000, "label": "Legend", "item_id": "minecraft:diamond", "rewards": ["give {player} minecraft:diamond 1"]},
 ]
 
+# The plugin polls these on every join and claim, so they are async: auth, config
+# misses and the handler's queries share the request's RequestTransaction and do
+# not hold threadpool threads.
+
 # Server endpoint: check claim status for a day (defaults to today)
 @router.get("/v1/servers/players/{minecraft_username}/claim-status")
-def get_claim_status_server(
+async def get_claim_status_server(
     minecraft_username: str,
     day: str | None = Query(default=None),
     min_steps: int | None = Query(default=None),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Check if the player has claimed their reward for a specific day.
@@ -33,33 +42,26 @@ def get_claim_status_server(
     if min_steps < 0:
         raise HTTPException(status_code=400, detail="min_steps must be >= 0")
 
-    target_day = _resolve_claim_day(day, server_name)
-    resolved_username = _resolve_username(minecraft_username, server_name)
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT claimed, claimed_at FROM step_claims
-                WHERE minecraft_username = :username AND server_name = :server AND day = :day AND min_steps = :min_steps
-                LIMIT 1
-            """),
-            {
-                "username": resolved_username,
-                "server": server_name,
-                "day": target_day,
-                "min_steps": min_steps,
-            }
-        ).fetchone()
+    config = await server_config.get_async(server_name, tx)
+    target_day = _resolve_claim_day(day, config["claim_buffer_days"])
+
+    def load(conn):
+        resolved_username = _resolve_username(conn, minecraft_username, server_name)
+        return _load_claim(conn, resolved_username, server_name, target_day, min_steps)
+
+    row = await tx.run(load)
     if row:
         return {"claimed": row[0], "claimed_at": row[1], "day": str(target_day), "min_steps": min_steps}
     else:
         return {"claimed": False, "claimed_at": None, "day": str(target_day), "min_steps": min_steps}
 
 @router.post("/v1/servers/players/{minecraft_username}/claim-reward")
-def claim_reward_server(
+async def claim_reward_server(
     minecraft_username: str,
     day: str | None = Query(default=None),
     min_steps: int | None = Query(default=None),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Mark the player's reward as claimed for a specific day.
@@ -70,32 +72,15 @@ def claim_reward_server(
     if min_steps < 0:
         raise HTTPException(status_code=400, detail="min_steps must be >= 0")
 
-    target_day = _resolve_claim_day(day, server_name)
-    resolved_username = _resolve_username(minecraft_username, server_name)
+    config = await server_config.get_async(server_name, tx)
+    target_day = _resolve_claim_day(day, config["claim_buffer_days"])
     now = datetime.now(timezone.utc)
-    with engine.begin() as conn:
-        existing = conn.execute(
-            text("""
-                SELECT claimed, claimed_at FROM step_claims
-                WHERE minecraft_username = :username AND server_name = :server AND day = :day AND min_steps = :min_steps
-                LIMIT 1
-            """),
-            {
-                "username": resolved_username,
-                "server": server_name,
-                "day": target_day,
-                "min_steps": min_steps,
-            }
-        ).fetchone()
 
+    def claim(conn):
+        resolved_username = _resolve_username(conn, minecraft_username, server_name)
+        existing = _load_claim(conn, resolved_username, server_name, target_day, min_steps)
         if existing and existing[0]:
-            return {
-                "claimed": True,
-                "claimed_at": existing[1],
-                "already_claimed": True,
-                "day": str(target_day),
-                "min_steps": min_steps,
-            }
+            return existing
 
         conn.execute(
             text("""
@@ -112,19 +97,74 @@ def claim_reward_server(
                 "claimed_at": now,
             }
         )
+        claim_engine.record_player_activity(conn, server_name, resolved_username, now)
+        return None
+
+    existing = await tx.run(claim)
+    if existing:
+        return {
+            "claimed": True,
+            "claimed_at": existing[1],
+            "already_claimed": True,
+            "day": str(target_day),
+            "min_steps": min_steps,
+        }
     return {"claimed": True, "claimed_at": now.isoformat(), "day": str(target_day), "min_steps": min_steps}
 
+
+@router.post("/v1/servers/players/{minecraft_username}/claim-rewards")
+async def claim_rewards_server(
+    minecraft_username: str,
+    payload: ClaimRewardsRequest,
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
+):
+    """
+    Claim several reward tiers for a player in one request (plugin auto-claim).
+    Each item is checked against the claim window and the player's steps for that
+    day; valid items are claimed in a single statement. Items that were already
+    claimed are reported with already_claimed instead of failing the batch.
+    """
+    config = await server_config.get_async(server_name, tx)
+
+    def claim(conn):
+        resolved_username = _resolve_username(conn, minecraft_username, server_name)
+        return resolved_username, claim_engine.claim_rewards(
+            conn,
+            server_name,
+            resolved_username,
+            [(item.day, item.min_steps) for item in payload.claims],
+            config["claim_buffer_days"],
+        )
+
+    try:
+        resolved_username, results = await tx.run(claim)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to claim rewards: {str(e)}")
+
+    claimed = [r for r in results if r["claimed"]]
+    already = sum(1 for r in claimed if r["already_claimed"])
+    return {
+        "server_name": server_name,
+        "minecraft_username": resolved_username,
+        "claimed_count": len(claimed) - already,
+        "already_claimed_count": already,
+        "rejected_count": len(results) - len(claimed),
+        "results": results,
+    }
+
 @router.get("/v1/servers/players")
-def get_server_players(
+async def get_server_players(
     limit: int = 1000,
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Get all player data for this server.
     Requires server API key. Returns all step submissions scoped to this server.
     """
-    with engine.begin() as conn:
-        rows = conn.execute(
+    def load(conn):
+        return conn.execute(
             text("""
             SELECT
                 minecraft_username,
@@ -141,6 +181,8 @@ def get_server_players(
             {"server_name": server_name, "limit": limit},
         ).mappings().all()
 
+    rows = await tx.run(load)
+
     # Convert timestamps to ISO format in server timezone
     out: list[dict] = []
     for r in rows:
@@ -157,39 +199,36 @@ def get_server_players(
     }
 
 
-def _load_player_day_steps(
+async def _load_player_day_steps(
+    tx: RequestTransaction,
     minecraft_username: str,
     server_name: str,
     day: str | None,
 ) -> tuple[str, int]:
-    yesterday = (datetime.now(CENTRAL_TZ) - timedelta(days=1)).date()
-    target_day = _resolve_claim_day(day, server_name) if day else yesterday
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT steps_today FROM step_ingest
-                WHERE minecraft_username = :username AND server_name = :server AND day = :day
-                LIMIT 1
-            """),
-            {"username": minecraft_username, "server": server_name, "day": target_day}
-        ).fetchone()
+    if day:
+        config = await server_config.get_async(server_name, tx)
+        target_day = _resolve_claim_day(day, config["claim_buffer_days"])
+    else:
+        target_day = (datetime.now(CENTRAL_TZ) - timedelta(days=1)).date()
+    row = await tx.run(_load_day_steps, minecraft_username, server_name, target_day)
     if not row:
         raise HTTPException(status_code=404, detail=f"No step record found for {minecraft_username} on {str(target_day)}.")
     return str(target_day), int(row[0])
 
 
 @router.get("/v1/servers/players/{minecraft_username}/today-steps")
-def get_today_steps_server(
+async def get_today_steps_server(
     minecraft_username: str,
     day: str | None = Query(default=None),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Get step count for a player on a server day.
     Defaults to yesterday in server timezone when day is not provided.
     Requires server API key.
     """
-    target_day, steps_value = _load_player_day_steps(minecraft_username, server_name, day)
+    target_day, steps_value = await _load_player_day_steps(tx, minecraft_username, server_name, day)
     return {
         "minecraft_username": minecraft_username,
         "server_name": server_name,
@@ -199,15 +238,16 @@ def get_today_steps_server(
 
 
 @router.get("/v1/servers/players/{minecraft_username}/yesterday-steps")
-def get_yesterday_steps_server_legacy(
+async def get_yesterday_steps_server_legacy(
     minecraft_username: str,
     day: str | None = Query(default=None),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Legacy alias for older clients.
     """
-    target_day, steps_value = _load_player_day_steps(minecraft_username, server_name, day)
+    target_day, steps_value = await _load_player_day_steps(tx, minecraft_username, server_name, day)
     return {
         "minecraft_username": minecraft_username,
         "server_name": server_name,
@@ -218,42 +258,37 @@ def get_yesterday_steps_server_legacy(
 
 
 @router.get("/v1/servers/players/{minecraft_username}/day-steps")
-def get_day_steps_server(
+async def get_day_steps_server(
     minecraft_username: str,
     day: str = Query(...),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     Get step count for a player on a specific day (within claim window).
     Requires server API key.
     """
-    target_day = _resolve_claim_day(day, server_name)
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT steps_today FROM step_ingest
-                WHERE minecraft_username = :username AND server_name = :server AND day = :day
-                LIMIT 1
-            """),
-            {"username": minecraft_username, "server": server_name, "day": target_day}
-        ).fetchone()
+    config = await server_config.get_async(server_name, tx)
+    target_day = _resolve_claim_day(day, config["claim_buffer_days"])
+    row = await tx.run(_load_day_steps, minecraft_username, server_name, target_day)
     if row:
         return {"minecraft_username": minecraft_username, "server_name": server_name, "day": str(target_day), "steps": row[0]}
     raise HTTPException(status_code=404, detail=f"No step record found for {minecraft_username} on {str(target_day)}.")
 
 
 @router.get("/v1/servers/players/{minecraft_username}/all-steps")
-def get_all_steps_server(
+async def get_all_steps_server(
     minecraft_username: str,
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
     limit: int = Query(default=500, ge=1, le=5000),
 ):
     """
     List all step ingests for a player on this server.
     Returns most recent first.
     """
-    with engine.begin() as conn:
-        rows = conn.execute(
+    def load(conn):
+        return conn.execute(
             text("""
                 SELECT day, steps_today, source, created_at, device_id
                 FROM step_ingest
@@ -265,6 +300,8 @@ def get_all_steps_server(
             {"username": minecraft_username, "server": server_name, "limit": limit},
         ).mappings().all()
 
+    rows = await tx.run(load)
+
     out = []
     for r in rows:
         d = dict(r)
@@ -281,184 +318,117 @@ def get_all_steps_server(
 
 
 @router.get("/v1/servers/players/{minecraft_username}/claim-available")
-def get_claim_available(
+async def get_claim_available(
     minecraft_username: str,
     debug: bool = Query(default=False),
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     List all claimable reward tiers within the claim window for a player.
     Returns items with day + min_steps + label (one entry per tier per day).
     """
-    today = datetime.now(CENTRAL_TZ).date()
-    buffer_days = _get_claim_buffer_days(server_name)
-    days = [today - timedelta(days=offset) for offset in range(buffer_days + 1)]
-    resolved_username = _resolve_username(minecraft_username, server_name)
+    config = await server_config.get_async(server_name, tx)
+    buffer_days = config["claim_buffer_days"]
+    days = claim_engine.claim_window_days(buffer_days)
+    tiers = claim_engine.load_tiers(server_name, DEFAULT_REWARDS, config)
 
     debug_info = {
         "server_name": server_name,
-        "resolved_username": resolved_username,
+        "resolved_username": minecraft_username,
         "buffer_days": buffer_days,
         "days": [str(d) for d in days],
         "tiers": [],
         "steps_by_day": {},
         "claimed_by_day": {},
     }
+    if debug:
+        debug_info["tiers"] = [
+            {"min_steps": t["min_steps"], "label": t["label"], "item_id": t.get("item_id")}
+            for t in tiers
+        ]
+
+    def load(conn):
+        resolved_username = _resolve_username(conn, minecraft_username, server_name)
+        debug_info["resolved_username"] = resolved_username
+        return claim_engine.claim_items(
+            conn,
+            server_name,
+            [resolved_username],
+            tiers,
+            days,
+            debug_info=debug_info if debug else None,
+        )[resolved_username]
+
+    items = await tx.run(load)
 
-    with engine.begin() as conn:
-        tiers = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).mappings().all()
+    return {"server_name": server_name, "items": items, "debug": debug_info} if debug else {"server_name": server_name, "items": items}
 
-        if debug:
-            debug_info["tiers"] = [
-                {"min_steps": t["min_steps"], "label": t["label"]}
-                for t in tiers
-            ]
-
-        if not tiers:
-            tiers = [{"min_steps": r["min_steps"], "label": r["label"], "item_id": r.get("item_id")} for r in DEFAULT_REWARDS]
-            if debug:
-                debug_info["tiers"] = [
-                    {"min_steps": t["min_steps"], "label": t["label"], "item_id": t.get("item_id")}
-                    for t in tiers
-                ]
-
-        items = []
-        for day in days:
-            day_str = str(day)
-            steps_row = conn.execute(
-                text("""
-                    SELECT steps_today FROM step_ingest
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                    LIMIT 1
-                """),
-                {"username": resolved_username, "server": server_name, "day": day_str},
-            ).fetchone()
-
-            if not steps_row:
-                if debug:
-                    debug_info["steps_by_day"][str(day)] = None
-                continue
-
-            steps = steps_row[0]
-            if debug:
-                debug_info["steps_by_day"][str(day)] = steps
-            eligible = [tier for tier in tiers if steps >= tier["min_steps"]]
-            if not eligible:
-                continue
-
-            claimed_rows = conn.execute(
-                text("""
-                    SELECT min_steps FROM step_claims
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                      AND claimed = TRUE
-                """),
-                {"username": resolved_username, "server": server_name, "day": day_str},
-            ).fetchall()
-            claimed_set = {row[0] for row in claimed_rows}
-            if debug:
-                debug_info["claimed_by_day"][str(day)] = sorted(claimed_set)
-
-            for tier in eligible:
-                if tier["min_steps"] in claimed_set:
-                    continue
-                items.append(
-                    {
-                        "day": str(day),
-                        "min_steps": tier["min_steps"],
-                        "label": tier["label"],
-                        "item_id": tier.get("item_id"),
-                    }
-                )
 
-    return {"server_name": server_name, "items": items, "debug": debug_info} if debug else {"server_name": server_name, "items": items}
+@router.post("/v1/servers/claim-available")
+async def get_claim_available_bulk(
+    payload: ClaimAvailableRequest,
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
+):
+    """
+    List claimable reward tiers for several players at once (server restart join burst).
+    Same items as claim-available, keyed by the requested username; the tier list and
+    the whole window for all players are loaded with one query each.
+    """
+    requested = list(dict.fromkeys(u for u in payload.usernames if u))
+    config = await server_config.get_async(server_name, tx)
+    days = claim_engine.claim_window_days(config["claim_buffer_days"])
+    tiers = claim_engine.load_tiers(server_name, DEFAULT_REWARDS, config)
+
+    def load(conn):
+        resolved = claim_engine.resolve_usernames(conn, server_name, requested)
+        items = claim_engine.claim_items(
+            conn,
+            server_name,
+            list(dict.fromkeys(resolved.values())),
+            tiers,
+            days,
+        )
+        return resolved, items
+
+    resolved, items = await tx.run(load)
+
+    return {
+        "server_name": server_name,
+        "players": {
+            name: {"minecraft_username": resolved[name], "items": items[resolved[name]]}
+            for name in requested
+        },
+    }
 
 
 @router.get("/v1/servers/players/{minecraft_username}/claim-status-list")
-def get_claim_status_list(
+async def get_claim_status_list(
     minecraft_username: str,
-    server_name: str = Depends(require_server_access),
+    server_name: str = Depends(require_server_access_async),
+    tx: RequestTransaction = REQUEST_TRANSACTION,
 ):
     """
     List claim status for all eligible reward tiers within the claim window for a player.
     Only returns tiers the player is eligible to claim (per day in window).
     """
-    today = datetime.now(CENTRAL_TZ).date()
-    buffer_days = _get_claim_buffer_days(server_name)
-    days = [today - timedelta(days=offset) for offset in range(buffer_days + 1)]
-    resolved_username = _resolve_username(minecraft_username, server_name)
-
-    with engine.begin() as conn:
-        tiers = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).mappings().all()
-
-        if not tiers:
-            tiers = [{"min_steps": r["min_steps"], "label": r["label"], "item_id": r.get("item_id")} for r in DEFAULT_REWARDS]
-
-        items = []
-        for day in days:
-            day_str = str(day)
-            steps_row = conn.execute(
-                text("""
-                    SELECT steps_today FROM step_ingest
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                    LIMIT 1
-                """),
-                {"username": resolved_username, "server": server_name, "day": day_str},
-            ).fetchone()
-
-            if not steps_row:
-                continue
-
-            steps = steps_row[0]
-            eligible = [tier for tier in tiers if steps >= tier["min_steps"]]
-            if not eligible:
-                continue
-
-            claimed_rows = conn.execute(
-                text("""
-                    SELECT min_steps, claimed, claimed_at FROM step_claims
-                    WHERE minecraft_username = :username
-                      AND server_name = :server
-                      AND CAST(day AS TEXT) = :day
-                """),
-                {"username": resolved_username, "server": server_name, "day": day_str},
-            ).fetchall()
-
-            claimed_map = {row[0]: (bool(row[1]), row[2]) for row in claimed_rows}
-
-            for tier in eligible:
-                claimed, claimed_at = claimed_map.get(tier["min_steps"], (False, None))
-                items.append(
-                    {
-                        "day": day_str,
-                        "min_steps": tier["min_steps"],
-                        "label": tier["label"],
-                        "item_id": tier.get("item_id"),
-                        "claimed": claimed,
-                        "claimed_at": claimed_at,
-                    }
-                )
+    config = await server_config.get_async(server_name, tx)
+    days = claim_engine.claim_window_days(config["claim_buffer_days"])
+    tiers = claim_engine.load_tiers(server_name, DEFAULT_REWARDS, config)
+
+    def load(conn):
+        resolved_username = _resolve_username(conn, minecraft_username, server_name)
+        return claim_engine.claim_items(
+            conn,
+            server_name,
+            [resolved_username],
+            tiers,
+            days,
+            include_claimed=True,
+        )[resolved_username]
+
+    items = await tx.run(load)
 
     return {"server_name": server_name, "items": items}
 
@@ -469,92 +439,47 @@ def delete_player(
     server_name: str = Depends(require_server_access),
 ):
     """
-    Delete a player's data.
+    Delete a player's data on your server.
     
     Requires server API key.
     
     Parameters:
     - minecraft_username: Player username to delete
-    - all: If true, delete ALL data for this player across all servers.
-           If false, delete only data for this specific server.
+    - all: Rejected (403). A server key only reaches its own server; wiping a
+           player everywhere is DELETE /v1/admin/players/{minecraft_username}.
+    
+    Deletes every record of the player on this server (any case): key, step data,
+    claims, bans, push tokens and history (see cascade_delete.py).
     
     Returns deletion summary with number of records removed.
     """
     
     if not minecraft_username or len(minecraft_username.strip()) == 0:
         raise HTTPException(status_code=400, detail="minecraft_username cannot be empty")
+    if all:
+        raise HTTPException(
+            status_code=403,
+            detail="A server key can only delete players on its own server (all=true is master admin only)",
+        )
     
     try:
-        with engine.begin() as conn:
-            if all:
-                # Check if player exists at all
-                exists = conn.execute(
-                    text("""
-                        SELECT COUNT(*) as count FROM step_ingest
-                        WHERE minecraft_username = :minecraft_username
-                    """),
-                    {"minecraft_username": minecraft_username}
-                ).fetchone()
-                
-                if exists[0] == 0:
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"Player '{minecraft_username}' not found in any server"
-                    )
-                
-                # Delete all data for this player across all servers
-                result = conn.execute(
-                    text("""
-                        DELETE FROM step_ingest
-                        WHERE minecraft_username = :minecraft_username
-                    """),
-                    {"minecraft_username": minecraft_username}
-                )
-                rows_deleted = result.rowcount
-                
-                return {
-                    "ok": True,
-                    "action": "deleted_all",
-                    "minecraft_username": minecraft_username,
-                    "rows_deleted": rows_deleted,
-                    "message": f"All data for '{minecraft_username}' deleted across all servers"
-                }
-            else:
-                # Check if player exists on this specific server
-                exists = conn.execute(
-                    text("""
-                        SELECT COUNT(*) as count FROM step_ingest
-                        WHERE minecraft_username = :minecraft_username
-                        AND server_name = :server_name
-                    """),
-                    {"minecraft_username": minecraft_username, "server_name": server_name}
-                ).fetchone()
-                
-                if exists[0] == 0:
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"Player '{minecraft_username}' not found on server '{server_name}'"
-                    )
-                
-                # Delete only for this specific server
-                result = conn.execute(
-                    text("""
-                        DELETE FROM step_ingest
-                        WHERE minecraft_username = :minecraft_username
-                        AND server_name = :server_name
-                    """),
-                    {"minecraft_username": minecraft_username, "server_name": server_name}
-                )
-                rows_deleted = result.rowcount
-                
-                return {
-                    "ok": True,
-                    "action": "deleted_server",
-                    "minecraft_username": minecraft_username,
-                    "server_name": server_name,
-                    "rows_deleted": rows_deleted,
-                    "message": f"All data for '{minecraft_username}' on server '{server_name}' deleted"
-                }
+        players = cascade_delete.resolve_players(minecraft_username, server_name)
+        if not players:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Player '{minecraft_username}' not found on server '{server_name}'"
+            )
+
+        deleted = cascade_delete.wipe_players(players)
+        return {
+            "ok": True,
+            "action": "deleted_server",
+            "minecraft_username": minecraft_username,
+            "server_name": server_name,
+            "rows_deleted": sum(deleted.values()),
+            "deleted": deleted,
+            "message": f"All data for '{minecraft_username}' on server '{server_name}' deleted"
+        }
     
     except HTTPException:
         raise
@@ -562,7 +487,7 @@ def delete_player(
         raise HTTPException(status_code=500, detail=f"Failed to delete player: {str(e)}")
 
 
-def _resolve_claim_day(day: str | None, server_name: str):
+def _resolve_claim_day(day: str | None, buffer_days: int):
     today = datetime.now(CENTRAL_TZ).date()
     if day:
         try:
@@ -575,7 +500,6 @@ def _resolve_claim_day(day: str | None, server_name: str):
     if target_day > today:
         raise HTTPException(status_code=400, detail="Cannot claim future days")
 
-    buffer_days = _get_claim_buffer_days(server_name)
     earliest = today - timedelta(days=buffer_days)
     if target_day < earliest:
         raise HTTPException(status_code=400, detail="Day is outside claim window")
@@ -583,31 +507,44 @@ def _resolve_claim_day(day: str | None, server_name: str):
     return target_day
 
 
-def _get_claim_buffer_days(server_name: str) -> int:
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT claim_buffer_days FROM servers WHERE server_name = :server"),
-            {"server": server_name},
-        ).fetchone()
-    if not row or row[0] is None:
-        return 1
-    return max(0, int(row[0]))
-
-
-def _resolve_username(minecraft_username: str, server_name: str) -> str:
+def _resolve_username(conn, minecraft_username: str, server_name: str) -> str:
     if not minecraft_username:
         return minecraft_username
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                SELECT minecraft_username FROM step_ingest
-                WHERE server_name = :server
-                  AND LOWER(minecraft_username) = LOWER(:username)
-                ORDER BY day DESC
-                LIMIT 1
-            """),
-            {"server": server_name, "username": minecraft_username},
-        ).fetchone()
+    row = conn.execute(
+        text("""
+            SELECT minecraft_username FROM step_ingest
+            WHERE server_name = :server
+              AND LOWER(minecraft_username) = LOWER(:username)
+            ORDER BY day DESC
+            LIMIT 1
+        """),
+        {"server": server_name, "username": minecraft_username},
+    ).fetchone()
     return row[0] if row else minecraft_username
 
 
+def _load_claim(conn, minecraft_username: str, server_name: str, day, min_steps: int):
+    return conn.execute(
+        text("""
+            SELECT claimed, claimed_at FROM step_claims
+            WHERE minecraft_username = :username AND server_name = :server AND day = :day AND min_steps = :min_steps
+            LIMIT 1
+        """),
+        {
+            "username": minecraft_username,
+            "server": server_name,
+            "day": day,
+            "min_steps": min_steps,
+        }
+    ).fetchone()
+
+
+def _load_day_steps(conn, minecraft_username: str, server_name: str, day):
+    return conn.execute(
+        text("""
+            SELECT steps_today FROM step_ingest
+            WHERE minecraft_username = :username AND server_name = :server AND day = :day
+            LIMIT 1
+        """),
+        {"username": minecraft_username, "server": server_name, "day": day}
+    ).fetchone()
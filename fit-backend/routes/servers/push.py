@@ -3,28 +3,15 @@
 from fastapi import APIRouter, HTTPException, Depends, Header
 from pydantic import BaseModel, Field
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone
 
-from database import engine
+from database import REQUEST_CONNECTION
 from auth import require_server_access
 from audit import log_audit_event, maybe_get_user
-from apns_service import (
-    ApnsConfigError,
-    APNsException,
-    Unregistered,
-    apns_use_sandbox,
-    format_apns_exception,
-    send_push,
-)
-from apns2.errors import BadDeviceToken
-from fcm_service import (
-    FcmConfigError,
-    FirebaseError,
-    format_fcm_exception,
-    is_unregistered_fcm_error,
-    send_fcm_push,
-)
+from apns_service import ApnsConfigError, apns_use_sandbox
+import push_scheduler
 
 router = APIRouter()
 
@@ -42,18 +29,24 @@ class PushSendPayload(BaseModel):
 
 
 @router.get("/v1/servers/push")
-def list_push_notifications(server_name: str = Depends(require_server_access)):
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-                SELECT id, message, scheduled_at, created_at
-                FROM push_notifications
-                WHERE server_name = :server
-                ORDER BY scheduled_at DESC
-                LIMIT 20
-            """),
-            {"server": server_name},
-        ).mappings().all()
+def list_push_notifications(
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    rows = conn.execute(
+        text("""
+            SELECT
+                id, message, scheduled_at, created_at,
+                fanned_out_at, completed_at, target_count,
+                delivered_count, removed_count, failed_count
+            FROM push_notifications
+            WHERE server_name = :server
+              AND kind = 'scheduled'
+            ORDER BY scheduled_at DESC
+            LIMIT 20
+        """),
+        {"server": server_name},
+    ).mappings().all()
 
     return {"server_name": server_name, "items": list(rows)}
 
@@ -64,6 +57,7 @@ def schedule_push_notification(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     try:
         scheduled = datetime.fromisoformat(payload.scheduled_at)
@@ -87,23 +81,23 @@ def schedule_push_notification(
     scheduled_date = scheduled.date()
     scheduled_utc = scheduled.astimezone(timezone.utc)
 
-    with engine.begin() as conn:
-        row = conn.execute(
-            text("""
-                INSERT INTO push_notifications (server_name, message, scheduled_at, scheduled_date, created_by)
-                VALUES (:server, :message, :scheduled_at, :scheduled_date, :created_by)
-                RETURNING id, message, scheduled_at, created_at
-            """),
-            {
-                "server": server_name,
-                "message": payload.message.strip(),
-                "scheduled_at": scheduled_utc,
-                "scheduled_date": scheduled_date,
-                "created_by": None,
-            },
-        ).mappings().first()
-
-    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+    row = conn.execute(
+        text("""
+            INSERT INTO push_notifications (server_name, message, scheduled_at, scheduled_date, created_by)
+            VALUES (:server, :message, :scheduled_at, :scheduled_date, :created_by)
+            RETURNING id, message, scheduled_at, created_at
+        """),
+        {
+            "server": server_name,
+            "message": payload.message.strip(),
+            "scheduled_at": scheduled_utc,
+            "scheduled_date": scheduled_date,
+            "created_by": None,
+        },
+    ).mappings().first()
+    push_scheduler.notify_scheduled(row["id"], scheduled_utc, conn)
+
+    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
     log_audit_event(
         server_name=server_name,
         actor_user_id=user["id"] if user else None,
@@ -114,16 +108,18 @@ def schedule_push_notification(
             "scheduled_at": scheduled_utc.isoformat(),
             "timezone": payload.timezone,
         },
+        conn=conn,
     )
     return {"server_name": server_name, "item": dict(row)}
 
 
-@router.post("/v1/servers/push/send")
+@router.post("/v1/servers/push/send", status_code=202)
 def send_push_now(
     payload: PushSendPayload,
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     target_sandbox: bool | None = None
     try:
@@ -132,18 +128,17 @@ def send_push_now(
         target_sandbox = None
 
     try:
-        with engine.begin() as conn:
-            rows = conn.execute(
-                text(
-                    """
-                    SELECT token, sandbox, platform
-                    FROM push_device_tokens
-                    WHERE server_name = :server
-                    ORDER BY updated_at DESC
-                    """
-                ),
-                {"server": server_name},
-            ).fetchall()
+        rows = conn.execute(
+            text(
+                """
+                SELECT token, sandbox, platform, device_id
+                FROM push_device_tokens
+                WHERE server_name = :server
+                ORDER BY updated_at DESC
+                """
+            ),
+            {"server": server_name},
+        ).fetchall()
 
         eligible = [
             r for r in rows
@@ -157,66 +152,64 @@ def send_push_now(
         if not eligible:
             raise HTTPException(status_code=404, detail="No push tokens registered for this environment")
 
-        failures = 0
         title = payload.title
         if server_name and server_name.lower() not in title.lower():
             title = f"{title} • {server_name}"
         data = dict(payload.data or {})
         data.setdefault("server_name", server_name)
-        for token, _sandbox, platform in eligible:
-            try:
-                if str(platform or "").lower() == "android":
-                    send_fcm_push(token, title, payload.body, data)
-                else:
-                    send_push(token, title, payload.body, data)
-            except (Unregistered, BadDeviceToken):
-                with engine.begin() as conn:
-                    conn.execute(
-                        text(
-                            """
-                            DELETE FROM push_device_tokens
-                            WHERE server_name = :server AND token = :token
-                            """
-                        ),
-                        {"server": server_name, "token": token},
-                    )
-                failures += 1
-            except FirebaseError as e:
-                if is_unregistered_fcm_error(e):
-                    with engine.begin() as conn:
-                        conn.execute(
-                            text(
-                                """
-                                DELETE FROM push_device_tokens
-                                WHERE server_name = :server AND token = :token
-                                """
-                            ),
-                            {"server": server_name, "token": token},
-                        )
-                    failures += 1
-                    continue
-                raise HTTPException(status_code=502, detail=f"FCM error: {format_fcm_exception(e)}")
-            except APNsException as e:
-                raise HTTPException(status_code=502, detail=f"APNs error: {format_apns_exception(e)}")
-
-        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
-        log_audit_event(
-            server_name=server_name,
-            actor_user_id=user["id"] if user else None,
-            action="push_sent_now",
-            summary="Sent push notification",
-            details={
-                "title": title,
-                "body": payload.body,
-                "tokens": len(eligible),
-                "failed": failures,
-            },
+        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
+        # Delivered by the push scheduler; the audit event is written when the job completes
+        job_id = push_scheduler.enqueue_send_now(
+            server_name,
+            push_scheduler.KIND_SEND_NOW,
+            title,
+            payload.body,
+            data,
+            [(device_id, str(platform or "").lower(), token) for token, _sandbox, platform, device_id in eligible],
+            created_by=user["id"] if user else None,
+            conn=conn,
         )
-        return {"status": "sent", "tokens": len(eligible), "failed": failures}
+        return {"status": "queued", "job_id": job_id, "tokens": len(eligible)}
 
-    except FcmConfigError as e:
-        raise HTTPException(status_code=500, detail=f"FCM config error: {str(e)}")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send push: {str(e)}")
+
+
+@router.get("/v1/servers/push/jobs/{job_id}")
+def get_push_job(
+    job_id: int,
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    row = conn.execute(
+        text("""
+            SELECT
+                pn.id, pn.kind, pn.title, pn.message, pn.created_at, pn.completed_at,
+                pn.target_count, pn.delivered_count, pn.removed_count, pn.failed_count,
+                (SELECT COUNT(*) FROM push_delivery_queue q WHERE q.notification_id = pn.id) AS pending
+            FROM push_notifications pn
+            WHERE pn.id = :id AND pn.server_name = :server
+        """),
+        {"id": job_id, "server": server_name},
+    ).mappings().first()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Push job not found")
+
+    return {
+        "server_name": server_name,
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": "completed" if row["completed_at"] else "pending",
+        "title": row["title"],
+        "body": row["message"],
+        "tokens": row["target_count"],
+        "sent": row["delivered_count"],
+        "failed": row["removed_count"] + row["failed_count"],
+        "invalid_tokens": row["removed_count"],
+        "pending": row["pending"],
+        "created_at": row["created_at"],
+        "completed_at": row["completed_at"],
+    }
@@ -2,20 +2,26 @@
 
 from fastapi import APIRouter, HTTPException, Depends
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 from sqlalchemy.exc import IntegrityError
 from zoneinfo import ZoneInfo
 
-from database import engine
+from database import REQUEST_CONNECTION, after_commit
 from models import ServerRegistrationRequest, ApiKeyResponse, ReopenServerRequest
 from utils import generate_opaque_token, hash_token, generate_invite_code, send_api_key_email
 from auth import require_server_access, require_user
+import server_config
 
 CENTRAL_TZ = ZoneInfo("America/Chicago")
 router = APIRouter()
 
 
 @router.post("/v1/servers/register")
-def register_server(request: ServerRegistrationRequest, user=Depends(require_user)) -> ApiKeyResponse:
+def register_server(
+    request: ServerRegistrationRequest,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+) -> ApiKeyResponse:
     """
     Register a new Minecraft server and get an API key (opaque token).
     
@@ -30,90 +36,90 @@ def register_server(request: ServerRegistrationRequest, user=Depends(require_use
     invite_code = None
     
     try:
-        with engine.begin() as conn:
-            # Check if server name already exists
-            existing = conn.execute(
-                text("SELECT id FROM api_keys WHERE server_name = :server_name AND active = TRUE"),
-                {"server_name": request.server_name}
-            ).fetchone()
+        # Check if server name already exists
+        existing = conn.execute(
+            text("SELECT id FROM api_keys WHERE server_name = :server_name AND active = TRUE"),
+            {"server_name": request.server_name}
+        ).fetchone()
             
-            if existing:
-                raise HTTPException(status_code=409, detail=f"Server name '{request.server_name}' already registered")
+        if existing:
+            raise HTTPException(status_code=409, detail=f"Server name '{request.server_name}' already registered")
 
-            if request.is_private:
-                provided = (request.invite_code or "").strip() or None
-                if provided:
+        if request.is_private:
+            provided = (request.invite_code or "").strip() or None
+            if provided:
+                exists = conn.execute(
+                    text("SELECT id FROM servers WHERE invite_code = :invite_code"),
+                    {"invite_code": provided}
+                ).fetchone()
+                if exists:
+                    raise HTTPException(status_code=409, detail="Invite code already in use. Choose another.")
+                invite_code = provided
+            else:
+                for _ in range(5):
+                    candidate = generate_invite_code()
                     exists = conn.execute(
                         text("SELECT id FROM servers WHERE invite_code = :invite_code"),
-                        {"invite_code": provided}
+                        {"invite_code": candidate}
                     ).fetchone()
-                    if exists:
-                        raise HTTPException(status_code=409, detail="Invite code already in use. Choose another.")
-                    invite_code = provided
-                else:
-                    for _ in range(5):
-                        candidate = generate_invite_code()
-                        exists = conn.execute(
-                            text("SELECT id FROM servers WHERE invite_code = :invite_code"),
-                            {"invite_code": candidate}
-                        ).fetchone()
-                        if not exists:
-                            invite_code = candidate
-                            break
-                    if not invite_code:
-                        raise HTTPException(status_code=500, detail="Failed to generate unique invite code. Try again.")
+                    if not exists:
+                        invite_code = candidate
+                        break
+                if not invite_code:
+                    raise HTTPException(status_code=500, detail="Failed to generate unique invite code. Try again.")
             
-            # Insert new API key (hashed)
-            conn.execute(
-                text("""
-                    INSERT INTO api_keys (key, server_name, active, owner_user_id)
-                    VALUES (:key_hash, :server_name, :active, :owner_user_id)
-                """),
-                {
-                    "key_hash": key_hash,
-                    "server_name": request.server_name,
-                    "active": True,
-                    "owner_user_id": user["id"],
-                }
-            )
-
-            conn.execute(
-                text("""
-                    INSERT INTO servers (
-                        server_name,
-                        owner_user_id,
-                        owner_name,
-                        owner_email,
-                        server_address,
-                        server_version,
-                        is_private,
-                        invite_code
-                    )
-                    VALUES (
-                        :server_name,
-                        :owner_user_id,
-                        :owner_name,
-                        :owner_email,
-                        :server_address,
-                        :server_version,
-                        :is_private,
-                        :invite_code
-                    )
-                """),
-                {
-                    "server_name": request.server_name,
-                    "owner_user_id": user["id"],
-                    "owner_name": request.owner_name,
-                    "owner_email": request.owner_email,
-                    "server_address": request.server_address,
-                    "server_version": request.server_version,
-                    "is_private": request.is_private,
-                    "invite_code": invite_code,
-                }
-            )
+        # Insert new API key (hashed)
+        conn.execute(
+            text("""
+                INSERT INTO api_keys (key, server_name, active, owner_user_id)
+                VALUES (:key_hash, :server_name, :active, :owner_user_id)
+            """),
+            {
+                "key_hash": key_hash,
+                "server_name": request.server_name,
+                "active": True,
+                "owner_user_id": user["id"],
+            }
+        )
+
+        conn.execute(
+            text("""
+                INSERT INTO servers (
+                    server_name,
+                    owner_user_id,
+                    owner_name,
+                    owner_email,
+                    server_address,
+                    server_version,
+                    is_private,
+                    invite_code
+                )
+                VALUES (
+                    :server_name,
+                    :owner_user_id,
+                    :owner_name,
+                    :owner_email,
+                    :server_address,
+                    :server_version,
+                    :is_private,
+                    :invite_code
+                )
+            """),
+            {
+                "server_name": request.server_name,
+                "owner_user_id": user["id"],
+                "owner_name": request.owner_name,
+                "owner_email": request.owner_email,
+                "server_address": request.server_address,
+                "server_version": request.server_version,
+                "is_private": request.is_private,
+                "invite_code": invite_code,
+            }
+        )
             
-            # TODO: Send email to owner_email with the API key
-            # Example: send_email(request.owner_email, plaintext_key, request.server_name)
+        # TODO: Send email to owner_email with the API key
+        # Example: send_email(request.owner_email, plaintext_key, request.server_name)
+        server_config.invalidate(request.server_name, conn)
         
         # Return the plaintext key ONLY on creation (never again)
         response = ApiKeyResponse(
@@ -124,10 +130,8 @@ def register_server(request: ServerRegistrationRequest, user=Depends(require_use
             invite_code=invite_code,
         )
         if request.owner_email:
-            sent = send_api_key_email(request.owner_email, request.server_name, plaintext_key, response.message)
-            if not sent:
-                import logging
-                logging.warning("API key email not sent for server %s (check SMTP config)", request.server_name)
+            # Only mail a key that has committed
+            after_commit(conn, _email_api_key, request.owner_email, request.server_name, plaintext_key, response.message)
         return response
     
     except HTTPException:
@@ -141,8 +145,19 @@ def register_server(request: ServerRegistrationRequest, user=Depends(require_use
         raise HTTPException(status_code=500, detail=f"Failed to register server: {str(e)}")
 
 
+def _email_api_key(owner_email: str, server_name: str, plaintext_key: str, message: str) -> None:
+    sent = send_api_key_email(owner_email, server_name, plaintext_key, message)
+    if not sent:
+        import logging
+        logging.warning("API key email not sent for server %s (check SMTP config)", server_name)
+
+
 @router.post("/v1/servers/reopen")
-def reopen_server(request: ReopenServerRequest, user=Depends(require_user)) -> ApiKeyResponse:
+def reopen_server(
+    request: ReopenServerRequest,
+    user=Depends(require_user),
+    conn: Connection = REQUEST_CONNECTION,
+) -> ApiKeyResponse:
     """
     Reopen a deleted server and issue a new API key to the owner.
     Requires user authentication.
@@ -151,47 +166,48 @@ def reopen_server(request: ReopenServerRequest, user=Depends(require_user)) -> A
     key_hash = hash_token(plaintext_key)
 
     try:
-        with engine.begin() as conn:
-            server = conn.execute(
-                text("""
-                    SELECT server_name, owner_user_id, is_private, invite_code
-                    FROM servers
-                    WHERE server_name = :server_name
-                """),
-                {"server_name": request.server_name}
-            ).mappings().fetchone()
-
-            if not server:
-                raise HTTPException(status_code=404, detail=f"Server '{request.server_name}' not found")
-            if server["owner_user_id"] != user["id"]:
-                raise HTTPException(status_code=403, detail="Not authorized for this server")
-
-            active_key = conn.execute(
-                text("""
-                    SELECT id FROM api_keys
-                    WHERE server_name = :server_name
-                      AND owner_user_id = :owner_user_id
-                      AND active = TRUE
-                    LIMIT 1
-                """),
-                {"server_name": request.server_name, "owner_user_id": user["id"]}
-            ).fetchone()
-
-            if active_key:
-                raise HTTPException(status_code=409, detail="Server already active")
-
-            conn.execute(
-                text("""
-                    INSERT INTO api_keys (key, server_name, active, owner_user_id)
-                    VALUES (:key_hash, :server_name, :active, :owner_user_id)
-                """),
-                {
-                    "key_hash": key_hash,
-                    "server_name": request.server_name,
-                    "active": True,
-                    "owner_user_id": user["id"],
-                }
-            )
+        server = conn.execute(
+            text("""
+                SELECT server_name, owner_user_id, is_private, invite_code
+                FROM servers
+                WHERE server_name = :server_name
+            """),
+            {"server_name": request.server_name}
+        ).mappings().fetchone()
+
+        if not server:
+            raise HTTPException(status_code=404, detail=f"Server '{request.server_name}' not found")
+        if server["owner_user_id"] != user["id"]:
+            raise HTTPException(status_code=403, detail="Not authorized for this server")
+
+        active_key = conn.execute(
+            text("""
+                SELECT id FROM api_keys
+                WHERE server_name = :server_name
+                  AND owner_user_id = :owner_user_id
+                  AND active = TRUE
+                LIMIT 1
+            """),
+            {"server_name": request.server_name, "owner_user_id": user["id"]}
+        ).fetchone()
+
+        if active_key:
+            raise HTTPException(status_code=409, detail="Server already active")
+
+        conn.execute(
+            text("""
+                INSERT INTO api_keys (key, server_name, active, owner_user_id)
+                VALUES (:key_hash, :server_name, :active, :owner_user_id)
+            """),
+            {
+                "key_hash": key_hash,
+                "server_name": request.server_name,
+                "active": True,
+                "owner_user_id": user["id"],
+            }
+        )
+        # max_players is read from the newest key
+        server_config.invalidate(request.server_name, conn)
 
         return ApiKeyResponse(
             api_key=plaintext_key,
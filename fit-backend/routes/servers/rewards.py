@@ -3,10 +3,12 @@
 from fastapi import APIRouter, Depends, HTTPException, Header
 from pydantic import BaseModel, Field
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 import json
-from database import engine
+from database import REQUEST_CONNECTION
 from auth import require_server_access
 from audit import log_audit_event, maybe_get_user
+import server_config
 
 router = APIRouter()
 
@@ -30,34 +32,18 @@ DEFAULT_REWARDS = [
 
 
 @router.get("/v1/servers/rewards")
-def get_server_rewards(server_name: str = Depends(require_server_access)):
-    with engine.begin() as conn:
-        rows = conn.execute(
-            text("""
-                SELECT min_steps, label, item_id, rewards_json
-                FROM server_rewards
-                WHERE server_name = :server
-                ORDER BY min_steps ASC, position ASC
-            """),
-            {"server": server_name},
-        ).fetchall()
-
-    if not rows:
+def get_server_rewards(
+    server_name: str = Depends(require_server_access),
+    conn: Connection = REQUEST_CONNECTION,
+):
+    tiers = server_config.tiers(server_name, conn)
+    if not tiers:
         return {
             "server_name": server_name,
             "tiers": [tier.model_dump() for tier in DEFAULT_REWARDS],
             "is_default": True,
         }
 
-    tiers = []
-    for row in rows:
-        rewards = []
-        try:
-            rewards = json.loads(row[3]) if row[3] else []
-        except Exception:
-            rewards = []
-        tiers.append({"min_steps": row[0], "label": row[1], "item_id": row[2], "rewards": rewards})
-
     return {"server_name": server_name, "tiers": tiers, "is_default": False}
 
 
@@ -66,35 +52,37 @@ def seed_default_rewards(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
-    with engine.begin() as conn:
+    conn.execute(
+        text("DELETE FROM server_rewards WHERE server_name = :server"),
+        {"server": server_name},
+    )
+
+    for idx, tier in enumerate(DEFAULT_REWARDS):
         conn.execute(
-            text("DELETE FROM server_rewards WHERE server_name = :server"),
-            {"server": server_name},
+            text("""
+                INSERT INTO server_rewards (server_name, min_steps, label, item_id, rewards_json, position)
+                VALUES (:server, :min_steps, :label, :item_id, :rewards_json, :position)
+            """),
+            {
+                "server": server_name,
+                "min_steps": tier.min_steps,
+                "label": tier.label,
+                "item_id": tier.item_id,
+                "rewards_json": json.dumps(tier.rewards),
+                "position": idx,
+            },
         )
+    server_config.invalidate(server_name, conn)
 
-        for idx, tier in enumerate(DEFAULT_REWARDS):
-            conn.execute(
-                text("""
-                    INSERT INTO server_rewards (server_name, min_steps, label, item_id, rewards_json, position)
-                    VALUES (:server, :min_steps, :label, :item_id, :rewards_json, :position)
-                """),
-                {
-                    "server": server_name,
-                    "min_steps": tier.min_steps,
-                    "label": tier.label,
-                    "item_id": tier.item_id,
-                    "rewards_json": json.dumps(tier.rewards),
-                    "position": idx,
-                },
-            )
-
-    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
     log_audit_event(
         server_name=server_name,
         actor_user_id=user["id"] if user else None,
         action="rewards_reset_default",
         summary="Reset rewards to default tiers",
+        conn=conn,
     )
     return {
         "server_name": server_name,
@@ -109,19 +97,21 @@ def replace_rewards(
     server_name: str = Depends(require_server_access),
     authorization: str | None = Header(default=None, alias="Authorization"),
     x_user_token: str | None = Header(default=None, alias="X-User-Token"),
+    conn: Connection = REQUEST_CONNECTION,
 ):
     if not payload.tiers:
-        with engine.begin() as conn:
-            conn.execute(
-                text("DELETE FROM server_rewards WHERE server_name = :server"),
-                {"server": server_name},
-            )
-        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+        conn.execute(
+            text("DELETE FROM server_rewards WHERE server_name = :server"),
+            {"server": server_name},
+        )
+        server_config.invalidate(server_name, conn)
+        user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
         log_audit_event(
             server_name=server_name,
             actor_user_id=user["id"] if user else None,
             action="rewards_cleared",
             summary="Cleared all reward tiers",
+            conn=conn,
         )
         return {"server_name": server_name, "tiers": []}
 
@@ -131,34 +121,35 @@ def replace_rewards(
         if not tier.label.strip():
             raise HTTPException(status_code=400, detail="label cannot be empty")
 
-    with engine.begin() as conn:
+    conn.execute(
+        text("DELETE FROM server_rewards WHERE server_name = :server"),
+        {"server": server_name},
+    )
+
+    for idx, tier in enumerate(payload.tiers):
         conn.execute(
-            text("DELETE FROM server_rewards WHERE server_name = :server"),
-            {"server": server_name},
+            text("""
+                INSERT INTO server_rewards (server_name, min_steps, label, item_id, rewards_json, position)
+                VALUES (:server, :min_steps, :label, :item_id, :rewards_json, :position)
+            """),
+            {
+                "server": server_name,
+                "min_steps": tier.min_steps,
+                "label": tier.label,
+                "item_id": tier.item_id,
+                "rewards_json": json.dumps(tier.rewards),
+                "position": idx,
+            },
         )
+    server_config.invalidate(server_name, conn)
 
-        for idx, tier in enumerate(payload.tiers):
-            conn.execute(
-                text("""
-                    INSERT INTO server_rewards (server_name, min_steps, label, item_id, rewards_json, position)
-                    VALUES (:server, :min_steps, :label, :item_id, :rewards_json, :position)
-                """),
-                {
-                    "server": server_name,
-                    "min_steps": tier.min_steps,
-                    "label": tier.label,
-                    "item_id": tier.item_id,
-                    "rewards_json": json.dumps(tier.rewards),
-                    "position": idx,
-                },
-            )
-
-    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token)
+    user = maybe_get_user(authorization=authorization, x_user_token=x_user_token, conn=conn)
     log_audit_event(
         server_name=server_name,
         actor_user_id=user["id"] if user else None,
         action="rewards_updated",
         summary=f"Updated {len(payload.tiers)} reward tier(s)",
         details={"tiers": [tier.model_dump() for tier in payload.tiers]},
+        conn=conn,
     )
     return {"server_name": server_name, "tiers": [tier.model_dump() for tier in payload.tiers]}
@@ -0,0 +1,218 @@
+"""
+Versioned in-memory cache of per-server configuration.
+
+Reward tiers (with rewards_json already parsed), claim_buffer_days, is_private,
+invite_code and max_players are read on nearly every player and server request but
+change only through a handful of settings endpoints. Each server has a version
+counter; the endpoints that change these settings call invalidate() after they
+commit, which bumps the version, drops the entry and (on Postgres) publishes a
+NOTIFY on the server_config channel so other workers drop it too.
+SERVER_CONFIG_TTL_SECONDS bounds staleness when a notification is missed or a
+setting is changed outside the API; 0 disables the cache.
+
+Returned configs are shared between requests; treat them as read-only.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import RequestTransaction, after_commit, engine, run_in_transaction
+import notify_listener
+
+SERVER_CONFIG_TTL_SECONDS = float(os.getenv("SERVER_CONFIG_TTL_SECONDS", "300"))
+DEFAULT_CLAIM_BUFFER_DAYS = 1
+NOTIFY_CHANNEL = "server_config"
+
+
+def _parse_rewards(raw: str | None) -> list[str]:
+    try:
+        return json.loads(raw) if raw else []
+    except Exception:
+        return []
+
+
+def _load(server_name: str, conn: Connection | None) -> dict[str, Any]:
+    if conn is not None:
+        return _read(conn, server_name)
+    with engine.begin() as own_conn:
+        return _read(own_conn, server_name)
+
+
+def _read(conn, server_name: str) -> dict[str, Any]:
+    server = conn.execute(
+        text("""
+            SELECT
+                s.claim_buffer_days,
+                s.is_private,
+                s.invite_code,
+                (
+                    SELECT k.max_players FROM api_keys k
+                    WHERE k.server_name = s.server_name
+                    ORDER BY k.active DESC, k.id DESC
+                    LIMIT 1
+                ) AS max_players
+            FROM servers s
+            WHERE s.server_name = :server
+        """),
+        {"server": server_name},
+    ).fetchone()
+    rows = conn.execute(
+        text("""
+            SELECT min_steps, label, item_id, rewards_json
+            FROM server_rewards
+            WHERE server_name = :server
+            ORDER BY min_steps ASC, position ASC
+        """),
+        {"server": server_name},
+    ).fetchall()
+
+    buffer_days = server[0] if server else None
+    return {
+        "server_name": server_name,
+        "exists": server is not None,
+        "claim_buffer_days": DEFAULT_CLAIM_BUFFER_DAYS if buffer_days is None else max(0, int(buffer_days)),
+        "is_private": bool(server[1]) if server else False,
+        "invite_code": server[2] if server else None,
+        "max_players": server[3] if server else None,
+        # Empty when the server has no custom tiers; callers fall back to their defaults
+        "tiers": [
+            {"min_steps": r[0], "label": r[1], "item_id": r[2], "rewards": _parse_rewards(r[3])}
+            for r in rows
+        ],
+    }
+
+
+class ServerConfigCache:
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}
+        # server_name -> (expires_at, version, config)
+        self._entries: dict[str, tuple[float, int, dict[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, server_name: str, conn: Connection | None = None) -> dict[str, Any]:
+        cached, version = self._lookup(server_name)
+        if cached is not None:
+            return cached
+        return self._store(server_name, _load(server_name, conn), version)
+
+    async def get_async(self, server_name: str, tx: RequestTransaction | None = None) -> dict[str, Any]:
+        cached, version = self._lookup(server_name)
+        if cached is not None:
+            return cached
+        run = tx.run if tx is not None else run_in_transaction
+        return self._store(server_name, await run(_read, server_name), version)
+
+    def _lookup(self, server_name: str) -> tuple[dict[str, Any] | None, int]:
+        now = time.monotonic()
+        with self._lock:
+            version = self._versions.get(server_name, 0)
+            entry = self._entries.get(server_name)
+            if entry is not None and entry[0] > now and entry[1] == version:
+                self.hits += 1
+                return entry[2], version
+            self.misses += 1
+            return None, version
+
+    def _store(self, server_name: str, config: dict[str, Any], version: int) -> dict[str, Any]:
+        config["version"] = version
+        # Unknown servers are not cached so registration does not need to invalidate
+        if self.ttl_seconds > 0 and config["exists"]:
+            with self._lock:
+                # A concurrent invalidate() wins over this (possibly stale) read
+                if self._versions.get(server_name, 0) == version:
+                    self._entries[server_name] = (time.monotonic() + self.ttl_seconds, version, config)
+        return config
+
+    def invalidate(self, server_name: str) -> None:
+        with self._lock:
+            self._versions[server_name] = self._versions.get(server_name, 0) + 1
+            if self._entries.pop(server_name, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for server_name in set(self._versions) | set(self._entries):
+                self._versions[server_name] = self._versions.get(server_name, 0) + 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "ttl_seconds": self.ttl_seconds,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache = ServerConfigCache(SERVER_CONFIG_TTL_SECONDS)
+
+
+def _apply(payload: dict[str, Any]) -> None:
+    if payload.get("server_name"):
+        _cache.invalidate(payload["server_name"])
+    else:
+        _cache.clear()
+
+
+if SERVER_CONFIG_TTL_SECONDS > 0:
+    notify_listener.register(NOTIFY_CHANNEL, _apply, _cache.clear)
+
+
+def get(server_name: str, conn: Connection | None = None) -> dict[str, Any]:
+    """
+    Configuration for a server, from memory when the cached version is current.
+    A miss reads through conn when given (the request's connection).
+    """
+    return _cache.get(server_name, conn)
+
+
+async def get_async(server_name: str, tx: RequestTransaction | None = None) -> dict[str, Any]:
+    """get() for async routes; a miss reads through tx (or database.run_in_transaction)."""
+    return await _cache.get_async(server_name, tx)
+
+
+def claim_buffer_days(server_name: str, conn: Connection | None = None) -> int:
+    return get(server_name, conn)["claim_buffer_days"]
+
+
+def tiers(server_name: str, conn: Connection | None = None) -> list[dict[str, Any]]:
+    """Custom reward tiers ordered by min_steps (empty when the server uses the defaults)."""
+    return get(server_name, conn)["tiers"]
+
+
+def invalidate(server_name: str, conn: Connection | None = None) -> None:
+    """
+    Bump a server's config version. Call after the settings change has committed,
+    or pass the request's connection that made it to bump when that commits.
+    """
+    if conn is None:
+        _cache.invalidate(server_name)
+    else:
+        after_commit(conn, _cache.invalidate, server_name)
+    if SERVER_CONFIG_TTL_SECONDS > 0:
+        notify_listener.publish(NOTIFY_CHANNEL, {"server_name": server_name}, conn)
+
+
+def invalidate_all() -> None:
+    _cache.clear()
+    if SERVER_CONFIG_TTL_SECONDS > 0:
+        notify_listener.publish(NOTIFY_CHANNEL, {})
+
+
+def stats() -> dict[str, Any]:
+    return _cache.stats()
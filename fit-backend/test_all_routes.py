@@ -15,10 +15,14 @@ ROUTES = [
     ("GET", "/v1/servers/available", {}),
     ("GET", "/v1/servers/players/nonexistent_user/claim-status", {"headers": {"X-API-Key": API_KEY}}),
     ("POST", "/v1/servers/players/nonexistent_user/claim-reward", {"headers": {"X-API-Key": API_KEY}}),
+    ("POST", "/v1/servers/players/nonexistent_user/claim-rewards", {"headers": {"X-API-Key": API_KEY}, "json": {"claims": [{"min_steps": 1000}]}}),
+    ("POST", "/v1/servers/claim-available", {"headers": {"X-API-Key": API_KEY}, "json": {"usernames": ["nonexistent_user"]}}),
     ("GET", "/v1/servers/players", {"headers": {"X-API-Key": API_KEY}}),
     ("GET", "/v1/servers/players/nonexistent_user/today-steps", {"headers": {"X-API-Key": API_KEY}}),
+    ("GET", "/v1/servers/push/jobs/0", {"headers": {"X-API-Key": API_KEY}}),
     ("DELETE", "/v1/servers/players/nonexistent_user", {"headers": {"X-API-Key": API_KEY}}),
     ("POST", "/v1/ingest", {"json": {"minecraft_username": "testuser", "device_id": "testdevice", "steps_today": 1000, "player_api_key": "testplayerkey"}}),
+    ("POST", "/v1/ingest/batch", {"json": {"minecraft_username": "testuser", "device_id": "testdevice", "steps_today": 1000, "servers": [{"server_name": "testserver", "player_api_key": "testplayerkey"}]}}),
     ("GET", "/health", {}),
 ]
 
@@ -32,8 +36,10 @@ def test_all_routes():
             response = client.delete(path, **opts)
         else:
             continue
-        # Print for manual review; in real tests, assert expected status and response
+        # Unknown keys and players are rejected, never a server error; behavior is
+        # covered per module (test_ingest_engine.py, test_claim_engine.py, ...)
         print(f"{method} {path} -> {response.status_code} {response.json()}")
+        assert response.status_code < 500, f"{method} {path} -> {response.status_code}"
 
 # Add test for admin server list route
 ADMIN_KEY = os.getenv("MASTER_ADMIN_KEY", "change-me-in-production")
@@ -50,3 +56,16 @@ def test_admin_list_servers():
         assert "active" in s
         assert "created_at" in s
         assert "last_used" in s
+
+def test_admin_metrics():
+    response = client.get("/v1/admin/metrics", headers={"X-Admin-Key": ADMIN_KEY})
+    assert response.status_code == 200
+    data = response.json()
+    assert "ingest_buffer" in data
+    assert "coalescing_ratio" in data["ingest_buffer"]
+    assert "hit_ratio" in data["auth_cache"]["api_keys"]
+    assert "hit_ratio" in data["server_config"]
+    assert "connection_errors" in data["apns_pool"]
+    assert data["push_circuits"]["apns"]["state"] in {"closed", "open", "half_open"}
+    if "api" in data["db_pools"]:
+        assert data["db_pools"]["api"]["checked_out"] >= 0
@@ -0,0 +1,22 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import auth
+from audit import maybe_get_user
+from database import engine
+
+
+def test_maybe_get_user_treats_auth_failures_as_anonymous():
+    with engine.begin() as conn:
+        assert maybe_get_user(authorization=None, x_user_token=None, conn=conn) is None
+        assert maybe_get_user(authorization=None, x_user_token="no-such-session", conn=conn) is None
+
+
+def test_maybe_get_user_lets_database_errors_propagate(monkeypatch):
+    def broken_lookup(conn, token_hash):
+        raise OperationalError("SELECT", {}, Exception("connection lost"))
+
+    monkeypatch.setattr(auth, "_lookup_session", broken_lookup)
+    with engine.begin() as conn:
+        with pytest.raises(OperationalError):
+            maybe_get_user(authorization=None, x_user_token="uncached-session", conn=conn)
@@ -0,0 +1,170 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+import cascade_delete
+import prune_engine
+from database import engine
+
+SERVER = "test-cascade"
+OTHER_SERVER = "test-cascade-other"
+COUNTED_TABLES = ("player_keys", "step_ingest", "step_claims", "bans", "push_device_tokens", "push_deliveries")
+
+
+@pytest.fixture
+def players():
+    """Steve (active) and Alex (inactive for 60 days) on SERVER, plus Steve on OTHER_SERVER."""
+    _cleanup()
+    now = datetime.now(timezone.utc)
+    with engine.begin() as conn:
+        for notification_id, (server, username, device, last_activity) in enumerate((
+            (SERVER, "Steve", "steve-phone", now),
+            (SERVER, "Alex", "alex-phone", now - timedelta(days=60)),
+            (OTHER_SERVER, "Steve", "steve-phone", now),
+        )):
+            params = {
+                "server": server,
+                "username": username,
+                "device": device,
+                "at": last_activity,
+                "notification": -1 - notification_id,
+            }
+            conn.execute(
+                text("""
+                    INSERT INTO player_keys (key, device_id, minecraft_username, server_name, last_activity_at)
+                    VALUES (:server || ':' || :username, :device, :username, :server, :at)
+                """),
+                params,
+            )
+            conn.execute(
+                text("""
+                    INSERT INTO step_ingest (device_id, day, steps_today, minecraft_username, server_name)
+                    VALUES (:device, CURRENT_DATE, 1000, :username, :server)
+                """),
+                params,
+            )
+            conn.execute(
+                text("""
+                    INSERT INTO step_claims (minecraft_username, server_name, day, min_steps, claimed)
+                    VALUES (:username, :server, CURRENT_DATE, 1000, TRUE)
+                """),
+                params,
+            )
+            conn.execute(
+                text("""
+                    INSERT INTO bans (ban_group_id, server_name, minecraft_username, device_id)
+                    VALUES ('g', :server, :username, :device)
+                """),
+                params,
+            )
+            conn.execute(
+                text("""
+                    INSERT INTO push_device_tokens (device_id, server_name, platform, token)
+                    VALUES (:device, :server, 'android', 'token')
+                """),
+                params,
+            )
+            conn.execute(
+                text("""
+                    INSERT INTO push_deliveries (notification_id, device_id, minecraft_username, server_name)
+                    VALUES (:notification, :device, :username, :server)
+                """),
+                params,
+            )
+    yield
+    _cleanup()
+
+
+def _cleanup():
+    with engine.begin() as conn:
+        for table in COUNTED_TABLES:
+            conn.execute(
+                text(f"DELETE FROM {table} WHERE server_name IN (:server, :other)"),
+                {"server": SERVER, "other": OTHER_SERVER},
+            )
+
+
+def _remaining() -> dict[str, list[tuple[str, str]]]:
+    remaining = {}
+    with engine.begin() as conn:
+        for table in COUNTED_TABLES:
+            column = "device_id" if table == "push_device_tokens" else "minecraft_username"
+            remaining[table] = sorted(
+                tuple(row)
+                for row in conn.execute(
+                    text(f"SELECT server_name, {column} FROM {table} WHERE server_name IN (:server, :other)"),
+                    {"server": SERVER, "other": OTHER_SERVER},
+                )
+            )
+    return remaining
+
+
+def test_resolve_players_respects_server_scope(players):
+    assert sorted(cascade_delete.resolve_players("steve")) == [(SERVER, "Steve"), (OTHER_SERVER, "Steve")]
+    assert cascade_delete.resolve_players("STEVE", SERVER) == [(SERVER, "Steve")]
+
+
+def test_wipe_players_clears_every_table_on_that_server_only(players):
+    counts = cascade_delete.wipe_players([(SERVER, "Steve")])
+    assert {table: counts[table] for table in COUNTED_TABLES} == {table: 1 for table in COUNTED_TABLES}
+
+    remaining = _remaining()
+    assert remaining["player_keys"] == [(SERVER, "Alex"), (OTHER_SERVER, "Steve")]
+    assert remaining["push_device_tokens"] == [(SERVER, "alex-phone"), (OTHER_SERVER, "steve-phone")]
+    for table in ("step_ingest", "step_claims", "bans", "push_deliveries"):
+        assert remaining[table] == [(SERVER, "Alex"), (OTHER_SERVER, "Steve")]
+
+
+def test_prune_wipe_removes_only_inactive_players(players):
+    result = prune_engine.prune_server(SERVER, days=30, mode=prune_engine.MODE_WIPE)
+    assert result["removed_players"] == ["Alex"]
+
+    remaining = _remaining()
+    assert remaining["push_device_tokens"] == [(SERVER, "steve-phone"), (OTHER_SERVER, "steve-phone")]
+    for table in ("player_keys", "step_ingest", "step_claims", "bans", "push_deliveries"):
+        assert remaining[table] == [(SERVER, "Steve"), (OTHER_SERVER, "Steve")]
+
+
+def test_prune_deactivate_keeps_player_data(players):
+    result = prune_engine.prune_server(SERVER, days=30, mode=prune_engine.MODE_DEACTIVATE)
+    assert result["removed_players"] == ["Alex"]
+    with engine.begin() as conn:
+        active = conn.execute(
+            text("SELECT minecraft_username, active FROM player_keys WHERE server_name = :server ORDER BY 1"),
+            {"server": SERVER},
+        ).all()
+    assert [tuple(row) for row in active] == [("Alex", False), ("Steve", True)]
+    assert len(_remaining()["step_ingest"]) == 3
+
+
+def test_only_jobs_of_a_stopped_process_are_failed():
+    stale = datetime.now(timezone.utc) - timedelta(seconds=cascade_delete.JOB_STALE_SECONDS + 60)
+    fresh = datetime.now(timezone.utc)
+    jobs = {
+        "dead": ("gone-host:1:dead", stale),
+        "alive": ("other-host:2:live", fresh),
+        "ours": (cascade_delete.WORKER_ID, stale),
+    }
+    with engine.begin() as conn:
+        ids = {
+            name: conn.execute(
+                text("""
+                    INSERT INTO deletion_jobs (kind, server_name, status, worker_id, heartbeat_at)
+                    VALUES ('server', :server, 'running', :worker, :heartbeat)
+                    RETURNING id
+                """),
+                {"server": SERVER, "worker": worker, "heartbeat": heartbeat},
+            ).scalar_one()
+            for name, (worker, heartbeat) in jobs.items()
+        }
+    try:
+        cascade_delete.fail_abandoned_jobs()
+        assert {name: cascade_delete.get_job(job_id)["status"] for name, job_id in ids.items()} == {
+            "dead": cascade_delete.JOB_FAILED,
+            "alive": cascade_delete.JOB_RUNNING,
+            "ours": cascade_delete.JOB_RUNNING,
+        }
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM deletion_jobs WHERE id = ANY(:ids)"), {"ids": list(ids.values())})
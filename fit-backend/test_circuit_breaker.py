@@ -0,0 +1,98 @@
+import pytest
+from firebase_admin import messaging
+from firebase_admin.exceptions import InvalidArgumentError, UnavailableError
+
+import apns_service
+import circuit_breaker
+import fcm_service
+from circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def fcm_circuit(monkeypatch):
+    circuit = CircuitBreaker("FCM", failure_threshold=1, cooldown_seconds=0)
+    monkeypatch.setattr(fcm_service, "_circuit", circuit)
+    monkeypatch.setattr(fcm_service, "get_fcm_app", lambda: None)
+    return circuit
+
+
+@pytest.fixture
+def apns_circuit(monkeypatch):
+    circuit = CircuitBreaker("APNs", failure_threshold=1, cooldown_seconds=0)
+    monkeypatch.setattr(apns_service, "_circuit", circuit)
+    monkeypatch.setattr(apns_service, "get_apns_config", lambda: {"topic": "test.topic"})
+    return circuit
+
+
+def _raise(exc):
+    def send(*args, **kwargs):
+        raise exc
+    return send
+
+
+def test_opens_after_threshold_and_half_opens_after_cooldown():
+    circuit = CircuitBreaker("test", failure_threshold=2, cooldown_seconds=0)
+    circuit.record_failure()
+    assert circuit.stats()["state"] == circuit_breaker.CLOSED
+    circuit.record_failure()
+    assert circuit.stats()["state"] == circuit_breaker.OPEN
+
+    assert circuit.allow() is True  # cooldown over: this is the probe
+    assert circuit.stats()["state"] == circuit_breaker.HALF_OPEN
+    assert circuit.allow() is False  # only one probe at a time
+
+    circuit.record_success()
+    assert circuit.stats()["state"] == circuit_breaker.CLOSED
+    assert circuit.allow() is True
+
+
+def test_failed_probe_reopens_with_longer_cooldown():
+    circuit = CircuitBreaker("test", failure_threshold=1, cooldown_seconds=0.0)
+    circuit.base_cooldown_seconds = circuit._cooldown = 5.0
+    circuit.record_failure()
+    circuit._open_until = 0.0
+    assert circuit.allow() is True
+    circuit.record_failure()
+    stats = circuit.stats()
+    assert stats["state"] == circuit_breaker.OPEN
+    assert stats["cooldown_seconds"] == 10.0
+    assert circuit.allow() is False
+
+
+def test_fcm_probe_rejected_by_provider_closes_circuit(fcm_circuit, monkeypatch):
+    monkeypatch.setattr(messaging, "send_each_for_multicast", _raise(UnavailableError("down")))
+    outcome, _ = fcm_service.send_fcm_multicast(["t1"], "title", "body")[0]
+    assert outcome == fcm_service.FAILED
+    assert fcm_circuit.stats()["state"] == circuit_breaker.OPEN
+
+    # The half-open probe reaches FCM, which rejects the message itself
+    monkeypatch.setattr(messaging, "send_each_for_multicast", _raise(InvalidArgumentError("bad")))
+    outcome, _ = fcm_service.send_fcm_multicast(["t1"], "title", "body")[0]
+    assert outcome == fcm_service.FAILED
+    assert fcm_circuit.stats()["state"] == circuit_breaker.CLOSED
+    assert fcm_circuit.allow() is True
+
+
+def test_fcm_probe_raising_unexpectedly_still_settles(fcm_circuit, monkeypatch):
+    fcm_circuit.record_failure()
+    monkeypatch.setattr(messaging, "send_each_for_multicast", _raise(ValueError("boom")))
+    with pytest.raises(ValueError):
+        fcm_service.send_fcm_multicast(["t1"], "title", "body")
+    assert fcm_circuit.stats()["state"] == circuit_breaker.CLOSED
+
+
+def test_apns_probe_raising_settles_circuit(apns_circuit, monkeypatch):
+    apns_circuit.record_failure()
+    monkeypatch.setattr(apns_service._pool, "send", _raise(RuntimeError("bad payload")))
+    with pytest.raises(RuntimeError):
+        apns_service.send_push_batch(["t1"], "title", "body")
+    assert apns_circuit.stats()["state"] == circuit_breaker.CLOSED
+    assert apns_circuit.allow() is True
+
+
+def test_apns_transport_failure_on_probe_reopens(apns_circuit, monkeypatch):
+    apns_circuit.record_failure()
+    monkeypatch.setattr(apns_service._pool, "send", lambda *args: ({}, OSError("reset")))
+    outcomes = apns_service.send_push_batch(["t1"], "title", "body")
+    assert outcomes[0][0] == apns_service.FAILED
+    assert apns_circuit.stats()["state"] == circuit_breaker.OPEN
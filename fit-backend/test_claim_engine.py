@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from claim_engine import CENTRAL_TZ, claim_items, claim_rewards, claim_window_days
+from database import engine
+
+SERVER = "test-claims"
+TIERS = [
+    {"min_steps": 1000, "label": "Starter", "item_id": "minecraft:bread"},
+    {"min_steps": 5000, "label": "Walker", "item_id": "minecraft:iron_ingot"},
+]
+
+
+@pytest.fixture
+def conn():
+    """Steve walked 6000 steps today and 2000 the two days before; rolled back after."""
+    today = datetime.now(CENTRAL_TZ).date()
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        for offset, steps in ((0, 6000), (1, 2000), (2, 2000)):
+            conn.execute(
+                text("""
+                    INSERT INTO step_ingest (device_id, day, steps_today, minecraft_username, server_name)
+                    VALUES ('claim-device', :day, :steps, 'Steve', :server)
+                """),
+                {"day": today - timedelta(days=offset), "steps": steps, "server": SERVER},
+            )
+        yield conn
+        transaction.rollback()
+
+
+def test_claim_window_is_today_plus_buffer_days():
+    today = datetime.now(CENTRAL_TZ).date()
+    assert claim_window_days(0) == [today]
+    assert claim_window_days(2) == [today, today - timedelta(days=1), today - timedelta(days=2)]
+
+
+def test_claims_outside_window_or_below_tier_are_rejected(conn):
+    today = datetime.now(CENTRAL_TZ).date()
+    results = claim_rewards(
+        conn,
+        SERVER,
+        "Steve",
+        [
+            (str(today + timedelta(days=1)), 1000),
+            (str(today - timedelta(days=2)), 1000),
+            ("yesterday", 1000),
+            (str(today - timedelta(days=1)), 5000),
+        ],
+        buffer_days=1,
+    )
+    assert [r.get("error") for r in results] == [
+        "Cannot claim future days",
+        "Day is outside claim window",
+        "Invalid day format (YYYY-MM-DD)",
+        "Not enough steps for this tier",
+    ]
+    assert not any(r["claimed"] for r in results)
+    assert results[3]["steps"] == 2000
+
+
+def test_second_claim_reports_already_claimed(conn):
+    first = claim_rewards(conn, SERVER, "Steve", [(None, 1000), (None, 5000)], buffer_days=1)
+    assert [(r["claimed"], r["already_claimed"]) for r in first] == [(True, False), (True, False)]
+
+    again = claim_rewards(conn, SERVER, "Steve", [(None, 5000)], buffer_days=1)
+    assert again[0]["claimed"] is True
+    assert again[0]["already_claimed"] is True
+    assert again[0]["claimed_at"] == first[1]["claimed_at"]
+
+
+def test_claimed_tiers_leave_the_available_list(conn):
+    days = claim_window_days(1)
+    available = claim_items(conn, SERVER, ["Steve"], TIERS, days)["Steve"]
+    assert [(item["day"], item["min_steps"]) for item in available] == [
+        (str(days[0]), 1000),
+        (str(days[0]), 5000),
+        (str(days[1]), 1000),
+    ]
+
+    claim_rewards(conn, SERVER, "Steve", [(None, 5000)], buffer_days=1)
+    available = claim_items(conn, SERVER, ["Steve"], TIERS, days)["Steve"]
+    assert (str(days[0]), 5000) not in [(item["day"], item["min_steps"]) for item in available]
+    status = claim_items(conn, SERVER, ["Steve"], TIERS, days, include_claimed=True)["Steve"]
+    assert [item["claimed"] for item in status] == [False, True, False]
@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+import database
+from database import (
+    REQUEST_CONNECTION,
+    REQUEST_TRANSACTION,
+    RequestTransaction,
+    after_commit,
+    direct_engine,
+    engine,
+    init_db,
+    request_transaction,
+    run_in_transaction,
+)
+
+SERVER = "test-database"
+
+
+def _xact_status(txid):
+    with engine.begin() as conn:
+        return conn.execute(text("SELECT pg_xact_status(CAST(:txid AS xid8))"), {"txid": str(txid)}).scalar_one()
+
+
+def test_run_in_transaction_defers_after_commit_callbacks():
+    seen = []
+
+    def work(conn):
+        txid = conn.execute(text("SELECT pg_current_xact_id()::text")).scalar_one()
+        after_commit(conn, lambda: seen.append(_xact_status(txid)))
+        assert seen == []
+        return txid
+
+    asyncio.run(run_in_transaction(work))
+    assert seen == ["committed"]
+
+
+def test_run_in_transaction_drops_callbacks_on_rollback():
+    seen = []
+
+    def work(conn):
+        after_commit(conn, seen.append, "ran")
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_in_transaction(work))
+    assert seen == []
+
+
+def test_request_transaction_defers_after_commit_callbacks():
+    seen = []
+
+    def work(conn):
+        txid = conn.execute(text("SELECT pg_current_xact_id()::text")).scalar_one()
+        after_commit(conn, lambda: seen.append(_xact_status(txid)))
+
+    async def request():
+        dependency = request_transaction()
+        tx = await anext(dependency)
+        await tx.run(work)
+        await tx.run(work)
+        assert seen == []
+        with pytest.raises(StopAsyncIteration):
+            await anext(dependency)
+
+    asyncio.run(request())
+    assert seen == ["committed", "committed"]
+
+
+def _audit(conn, action):
+    conn.execute(
+        text("INSERT INTO audit_logs (server_name, action) VALUES (:server, :action)"),
+        {"server": SERVER, "action": action},
+    )
+
+
+def _audited_actions():
+    with engine.begin() as conn:
+        return conn.execute(
+            text("SELECT action FROM audit_logs WHERE server_name = :server ORDER BY id"), {"server": SERVER}
+        ).scalars().all()
+
+
+@pytest.fixture
+def request_client():
+    """An app with sync and async routes that write, queue a callback, then maybe fail."""
+    app = FastAPI()
+    app.state.callbacks = []
+
+    @app.post("/sync/{action}")
+    def sync_route(action: str, fail: bool = False, conn: Connection = REQUEST_CONNECTION):
+        _audit(conn, action)
+        after_commit(conn, app.state.callbacks.append, action)
+        if fail:
+            raise HTTPException(status_code=409, detail="handler failed")
+        return {"ok": True}
+
+    @app.post("/async/{action}")
+    async def async_route(action: str, fail: bool = False, tx: RequestTransaction = REQUEST_TRANSACTION):
+        def work(conn):
+            _audit(conn, action)
+            after_commit(conn, app.state.callbacks.append, action)
+
+        await tx.run(work)
+        if fail:
+            raise HTTPException(status_code=409, detail="handler failed")
+        return {"ok": True}
+
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM audit_logs WHERE server_name = :server"), {"server": SERVER})
+    yield TestClient(app), app.state.callbacks
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM audit_logs WHERE server_name = :server"), {"server": SERVER})
+
+
+@pytest.mark.parametrize("kind", ["sync", "async"])
+def test_request_rolls_back_when_handler_raises(request_client, kind):
+    client, callbacks = request_client
+    assert client.post(f"/{kind}/failed?fail=true").status_code == 409
+    assert _audited_actions() == []
+    assert callbacks == []
+
+    assert client.post(f"/{kind}/committed").status_code == 200
+    assert _audited_actions() == ["committed"]
+    assert callbacks == ["committed"]
+
+
+def _schema_versions():
+    with engine.begin() as conn:
+        return conn.execute(text("SELECT version FROM schema_version ORDER BY version")).scalars().all()
+
+
+def test_init_db_is_a_noop_when_current(monkeypatch):
+    def must_not_run(conn):
+        raise AssertionError("migration re-applied")
+
+    versions = _schema_versions()
+    monkeypatch.setattr(database, "MIGRATIONS", [(v, n, must_not_run) for v, n, _ in database.MIGRATIONS])
+    init_db()
+    assert _schema_versions() == versions
+
+
+def test_migrations_can_be_re_run():
+    # Each migration is idempotent, so a run interrupted after its DDL can repeat it
+    with direct_engine.connect() as conn:
+        for _, _, migrate in database.MIGRATIONS:
+            with conn.begin() as transaction:
+                migrate(conn)
+                transaction.rollback()
+
+
+@pytest.fixture
+def pending_migration(monkeypatch):
+    version = database.SCHEMA_VERSION + 1
+    applied = []
+    monkeypatch.setattr(database, "MIGRATIONS", [*database.MIGRATIONS, (version, "test", applied.append)])
+    monkeypatch.setattr(database, "SCHEMA_VERSION", version)
+    yield version, applied
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM schema_version WHERE version = :version"), {"version": version})
+
+
+def test_init_db_applies_a_pending_migration_once(pending_migration):
+    version, applied = pending_migration
+    init_db()
+    init_db()
+    assert len(applied) == 1
+    assert _schema_versions()[-1] == version
+
+
+def test_init_db_rereads_the_version_under_the_lock(pending_migration, monkeypatch):
+    # Another worker applies the migration while this one waits for the lock
+    version, applied = pending_migration
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO schema_version (version, name) VALUES (:version, 'test')"), {"version": version})
+    reads = []
+    real_read = database.current_schema_version
+
+    def stale_first_read(conn):
+        reads.append(real_read(conn))
+        return version - 1 if len(reads) == 1 else reads[-1]
+
+    monkeypatch.setattr(database, "current_schema_version", stale_first_read)
+    init_db()
+    assert len(reads) == 2
+    assert applied == []
@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+import auth_cache
+import ingest_engine
+from database import engine
+from ingest_engine import CENTRAL_TZ, ingest_response, run_ingest
+from utils import hash_token
+
+SERVER = "test-ingest"
+DEVICE = "ingest-device"
+KEY = "ingest-player-key"
+
+
+@pytest.fixture
+def conn():
+    """A connection whose writes are rolled back after the test."""
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(
+            text("""
+                INSERT INTO player_keys (key, device_id, minecraft_username, server_name)
+                VALUES (:key, :device, 'Alex', :server)
+            """),
+            {"key": hash_token(KEY), "device": DEVICE, "server": SERVER},
+        )
+        yield conn
+        transaction.rollback()
+
+
+def _ingest(conn, username, steps, device=DEVICE, key=KEY):
+    day = datetime.now(CENTRAL_TZ).date()
+    return run_ingest(conn, device, username, [(hash_token(key), None, day, steps)], "test")[0]
+
+
+def _bound_username(conn):
+    return conn.execute(
+        text("SELECT minecraft_username FROM player_keys WHERE key = :key"), {"key": hash_token(KEY)}
+    ).scalar_one()
+
+
+def test_accepts_only_higher_steps(conn):
+    row = _ingest(conn, "Alex", 1000)
+    assert row["server_name"] == SERVER
+    assert row["upserted"] is True
+    assert ingest_response(row, DEVICE, "Alex")["new_day"] is True
+
+    assert _ingest(conn, "Alex", 500)["upserted"] is False
+    row = _ingest(conn, "Alex", 1500)
+    assert row["upserted"] is True
+    assert row["previous_steps"] == 1000
+
+
+def test_rejects_unknown_key_and_other_device(conn):
+    assert _ingest(conn, "Alex", 1000, key="not-a-key")["server_name"] is None
+    row = _ingest(conn, "Alex", 1000, device="other-device")
+    assert row["server_name"] is None
+    with pytest.raises(HTTPException) as exc:
+        ingest_response(row, "other-device", "Alex")
+    assert exc.value.status_code == 401
+
+
+def test_rejects_banned_player_without_rebinding(conn):
+    conn.execute(
+        text("""
+            INSERT INTO bans (ban_group_id, server_name, minecraft_username, reason)
+            VALUES ('g', :server, 'Steve', 'griefing')
+        """),
+        {"server": SERVER},
+    )
+    row = _ingest(conn, "Steve", 1000)
+    assert row["banned"] is True
+    assert row["upserted"] is False
+    assert _bound_username(conn) == "Alex"
+
+
+def test_rejects_second_username_on_device_same_day(conn):
+    _ingest(conn, "Alex", 1000)
+    row = _ingest(conn, "Steve", 2000)
+    assert row["first_username"] == "Alex"
+    assert row["upserted"] is False
+    assert ingest_response(row, DEVICE, "Steve")["ok"] is False
+
+
+def test_rebinds_username_and_invalidates_in_transaction(conn, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(auth_cache, "invalidate_players", lambda **kwargs: invalidated.append(kwargs))
+    day = datetime.now(CENTRAL_TZ).date()
+
+    rows = ingest_engine._run_ingest_and_invalidate(
+        conn, DEVICE, "Steve", [(hash_token(KEY), None, day, 1000)], "test", True
+    )
+    assert rows[0]["previous_username"] == "Alex"
+    assert rows[0]["upserted"] is True
+    assert _bound_username(conn) == "Steve"
+    assert invalidated == [{"server_name": SERVER, "device_id": DEVICE, "conn": conn}]
+
+    invalidated.clear()
+    ingest_engine._run_ingest_and_invalidate(
+        conn, DEVICE, "Steve", [(hash_token(KEY), None, day, 2000)], "test", True
+    )
+    assert invalidated == []
+
+
+def test_rebind_covers_every_key_row_of_the_device_on_that_server(conn):
+    # Tables created before UNIQUE(device_id, server_name) can hold several rows
+    conn.execute(text("ALTER TABLE player_keys DROP CONSTRAINT IF EXISTS player_keys_device_id_server_name_key"))
+    conn.execute(
+        text("""
+            INSERT INTO player_keys (key, device_id, minecraft_username, server_name, active)
+            VALUES ('old-key', :device, 'Alex', :server, FALSE), ('other-device-key', 'other', 'Alex', :server, TRUE)
+        """),
+        {"device": DEVICE, "server": SERVER},
+    )
+    _ingest(conn, "Steve", 1000)
+    bound = conn.execute(
+        text("SELECT key, minecraft_username FROM player_keys WHERE server_name = :server ORDER BY key"),
+        {"server": SERVER},
+    ).all()
+    assert [tuple(row) for row in bound] == [
+        (hash_token(KEY), "Steve"),
+        ("old-key", "Steve"),
+        ("other-device-key", "Alex"),
+    ]
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+import push_retention
+from database import engine
+
+SERVER = "test-push-retention"
+
+
+@pytest.fixture
+def deliveries():
+    _cleanup()
+    now = datetime.now(timezone.utc)
+    old = now - timedelta(days=60)
+    with engine.begin() as conn:
+        notification_id = conn.execute(
+            text("""
+                INSERT INTO push_notifications (server_name, message, scheduled_at, scheduled_date)
+                VALUES (:server, 'pending', :at, :day)
+                RETURNING id
+            """),
+            {"server": SERVER, "at": now, "day": now.date()},
+        ).scalar_one()
+        missing_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) + 1000 FROM push_notifications")).scalar_one()
+        rows = [(missing_id, f"orphan-{i}", old) for i in range(5)]
+        rows.append((missing_id, "orphan-recent", now))
+        rows.append((notification_id, "kept", old))
+        for notification, device_id, delivered_at in rows:
+            conn.execute(
+                text("""
+                    INSERT INTO push_deliveries (notification_id, device_id, minecraft_username, server_name, delivered_at)
+                    VALUES (:notification, :device, 'Steve', :server, :delivered_at)
+                """),
+                {"notification": notification, "device": device_id, "server": SERVER, "delivered_at": delivered_at},
+            )
+    yield
+    _cleanup()
+
+
+def _cleanup():
+    with engine.begin() as conn:
+        for table in ("push_deliveries", "push_notifications"):
+            conn.execute(text(f"DELETE FROM {table} WHERE server_name = :server"), {"server": SERVER})
+
+
+def test_orphan_pass_pages_through_the_table(deliveries, monkeypatch):
+    monkeypatch.setattr(push_retention, "CHUNK_ROWS", 2)
+    result = push_retention.run_push_retention_once(retention_days=30)
+    assert result["orphan_rows_deleted"] >= 5  # the database may hold older orphans too
+    with engine.begin() as conn:
+        remaining = conn.execute(
+            text("SELECT device_id FROM push_deliveries WHERE server_name = :server ORDER BY device_id"),
+            {"server": SERVER},
+        ).scalars().all()
+    assert remaining == ["kept", "orphan-recent"]
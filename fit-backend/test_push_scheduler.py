@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+import apns_service
+import push_scheduler
+from database import engine
+
+SERVER = "test-push-scheduler"
+
+
+@pytest.fixture
+def notification(monkeypatch):
+    monkeypatch.delenv("APNS_CERT_PATH", raising=False)
+    monkeypatch.delenv("APNS_TOPIC", raising=False)
+    _cleanup()
+    now = datetime.now(timezone.utc)
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO push_device_tokens (device_id, server_name, platform, token, sandbox, created_at)
+                VALUES
+                    ('ps-android', :server, 'android', 'fcm-token', FALSE, :created),
+                    ('ps-ios', :server, 'ios', 'apns-token', TRUE, :created)
+            """),
+            {"server": SERVER, "created": now - timedelta(days=1)},
+        )
+        notification_id = conn.execute(
+            text("""
+                INSERT INTO push_notifications (server_name, message, scheduled_at, scheduled_date)
+                VALUES (:server, 'hello', :at, :day)
+                RETURNING id
+            """),
+            {"server": SERVER, "at": now - timedelta(minutes=1), "day": now.date()},
+        ).scalar_one()
+    yield notification_id
+    _cleanup()
+
+
+def _cleanup():
+    with engine.begin() as conn:
+        for table in ("push_delivery_queue", "push_deliveries", "push_notifications", "push_device_tokens"):
+            conn.execute(text(f"DELETE FROM {table} WHERE server_name = :server"), {"server": SERVER})
+
+
+def _state(notification_id):
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("""
+                SELECT fanned_out_at, completed_at, target_count, ios_fanout_pending
+                FROM push_notifications WHERE id = :id
+            """),
+            {"id": notification_id},
+        ).mappings().one()
+        platforms = conn.execute(
+            text("SELECT platform FROM push_delivery_queue WHERE notification_id = :id ORDER BY platform"),
+            {"id": notification_id},
+        ).scalars().all()
+    return dict(row), platforms
+
+
+def _fan_out_everything():
+    while push_scheduler.fan_out_due(datetime.now(timezone.utc)) == push_scheduler.FANOUT_BATCH:
+        pass
+
+
+def test_ios_targets_held_back_until_apns_is_configured(notification, monkeypatch):
+    _fan_out_everything()
+    row, platforms = _state(notification)
+    assert row["fanned_out_at"] is not None
+    assert row["ios_fanout_pending"] is True
+    assert row["completed_at"] is None
+    assert row["target_count"] == 1
+    assert platforms == ["android"]
+
+    monkeypatch.setenv("APNS_CERT_PATH", "/nonexistent/cert.pem")
+    monkeypatch.setenv("APNS_TOPIC", "test.topic")
+    monkeypatch.setenv("APNS_USE_SANDBOX", "true")
+    apns_service.get_apns_config.cache_clear()
+    try:
+        assert push_scheduler.has_pending_work(datetime.now(timezone.utc))
+        _fan_out_everything()
+    finally:
+        apns_service.get_apns_config.cache_clear()
+
+    row, platforms = _state(notification)
+    assert row["ios_fanout_pending"] is False
+    assert row["completed_at"] is None
+    assert row["target_count"] == 2
+    assert platforms == ["android", "ios"]
+
+
+def test_notification_without_ios_targets_is_not_held(notification):
+    with engine.begin() as conn:
+        conn.execute(
+            text("DELETE FROM push_device_tokens WHERE server_name = :server AND platform = 'ios'"),
+            {"server": SERVER},
+        )
+    _fan_out_everything()
+    row, platforms = _state(notification)
+    assert row["ios_fanout_pending"] is False
+    assert platforms == ["android"]
+
+
+def test_expired_leases_count_as_attempts(notification, monkeypatch):
+    monkeypatch.setattr(push_scheduler, "MAX_ATTEMPTS", 2)
+    with engine.begin() as conn:
+        conn.execute(
+            text("DELETE FROM push_device_tokens WHERE server_name = :server AND platform = 'ios'"),
+            {"server": SERVER},
+        )
+    _fan_out_everything()
+
+    def expire_lease():
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    UPDATE push_delivery_queue SET next_attempt_at = NOW() - INTERVAL '1 second'
+                    WHERE server_name = :server
+                """),
+                {"server": SERVER},
+            )
+
+    # Each claim whose worker dies before settling leaves the lease to expire
+    assert [m["attempts"] for m in push_scheduler.load_due_messages(10)] == [0]
+    expire_lease()
+    assert [m["attempts"] for m in push_scheduler.load_due_messages(10)] == [1]
+    expire_lease()
+
+    def never_send(*args, **kwargs):
+        raise AssertionError("an exhausted row must not be sent again")
+
+    selected, resolved = push_scheduler.run_push_once({"android": never_send, "ios": never_send})
+    assert (selected, resolved) == (1, 0)
+    row, platforms = _state(notification)
+    assert platforms == []
+    assert row["completed_at"] is not None
+
+
+def test_send_now_job_rolls_back_with_the_callers_transaction(notification):
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        job_id = push_scheduler.enqueue_send_now(
+            SERVER,
+            push_scheduler.KIND_SEND_NOW,
+            "title",
+            "body",
+            {},
+            [("ps-android", "android", "fcm-token")],
+            conn=conn,
+        )
+        assert _job_rows(job_id) == (0, 0)  # not visible before the caller commits
+        transaction.rollback()
+    assert _job_rows(job_id) == (0, 0)
+
+
+def _job_rows(job_id):
+    with engine.begin() as conn:
+        return tuple(
+            conn.execute(
+                text(f"SELECT COUNT(*) FROM {table} WHERE {column} = :id"), {"id": job_id}
+            ).scalar_one()
+            for table, column in (("push_notifications", "id"), ("push_delivery_queue", "notification_id"))
+        )